@@ -0,0 +1,466 @@
+"""
+Benchmarks for the diffusion kernel builders in util and the model classes in models.
+
+Every case runs in a freshly forked process, so its peak RSS is not inflated by earlier
+cases.  Results are written as JSON:
+
+    python benchmark.py --sizes 500 2000 --density 0.005 --output benchmark.json
+"""
+import argparse
+import contextlib
+import inspect
+import json
+import multiprocessing
+import os
+import platform
+import re
+import sys
+import time
+import traceback
+
+import numpy as np
+import scipy.sparse as sp
+
+import callbacks
+import util
+
+
+# Builders whose implementation needs a dense adjacency matrix.
+_DENSE_INPUT_BUILDERS = (
+    'A_to_diffusion_kernel',
+    'A_to_post_sparse_diffusion_kernel',
+    'A_to_pre_sparse_diffusion_kernel',
+    'sparse_A_to_diffusion_kernel',
+)
+
+DEFAULT_PARAMETERS = {
+    'num_hops': 2,
+    'learning_rate': 0.05,
+    'num_epochs': 1,
+    'batch_size': 100,
+    'loss_fn': 'categorical_crossentropy',
+    'update_fn': 'adam',
+    'momentum': False,
+    'dcnn_nonlinearity': 'tanh',
+    'dense_nonlinearity': 'tanh',
+    'out_nonlinearity': 'softmax',
+    'stop_early': False,
+    'stop_window_size': 1,
+    'print_train_accuracy': False,
+    'print_valid_accuracy': False,
+    'diffusion_threshold': 0.1,
+    'num_dcnn_layers': 2,
+    'num_dense_layers': 1,
+    'dense_layer_size': 16,
+}
+
+
+class BenchmarkParameters(object):
+    """Model hyperparameters for a benchmark case, with the attributes the models read."""
+    def __init__(self, **kwargs):
+        self.__dict__.update(DEFAULT_PARAMETERS)
+        self.__dict__.update(kwargs)
+
+
+def _edges_to_adjacency(rows, cols, num_nodes):
+    """Builds a symmetric 0/1 CSR adjacency matrix without self loops from an edge list."""
+    keep = rows != cols
+    rows, cols = rows[keep], cols[keep]
+
+    A = sp.coo_matrix(
+        (np.ones(2 * rows.shape[0]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+        shape=(num_nodes, num_nodes)
+    ).tocsr()
+    A.data[:] = 1.0
+
+    return A
+
+
+def _num_edges(num_nodes, density):
+    return int(round(density * num_nodes * (num_nodes - 1) / 2.0))
+
+
+def erdos_renyi_graph(num_nodes, density, seed=None):
+    """
+    Samples an Erdos-Renyi graph.
+
+    :param num_nodes: integer, number of nodes
+    :param density: float, expected fraction of the possible edges that are present
+    :param seed: optional integer seed
+    :return: scipy.sparse CSR adjacency matrix
+    """
+    rng = np.random.RandomState(seed)
+    num_edges = _num_edges(num_nodes, density)
+
+    rows = rng.randint(0, num_nodes, num_edges)
+    cols = rng.randint(0, num_nodes, num_edges)
+
+    return _edges_to_adjacency(rows, cols, num_nodes)
+
+
+def power_law_graph(num_nodes, density, exponent=2.5, seed=None):
+    """
+    Samples a graph with a power-law degree distribution (Chung-Lu model).
+
+    :param num_nodes: integer, number of nodes
+    :param density: float, expected fraction of the possible edges that are present
+    :param exponent: float > 2, exponent of the degree distribution
+    :param seed: optional integer seed
+    :return: scipy.sparse CSR adjacency matrix
+    """
+    rng = np.random.RandomState(seed)
+    num_edges = _num_edges(num_nodes, density)
+
+    weights = np.arange(1, num_nodes + 1) ** (-1.0 / (exponent - 1.0))
+    weights /= weights.sum()
+
+    rows = rng.choice(num_nodes, num_edges, p=weights)
+    cols = rng.choice(num_nodes, num_edges, p=weights)
+
+    return _edges_to_adjacency(rows, cols, num_nodes)
+
+
+def community_graph(num_nodes, density, num_communities=8, mixing=0.1, seed=None):
+    """
+    Samples a planted-partition graph.
+
+    :param num_nodes: integer, number of nodes
+    :param density: float, expected fraction of the possible edges that are present
+    :param num_communities: integer, number of communities
+    :param mixing: float, fraction of the edges that cross communities
+    :param seed: optional integer seed
+    :return: scipy.sparse CSR adjacency matrix and the community of each node
+    """
+    rng = np.random.RandomState(seed)
+    num_edges = _num_edges(num_nodes, density)
+
+    communities = rng.randint(0, num_communities, num_nodes)
+    members = np.argsort(communities, kind='mergesort')
+    sizes = np.bincount(communities, minlength=num_communities)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    rows = rng.randint(0, num_nodes, num_edges)
+    cols = rng.randint(0, num_nodes, num_edges)
+
+    # Redirect the non-mixing edges to a random member of the source node's community.
+    inside = rng.rand(num_edges) >= mixing
+    c = communities[rows[inside]]
+    cols[inside] = members[starts[c] + (rng.rand(c.shape[0]) * sizes[c]).astype(int)]
+
+    return _edges_to_adjacency(rows, cols, num_nodes), communities
+
+
+graph_generator_map = {
+    'erdos_renyi': erdos_renyi_graph,
+    'power_law': power_law_graph,
+    'community': lambda num_nodes, density, seed=None: community_graph(num_nodes, density, seed=seed)[0],
+}
+
+
+def _node_data(A, num_features, num_classes, seed):
+    rng = np.random.RandomState(seed)
+    num_nodes = A.shape[0]
+
+    X = rng.rand(num_nodes, num_features).astype('float32')
+    Y = np.zeros((num_nodes, num_classes), dtype='int32')
+    Y[np.arange(num_nodes), rng.randint(0, num_classes, num_nodes)] = 1
+
+    return X, Y
+
+
+def _graph_data(generator, num_graphs, graph_size, density, num_features, num_classes, seed):
+    rng = np.random.RandomState(seed)
+
+    A, X, Y = [], [], []
+    for g in range(num_graphs):
+        num_nodes = rng.randint(max(2, graph_size // 2), graph_size + 1)
+        A.append(generator(num_nodes, density, seed=rng.randint(2 ** 31)).toarray().astype('float32'))
+        X.append(rng.rand(num_nodes, num_features).astype('float32'))
+
+        y = np.zeros((1, num_classes), dtype='int32')
+        y[0, rng.randint(num_classes)] = 1
+        Y.append(y)
+
+    return A, X, Y
+
+
+def _timed(record, key, fn, *args):
+    start = time.time()
+    result = fn(*args)
+    record[key] = time.time() - start
+    return result
+
+
+def kernel_builders():
+    """Returns the names of the diffusion kernel and feature builders in util."""
+    return sorted(
+        name for name, fn in inspect.getmembers(util, inspect.isfunction)
+        if name.startswith('A_to_') or name == 'sparse_A_to_diffusion_kernel'
+    )
+
+
+def model_classes(base):
+    """
+    Returns the names of the model classes in models derived from base.
+
+    :param base: 'NodeClassificationDCNN' or 'GraphClassificationDCNN'
+    """
+    import models
+
+    base = getattr(models, base)
+    return sorted(
+        name for name, cls in inspect.getmembers(models, inspect.isclass)
+        if issubclass(cls, base) and cls.__module__ == models.__name__
+    )
+
+
+def _run_kernel_builder(record, config, A, X):
+    name = record['name']
+    build = getattr(util, name)
+
+    args = [A.toarray() if name in _DENSE_INPUT_BUILDERS else A]
+    for arg in inspect.getargspec(build).args[1:]:
+        if arg == 'X':
+            args.append(X)
+        elif arg == 'k':
+            args.append(config['num_hops'])
+        elif arg in ('threshold', 'epsilon'):
+            args.append(config['diffusion_threshold'])
+        else:
+            break
+
+    kwargs = {}
+    if 'stats' in inspect.getargspec(build).args:
+        kwargs['stats'] = record['build_stats'] = {}
+
+    K = _timed(record, 'build_s', lambda: build(*args, **kwargs))
+
+    if not name.endswith('_features') and not isinstance(K, list):
+        rows = np.random.RandomState(0).choice(A.shape[0], min(config['batch_size'], A.shape[0]), replace=False)
+        _timed(record, 'gather_s', lambda: K[rows, :, :])
+
+
+def _run_node_model(record, config, A, X, Y):
+    import models
+
+    num_nodes = A.shape[0]
+    parameters = BenchmarkParameters(
+        num_nodes=num_nodes,
+        num_features=X.shape[1],
+        num_classes=Y.shape[1],
+        **config['parameters']
+    )
+
+    indices = np.random.RandomState(0).permutation(num_nodes).astype('int32')
+    train_indices = indices[:num_nodes // 2]
+    valid_indices = indices[num_nodes // 2:]
+
+    model = _timed(record, 'construct_s', getattr(models, record['name']), parameters, A.toarray())
+    history = callbacks.MetricsHistory()
+    _timed(record, 'epoch_s', model.fit, X, Y, train_indices, valid_indices, [history])
+    record['epoch'] = history.epochs[-1]
+    _timed(record, 'predict_s', model.predict, X, valid_indices)
+
+
+def _run_graph_model(record, config, A, X, Y):
+    import models
+
+    parameters = BenchmarkParameters(
+        num_features=X[0].shape[1],
+        num_classes=Y[0].shape[1],
+        **config['parameters']
+    )
+
+    indices = np.arange(len(A))
+    train_indices = indices[:len(A) // 2]
+    valid_indices = indices[len(A) // 2:]
+
+    model = _timed(record, 'construct_s', getattr(models, record['name']), parameters)
+    # Per-graph preprocessing (power series, coarsening hierarchies) is done once and reused by
+    # fit, so it is timed on its own and predict is fed the same preprocessed graphs.
+    graphs = _timed(record, 'preprocess_s', model._graph_inputs, A)
+    history = callbacks.MetricsHistory()
+    _timed(record, 'epoch_s', model.fit, A, X, Y, train_indices, valid_indices, [history])
+    record['epoch'] = history.epochs[-1]
+    _timed(record, 'predict_s', lambda: [model.predict(graphs[i], X[i]) for i in valid_indices])
+
+
+@contextlib.contextmanager
+def quiet_stdout():
+    """Sends stdout to os.devnull for the duration of the block, e.g. while a model prints its progress."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _run_case(connection, record, config):
+    record['rss_start_kb'] = callbacks.peak_rss_kb()
+
+    # Model training prints progress; keep the benchmark output clean.
+    with quiet_stdout():
+        try:
+            generator = graph_generator_map[record['graph']]
+
+            if record['kind'] == 'graph_model':
+                A, X, Y = _graph_data(
+                    generator, config['num_graphs'], record['num_nodes'], record['density'],
+                    config['num_features'], config['num_classes'], config['seed']
+                )
+                record['num_edges'] = int(sum(a.sum() for a in A) // 2)
+                _run_graph_model(record, config, A, X, Y)
+            else:
+                A = generator(record['num_nodes'], record['density'], seed=config['seed'])
+                X, Y = _node_data(A, config['num_features'], config['num_classes'], config['seed'])
+                record['num_edges'] = int(A.nnz // 2)
+
+                if record['kind'] == 'kernel':
+                    _run_kernel_builder(record, config, A, X)
+                else:
+                    _run_node_model(record, config, A, X, Y)
+        except Exception:
+            record['error'] = traceback.format_exc().strip().splitlines()[-1]
+
+    record['peak_rss_kb'] = callbacks.peak_rss_kb()
+    connection.send(record)
+    connection.close()
+
+
+def run_case(record, config, timeout=None):
+    """
+    Runs one benchmark case in a forked process.
+
+    :param record: dict with kind ('kernel', 'node_model' or 'graph_model'), name, graph,
+                   num_nodes and density; timings and memory are added to it
+    :param config: dict of benchmark settings, see run_benchmarks
+    :param timeout: optional number of seconds after which the case is killed
+    :return: the completed record
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_run_case, args=(sender, dict(record), config))
+    process.start()
+    sender.close()
+
+    if receiver.poll(timeout):
+        record = receiver.recv()
+    else:
+        process.terminate()
+        record = dict(record, error='timed out after %ss' % timeout)
+
+    process.join()
+
+    return record
+
+
+def run_benchmarks(sizes, graph_sizes, densities, graphs, config, pattern=None, timeout=None, log=sys.stderr):
+    """
+    Runs every kernel builder and model class on every synthetic graph.
+
+    :param sizes: list of integers, number of nodes for kernel builders and node models
+    :param graph_sizes: list of integers, maximum number of nodes per graph for graph models
+    :param densities: list of floats, edge densities
+    :param graphs: list of keys of graph_generator_map
+    :param config: dict with num_hops, diffusion_threshold, batch_size, num_features, num_classes,
+                   num_graphs, seed and parameters (overrides of DEFAULT_PARAMETERS)
+    :param pattern: optional regular expression; only cases whose name matches are run
+    :param timeout: optional number of seconds per case
+    :return: list of result records
+    """
+    node_models = model_classes('NodeClassificationDCNN')
+    graph_models = model_classes('GraphClassificationDCNN')
+    cases = (
+        [('kernel', name, num_nodes) for num_nodes in sizes for name in kernel_builders()] +
+        [('node_model', name, num_nodes) for num_nodes in sizes for name in node_models] +
+        [('graph_model', name, num_nodes) for num_nodes in graph_sizes for name in graph_models]
+    )
+
+    results = []
+    for graph in graphs:
+        for density in densities:
+            for kind, name, num_nodes in cases:
+                if pattern is not None and not re.search(pattern, name):
+                    continue
+
+                record = run_case(
+                    dict(kind=kind, name=name, graph=graph, num_nodes=num_nodes, density=density),
+                    config,
+                    timeout=timeout,
+                )
+                results.append(record)
+
+                log.write('%-12s %-46s %-12s N=%-7d %s\n' % (
+                    kind, name, graph, num_nodes,
+                    record.get('error') or ' '.join(
+                        '%s=%.3f' % (key, record[key]) for key in sorted(record) if key.endswith('_s')
+                    )
+                ))
+
+    return results
+
+
+def _environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'scipy': __import__('scipy').__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark diffusion kernel builders and DCNN models.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 2000])
+    parser.add_argument('--graph-sizes', type=int, nargs='+', default=[20, 50])
+    parser.add_argument('--density', type=float, nargs='+', default=[0.005])
+    parser.add_argument('--graphs', nargs='+', default=sorted(graph_generator_map), choices=sorted(graph_generator_map))
+    parser.add_argument('--num-hops', type=int, default=2)
+    parser.add_argument('--threshold', type=float, default=0.1)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--num-features', type=int, default=16)
+    parser.add_argument('--num-classes', type=int, default=4)
+    parser.add_argument('--num-graphs', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a model hyperparameter, e.g. kernel_backend=csr')
+    parser.add_argument('--only', help='regular expression selecting the builders and models to run')
+    parser.add_argument('--timeout', type=float, help='seconds allowed per case')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args(argv)
+
+    parameters = dict(
+        num_hops=args.num_hops,
+        diffusion_threshold=args.threshold,
+        batch_size=args.batch_size,
+    )
+    for override in args.param:
+        name, value = override.split('=', 1)
+        try:
+            parameters[name] = json.loads(value)
+        except ValueError:
+            parameters[name] = value
+
+    config = dict(
+        num_hops=parameters['num_hops'],
+        diffusion_threshold=parameters['diffusion_threshold'],
+        batch_size=parameters['batch_size'],
+        num_features=args.num_features,
+        num_classes=args.num_classes,
+        num_graphs=args.num_graphs,
+        seed=args.seed,
+        parameters=parameters,
+    )
+
+    results = run_benchmarks(
+        args.sizes, args.graph_sizes, args.density, args.graphs, config, pattern=args.only, timeout=args.timeout
+    )
+
+    with open(args.output, 'w') as f:
+        json.dump({'environment': _environment(), 'config': config, 'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
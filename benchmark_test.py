@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+
+import benchmark
+
+
+class TestGraphGenerators(unittest.TestCase):
+    def setUp(self):
+        self.num_nodes = 300
+        self.density = 0.05
+
+    def check_graph(self, A):
+        self.assertEqual(A.shape, (self.num_nodes, self.num_nodes))
+        self.assertEqual(abs(A - A.T).nnz, 0)
+        self.assertTrue((A.diagonal() == 0).all())
+        self.assertTrue((A.data == 1.0).all())
+
+        # Duplicate samples only ever remove edges.
+        density = A.nnz / float(self.num_nodes * (self.num_nodes - 1))
+        self.assertTrue(0.5 * self.density < density <= self.density)
+
+    def test_generators(self):
+        for name, generator in sorted(benchmark.graph_generator_map.items()):
+            self.check_graph(generator(self.num_nodes, self.density, seed=0))
+
+    def test_seed(self):
+        A = benchmark.power_law_graph(self.num_nodes, self.density, seed=1)
+        B = benchmark.power_law_graph(self.num_nodes, self.density, seed=1)
+        self.assertEqual(abs(A - B).nnz, 0)
+
+    def test_community_mixing(self):
+        A, communities = benchmark.community_graph(self.num_nodes, self.density, mixing=0.1, seed=0)
+        rows, cols = A.nonzero()
+
+        self.assertTrue(np.mean(communities[rows] == communities[cols]) > 0.85)
+
+
+class TestGraphModelCases(unittest.TestCase):
+    def test_every_graph_model_runs(self):
+        config = dict(num_graphs=6, num_features=4, num_classes=2, seed=0, parameters={})
+        names = benchmark.model_classes('GraphClassificationDCNN')
+        self.assertTrue('DeepGraphClassificationDCNNWithOfflineKronReduction' in names)
+
+        for name in names:
+            record = benchmark.run_case(
+                dict(kind='graph_model', name=name, graph='erdos_renyi', num_nodes=10, density=0.3), config
+            )
+            self.assertEqual(record.get('error'), None, name)
+            self.assertTrue(record['preprocess_s'] >= 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import collections
+import json
+import resource
+import sys
+import time
+
+
+def peak_rss_kb():
+    """Returns the peak resident set size of this process in kilobytes."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on OS X.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+class Callback(object):
+    """
+    Base class for hooks into model.fit.
+
+    Records are plain dicts.  Batch records hold epoch, batch, num_samples, loss, gather_s and
+    step_s.  Epoch records hold epoch, num_samples, train_loss, valid_loss, samples_per_s,
+    peak_rss_kb and the seconds spent on each part of the epoch (epoch_s, gather_s, step_s,
+    validation_s, accuracy_s), plus train_accuracy / valid_accuracy when those are computed.
+    """
+    def on_epoch_start(self, model, epoch):
+        pass
+
+    def on_batch_end(self, model, record):
+        pass
+
+    def on_epoch_end(self, model, record):
+        pass
+
+
+class MetricsHistory(Callback):
+    """Keeps every batch and epoch record in memory."""
+    def __init__(self):
+        self.batches = []
+        self.epochs = []
+
+    def on_batch_end(self, model, record):
+        self.batches.append(record)
+
+    def on_epoch_end(self, model, record):
+        self.epochs.append(record)
+
+
+class JSONLinesLogger(Callback):
+    """
+    Writes records as JSON lines, each tagged with event 'batch' or 'epoch'.
+
+    :param f: file object to write to
+    :param batches: whether to write batch records as well as epoch records
+    """
+    def __init__(self, f, batches=False):
+        self.f = f
+        self.batches = batches
+
+    def _write(self, event, record):
+        self.f.write(json.dumps(dict(record, event=event), sort_keys=True) + '\n')
+        self.f.flush()
+
+    def on_batch_end(self, model, record):
+        if self.batches:
+            self._write('batch', record)
+
+    def on_epoch_end(self, model, record):
+        self._write('epoch', record)
+
+
+class EpochTimers(object):
+    """
+    Splits the wall time of an epoch into named parts.
+
+    lap(name) adds the time since the previous lap to name; lap() just starts a new lap.
+    """
+    def __init__(self):
+        self.start = self._last = time.time()
+        self.totals = collections.defaultdict(float)
+        for name in ('gather', 'step', 'validation', 'accuracy'):
+            self.totals[name] = 0.0
+
+    def lap(self, name=None):
+        now = time.time()
+        elapsed = now - self._last
+        self._last = now
+
+        if name is not None:
+            self.totals[name] += elapsed
+
+        return elapsed
+
+    def record(self, **kwargs):
+        """Returns an epoch record with the accumulated timings."""
+        record = dict(('%s_s' % name, total) for name, total in self.totals.items())
+        record.update(kwargs)
+
+        train_s = self.totals['gather'] + self.totals['step']
+        record['samples_per_s'] = record.get('num_samples', 0) / train_s if train_s > 0 else 0.0
+        record['epoch_s'] = time.time() - self.start
+        record['peak_rss_kb'] = peak_rss_kb()
+
+        return record
@@ -0,0 +1,35 @@
+import json
+import StringIO
+import unittest
+
+import callbacks
+
+
+class TestCallbacks(unittest.TestCase):
+    def test_epoch_timers(self):
+        timers = callbacks.EpochTimers()
+        timers.lap('gather')
+        timers.lap('step')
+        timers.lap()
+
+        record = timers.record(epoch=3, num_samples=10)
+
+        for key in ('gather_s', 'step_s', 'validation_s', 'accuracy_s', 'epoch_s', 'samples_per_s', 'peak_rss_kb'):
+            self.assertIn(key, record)
+        self.assertEqual(record['epoch'], 3)
+        self.assertTrue(record['epoch_s'] >= record['gather_s'] + record['step_s'])
+
+    def test_json_lines_logger(self):
+        f = StringIO.StringIO()
+        logger = callbacks.JSONLinesLogger(f)
+
+        logger.on_batch_end(None, {'batch': 0})
+        logger.on_epoch_end(None, {'epoch': 0, 'train_loss': 1.5})
+
+        lines = f.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0]), {'event': 'epoch', 'epoch': 0, 'train_loss': 1.5})
+
+
+if __name__ == '__main__':
+    unittest.main()
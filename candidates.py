@@ -0,0 +1,281 @@
+"""
+Candidate generation: the top-k items of every user by inner product of representations.
+
+Users and items are rows of representation matrices, e.g. NodeClassificationDCNN.representations
+of user and item nodes.  The result feeds rerank.rerank:
+
+    indices, scores = candidates.exact_top_k(users, items, 500)
+    lists = rerank.rerank(scores, items, 10, candidates=indices)
+
+exact_top_k scores one (users, items) block at a time and keeps a running top-k, so memory is
+bounded by the block sizes rather than users x items.  IVFIndex clusters the items with k-means
+and only scores the items in the clusters closest to each user.
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+
+DEFAULT_USER_CHUNK_SIZE = 1024
+DEFAULT_ITEM_CHUNK_SIZE = 16384
+
+
+def _merge_top_k(best_scores, best_indices, scores, indices, k):
+    """Merges a block of scores into the running top-k of each row (unsorted)."""
+    scores = np.concatenate([best_scores, scores], 1)
+    indices = np.concatenate([best_indices, indices], 1)
+
+    if scores.shape[1] > k:
+        keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, keep, 1)
+        indices = np.take_along_axis(indices, keep, 1)
+
+    return scores, indices
+
+
+def _sort_top_k(scores, indices):
+    order = np.argsort(-scores, 1, kind='mergesort')
+    return np.take_along_axis(indices, order, 1), np.take_along_axis(scores, order, 1)
+
+
+def _empty_top_k(num_users, dtype):
+    return np.zeros((num_users, 0), dtype=dtype), np.zeros((num_users, 0), dtype='int64')
+
+
+def exact_top_k(users, items, k, user_chunk_size=DEFAULT_USER_CHUNK_SIZE, item_chunk_size=DEFAULT_ITEM_CHUNK_SIZE):
+    """
+    Finds the k items with the largest inner product for every user.
+
+    :param users: 2d numpy array (users, dimensions)
+    :param items: 2d numpy array (items, dimensions)
+    :param k: integer, number of candidates per user; at most the number of items
+    :param user_chunk_size: integer, users scored at a time
+    :param item_chunk_size: integer, items scored at a time
+    :return: (users, k) int64 item indices and their scores, best first
+    """
+    if k > items.shape[0]:
+        raise ValueError('cannot select %d of %d items' % (k, items.shape[0]))
+
+    dtype = np.result_type(users.dtype, items.dtype)
+    indices = np.zeros((users.shape[0], k), dtype='int64')
+    scores = np.zeros((users.shape[0], k), dtype=dtype)
+
+    for start in range(0, users.shape[0], user_chunk_size):
+        block = users[start:start + user_chunk_size]
+        best_scores, best_indices = _empty_top_k(block.shape[0], dtype)
+
+        for item_start in range(0, items.shape[0], item_chunk_size):
+            chunk = items[item_start:item_start + item_chunk_size]
+            chunk_indices = np.broadcast_to(
+                np.arange(item_start, item_start + chunk.shape[0]), (block.shape[0], chunk.shape[0])
+            )
+            best_scores, best_indices = _merge_top_k(
+                best_scores, best_indices, np.dot(block, chunk.T), chunk_indices, k
+            )
+
+        indices[start:start + block.shape[0]], scores[start:start + block.shape[0]] = _sort_top_k(
+            best_scores, best_indices
+        )
+
+    return indices, scores
+
+
+def kmeans(X, num_clusters, num_iterations=10, chunk_size=DEFAULT_ITEM_CHUNK_SIZE, seed=0):
+    """
+    Lloyd's k-means, assigning chunk_size points at a time.
+
+    :param X: 2d numpy array (points, dimensions)
+    :param num_clusters: integer, at most the number of points
+    :param num_iterations: integer, number of assignment and update rounds
+    :return: (clusters, dimensions) centroids and the cluster of every point
+    """
+    rng = np.random.RandomState(seed)
+    centroids = X[rng.choice(X.shape[0], num_clusters, replace=False)].astype('float64')
+    assignment = np.zeros(X.shape[0], dtype='int64')
+
+    for _ in range(num_iterations):
+        half_norms = 0.5 * (centroids ** 2).sum(1)
+        for start in range(0, X.shape[0], chunk_size):
+            # argmin |x - c|^2 = argmax x.c - |c|^2 / 2
+            assignment[start:start + chunk_size] = (np.dot(X[start:start + chunk_size], centroids.T) - half_norms).argmax(1)
+
+        counts = np.bincount(assignment, minlength=num_clusters)
+        membership = sp.csr_matrix(
+            (np.ones(X.shape[0]), (assignment, np.arange(X.shape[0]))), shape=(num_clusters, X.shape[0])
+        )
+        sums = np.asarray(membership.dot(X), dtype='float64')
+
+        # Empty clusters keep their centroid.
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+    return centroids, assignment
+
+
+class IVFIndex(object):
+    """
+    An inverted file index for approximate maximum inner product search.
+
+    Items are clustered with k-means and stored grouped by cluster, so the items of cluster c
+    are items[order[offsets[c]:offsets[c + 1]]].  A search scores every user against the
+    centroids and then only the items of its num_probes best clusters.
+
+    :param items: 2d numpy array (items, dimensions)
+    :param num_lists: integer, number of clusters; around sqrt(items) is a common choice
+    :param num_iterations: integer, k-means rounds
+    """
+    def __init__(self, items, num_lists, num_iterations=10, seed=0):
+        self.items = items
+        self.centroids, assignment = kmeans(items, num_lists, num_iterations, seed=seed)
+
+        self.order = np.argsort(assignment, kind='mergesort')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=num_lists))])
+
+        # Items stored contiguously by cluster, so each cluster is scored with one matmul.
+        self.packed_items = items[self.order]
+
+    @property
+    def num_lists(self):
+        return self.centroids.shape[0]
+
+    def search(self, users, k, num_probes=1, user_chunk_size=DEFAULT_USER_CHUNK_SIZE):
+        """
+        Finds approximately the k items with the largest inner product for every user.
+
+        Users whose probed clusters hold fewer than k items get index -1 and score -inf in the
+        remaining positions; rerank.rerank never selects those.
+
+        :param users: 2d numpy array (users, dimensions)
+        :param k: integer, number of candidates per user
+        :param num_probes: integer, number of clusters searched per user
+        :return: (users, k) int64 item indices and their scores, best first
+        """
+        num_probes = min(num_probes, self.num_lists)
+        dtype = np.result_type(users.dtype, self.items.dtype)
+
+        indices = np.zeros((users.shape[0], k), dtype='int64')
+        scores = np.zeros((users.shape[0], k), dtype=dtype)
+
+        for start in range(0, users.shape[0], user_chunk_size):
+            block = users[start:start + user_chunk_size]
+            n = block.shape[0]
+
+            centroid_scores = np.dot(block, self.centroids.T)
+            if num_probes < self.num_lists:
+                probes = np.argpartition(-centroid_scores, num_probes - 1, axis=1)[:, :num_probes]
+            else:
+                probes = np.broadcast_to(np.arange(self.num_lists), (n, self.num_lists))
+
+            # Pad every row with k placeholders, so rows with few probed items still have k entries.
+            best_scores = np.full((n, k), -np.inf, dtype=dtype)
+            best_indices = np.full((n, k), -1, dtype='int64')
+
+            # Loop over clusters, scoring all the users that probe each one together.
+            probed = np.zeros((n, self.num_lists), dtype=bool)
+            probed[np.arange(n)[:, None], probes] = True
+
+            for cluster in np.flatnonzero(probed.any(0)):
+                start_item, end_item = self.offsets[cluster], self.offsets[cluster + 1]
+                if start_item == end_item:
+                    continue
+
+                rows = np.flatnonzero(probed[:, cluster])
+                cluster_scores = np.dot(block[rows], self.packed_items[start_item:end_item].T)
+                cluster_indices = np.broadcast_to(self.order[start_item:end_item], cluster_scores.shape)
+
+                best_scores[rows], best_indices[rows] = _merge_top_k(
+                    best_scores[rows], best_indices[rows], cluster_scores, cluster_indices, k
+                )
+
+            indices[start:start + n], scores[start:start + n] = _sort_top_k(best_scores, best_indices)
+
+        return indices, scores
+
+
+def recall(approximate, exact):
+    """
+    :param approximate: 2d integer array (users, k) of retrieved items
+    :param exact: 2d integer array (users, k) of the true top-k items
+    :return: float, mean fraction of the true top-k that was retrieved
+    """
+    k = exact.shape[1]
+    hits = [len(np.intersect1d(a, e)) for a, e in zip(approximate, exact)]
+
+    return float(np.mean(hits)) / k
+
+
+def report(users, items, k, num_lists, probes=(1, 2, 4, 8, 16), num_eval_users=1000, seed=0, log=sys.stderr):
+    """
+    Measures recall against latency for the exact search and an IVFIndex over items.
+
+    Recall is computed on a random sample of num_eval_users users; throughput on all of them.
+
+    :return: list of records with mode, num_probes, recall, seconds and users_per_s
+    """
+    rng = np.random.RandomState(seed)
+    sample = rng.choice(users.shape[0], min(num_eval_users, users.shape[0]), replace=False)
+
+    records = []
+
+    def add(mode, num_probes, found, seconds, **extra):
+        record = dict(
+            mode=mode, num_probes=num_probes, k=k, seconds=seconds, users_per_s=users.shape[0] / seconds,
+            recall=recall(found[sample], exact[sample]), **extra
+        )
+        records.append(record)
+        log.write('%-5s probes=%-4s recall@%d=%.4f users_per_s=%.0f\n' % (
+            mode, num_probes, k, record['recall'], record['users_per_s']
+        ))
+
+    start = time.time()
+    exact, _ = exact_top_k(users, items, k)
+    add('exact', None, exact, time.time() - start)
+
+    start = time.time()
+    index = IVFIndex(items, num_lists, seed=seed)
+    build_seconds = time.time() - start
+
+    for num_probes in probes:
+        if num_probes > num_lists:
+            continue
+
+        start = time.time()
+        found, _ = index.search(users, k, num_probes)
+        add('ivf', num_probes, found, time.time() - start, num_lists=num_lists, build_seconds=build_seconds)
+
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report recall against latency of candidate generation.')
+    parser.add_argument('--num-users', type=int, default=20000)
+    parser.add_argument('--num-items', type=int, default=100000)
+    parser.add_argument('--num-dimensions', type=int, default=64)
+    parser.add_argument('--num-clusters', type=int, default=16, help='number of clusters in the synthetic data')
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--num-lists', type=int, default=256)
+    parser.add_argument('--probes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='candidates_report.json')
+    args = parser.parse_args(argv)
+
+    # Clustered synthetic representations, as learned representations tend to be.
+    rng = np.random.RandomState(args.seed)
+    centers = rng.randn(args.num_clusters, args.num_dimensions)
+    items = (centers[rng.randint(args.num_clusters, size=args.num_items)] +
+             0.5 * rng.randn(args.num_items, args.num_dimensions)).astype('float32')
+    users = (centers[rng.randint(args.num_clusters, size=args.num_users)] +
+             0.5 * rng.randn(args.num_users, args.num_dimensions)).astype('float32')
+
+    results = report(users, items, args.k, args.num_lists, args.probes, seed=args.seed)
+
+    with open(args.output, 'w') as f:
+        json.dump({'config': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import unittest
+
+import numpy as np
+
+import candidates
+
+
+class TestCandidates(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+
+        self.users = rng.randn(300, 8)
+        self.items = rng.randn(1000, 8)
+
+        scores = np.dot(self.users, self.items.T)
+        self.expected = np.argsort(-scores, 1)[:, :20]
+        self.expected_scores = -np.sort(-scores, 1)[:, :20]
+
+    def test_exact_top_k(self):
+        indices, scores = candidates.exact_top_k(self.users, self.items, 20, user_chunk_size=64, item_chunk_size=77)
+
+        self.assertTrue((indices == self.expected).all())
+        self.assertTrue(np.allclose(scores, self.expected_scores))
+
+    def test_ivf_all_probes(self):
+        index = candidates.IVFIndex(self.items, 30)
+        indices, _ = index.search(self.users, 20, num_probes=30, user_chunk_size=64)
+
+        self.assertTrue((indices == self.expected).all())
+        self.assertEqual(sorted(index.order), list(range(1000)))
+
+    def test_ivf_recall(self):
+        index = candidates.IVFIndex(self.items, 30)
+
+        recalls = [candidates.recall(index.search(self.users, 20, num_probes)[0], self.expected) for num_probes in [1, 4, 16]]
+        self.assertTrue(recalls[0] < recalls[1] < recalls[2] <= 1.0)
+
+    def test_ivf_padding(self):
+        index = candidates.IVFIndex(self.items, 30)
+        indices, scores = index.search(self.users, 200, num_probes=1)
+
+        self.assertTrue(((indices == -1) == np.isinf(scores)).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
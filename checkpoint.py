@@ -0,0 +1,76 @@
+"""
+Checkpoints of training runs as single .npz files.
+
+A checkpoint holds named arrays: the model's shared variables (parameters followed by the
+optimizer state of update_fn / apply_momentum), the NumPy RNG state and the training loop
+state.  Files are written next to their destination, synced and renamed into place, so an
+interrupted write or a crash never replaces a good checkpoint with a partial one.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+
+def write(path, arrays):
+    """
+    Atomically writes arrays to path as an uncompressed .npz.
+
+    :param path: string, destination file
+    :param arrays: dict of name -> numpy array
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+            # The data must be on disk before the rename makes it the checkpoint.
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    # Persist the rename itself.
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def read(path):
+    """
+    :param path: string, checkpoint file
+    :return: dict of name -> numpy array
+    """
+    with np.load(path) as f:
+        return dict((name, f[name]) for name in f.files)
+
+
+def rng_state_arrays(prefix='rng_'):
+    """Returns the state of the global NumPy RNG as arrays."""
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+
+    return {
+        prefix + 'name': np.asarray(name),
+        prefix + 'keys': keys,
+        prefix + 'position': np.asarray(position),
+        prefix + 'has_gauss': np.asarray(has_gauss),
+        prefix + 'cached_gaussian': np.asarray(cached_gaussian),
+    }
+
+
+def set_rng_state(arrays, prefix='rng_'):
+    """Restores the global NumPy RNG from arrays written by rng_state_arrays."""
+    np.random.set_state((
+        str(arrays[prefix + 'name']),
+        arrays[prefix + 'keys'],
+        int(arrays[prefix + 'position']),
+        int(arrays[prefix + 'has_gauss']),
+        float(arrays[prefix + 'cached_gaussian']),
+    ))
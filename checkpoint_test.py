@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import checkpoint
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'run', 'checkpoint.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_read(self):
+        checkpoint.write(self.path, {'W': np.eye(3), 'epoch': np.asarray(4)})
+        checkpoint.write(self.path, {'W': np.ones(2), 'epoch': np.asarray(5)})
+
+        arrays = checkpoint.read(self.path)
+        self.assertEqual(sorted(arrays), ['W', 'epoch'])
+        self.assertTrue((arrays['W'] == 1.0).all())
+        self.assertEqual(int(arrays['epoch']), 5)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['checkpoint.npz'])
+
+    def test_rng_state(self):
+        np.random.seed(3)
+        np.random.randn()
+        checkpoint.write(self.path, checkpoint.rng_state_arrays())
+        expected = np.random.randn(5)
+
+        np.random.seed(0)
+        checkpoint.set_rng_state(checkpoint.read(self.path))
+        self.assertTrue((np.random.randn(5) == expected).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
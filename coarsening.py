@@ -0,0 +1,148 @@
+"""
+Offline Kron reduction hierarchies for graph classification DCNNs.
+
+The reduction used by DeepGraphClassificationDCNNWithKronReduction does not depend on learned
+parameters, so it can be computed once per graph instead of in every training step.  Each level
+splits the nodes by the sign of the eigenvector of the largest eigenvalue of the Laplacian
+L = D - A (for regular graphs, the eigenvector of the smallest eigenvalue of A) and eliminates
+the negative side from the Laplacian:
+
+    L' = L[k, k] - L[k, r] pinv(L[r, r]) L[r, k]
+    X' = X[k] - L[k, r] pinv(L[r, r]) X[r] = Q X
+
+Reducing the Laplacian rather than A keeps the reduced edge weights non-negative, so degree
+normalization stays well defined at every level.  A level is stored as the reduced adjacency
+A' = -offdiag(L') and the sparse projection Q.
+"""
+import multiprocessing
+
+import numpy as np
+import scipy.linalg
+import scipy.sparse as sp
+import scipy.sparse.linalg
+
+
+# Graphs up to this many nodes are split with a dense eigensolver; larger ones use Lanczos.
+DENSE_EIGENSOLVER_SIZE = 64
+
+
+class GraphHierarchy(object):
+    """
+    The Kron reduction levels of one graph.
+
+    :param A_levels: list of num_levels + 1 dense adjacency matrices, the input graph first
+    :param Q_levels: list of num_levels CSR projections; Q_levels[l] maps the node features of
+                     level l onto the nodes of level l + 1
+    """
+    def __init__(self, A_levels, Q_levels):
+        self.A_levels = A_levels
+        self.Q_levels = Q_levels
+
+
+def largest_eigenvector(L):
+    """
+    Computes the eigenvector of the largest eigenvalue of a symmetric matrix.
+
+    The sign is chosen so that at least half of the entries are non-negative.
+
+    :param L: 2d numpy array, symmetric
+    :return: 1d numpy array
+    """
+    n = L.shape[0]
+
+    if n <= DENSE_EIGENSOLVER_SIZE:
+        _, vectors = scipy.linalg.eigh(L, eigvals=(n - 1, n - 1))
+    else:
+        _, vectors = scipy.sparse.linalg.eigsh(sp.csr_matrix(L), k=1, which='LA')
+    v = vectors[:, 0]
+
+    if 2 * (v >= 0).sum() < n:
+        v = -v
+
+    return v
+
+
+def kron_reduction(A):
+    """
+    Computes one level of Kron reduction.
+
+    :param A: 2d numpy array, symmetric adjacency matrix
+    :return: the reduced adjacency matrix and the CSR projection of node features onto its nodes
+    """
+    A = np.asarray(A, dtype='float64')
+    L = np.diag(A.sum(0)) - A
+
+    v = largest_eigenvector(L)
+    keep = np.flatnonzero(v >= 0)
+    reduced = np.flatnonzero(v < 0)
+
+    if not len(reduced):
+        return A, sp.identity(A.shape[0], format='csr')
+
+    b = L[np.ix_(keep, reduced)]
+    elimination = b.dot(np.linalg.pinv(L[np.ix_(reduced, reduced)]))
+
+    reduced_L = L[np.ix_(keep, keep)] - elimination.dot(b.T)
+
+    # Off-diagonal entries of a Kron-reduced Laplacian are non-positive up to rounding.
+    reduced_A = np.maximum(-reduced_L, 0.0)
+    np.fill_diagonal(reduced_A, 0.0)
+
+    Q = np.zeros((len(keep), A.shape[0]))
+    Q[np.arange(len(keep)), keep] = 1.0
+    Q[:, reduced] = -elimination
+
+    return reduced_A, sp.csr_matrix(Q)
+
+
+def coarsen(A, num_levels, dtype='float32'):
+    """
+    Computes the Kron reduction hierarchy of a graph.
+
+    :param A: 2d numpy array or scipy.sparse matrix, symmetric adjacency matrix
+    :param num_levels: integer, number of reductions
+    :param dtype: storage type of the operators
+    :return: GraphHierarchy
+    """
+    A = A.toarray() if sp.issparse(A) else np.asarray(A, dtype='float64')
+
+    A_levels = [A.astype(dtype)]
+    Q_levels = []
+    for _ in range(num_levels):
+        A, Q = kron_reduction(A)
+        A_levels.append(A.astype(dtype))
+        Q_levels.append(Q.astype(dtype))
+
+    return GraphHierarchy(A_levels, Q_levels)
+
+
+def _coarsen_job(job):
+    A, num_levels, dtype = job
+    return coarsen(A, num_levels, dtype)
+
+
+def precompute_hierarchies(A, num_levels, dtype='float32', num_workers=None, chunk_size=16):
+    """
+    Computes the hierarchy of every graph, across a process pool.
+
+    :param A: list of 2d numpy arrays, adjacency matrix of each graph
+    :param num_levels: integer, number of reductions
+    :param dtype: storage type of the operators
+    :param num_workers: number of worker processes; None uses one per CPU, 1 computes in-process
+    :param chunk_size: number of graphs sent to a worker at a time
+    :return: list of GraphHierarchy
+    """
+    jobs = [(a, num_levels, dtype) for a in A]
+
+    if num_workers == 1:
+        return [_coarsen_job(job) for job in jobs]
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        hierarchies = pool.map(_coarsen_job, jobs, chunk_size)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return hierarchies
@@ -0,0 +1,48 @@
+import unittest
+
+import numpy as np
+import scipy.linalg
+
+import coarsening
+
+
+class TestCoarsening(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+
+        A = np.triu((rng.rand(80, 80) < 0.1).astype('float64'), 1)
+        self.A = A + A.T
+
+    def test_path_graph(self):
+        # Eliminating the middle of a path joins its ends with an edge in series.
+        A = np.asarray([[0.0, 1.0, 0.0], [1.0, 0.0, 1.0], [0.0, 1.0, 0.0]])
+        reduced_A, Q = coarsening.kron_reduction(A)
+
+        self.assertTrue(np.allclose(reduced_A, [[0.0, 0.5], [0.5, 0.0]]))
+        self.assertTrue(np.allclose(Q.toarray(), [[1.0, 0.5, 0.0], [0.0, 0.5, 1.0]]))
+
+    def test_lanczos_split(self):
+        L = np.diag(self.A.sum(0)) - self.A
+        v = coarsening.largest_eigenvector(L)
+
+        _, vectors = scipy.linalg.eigh(L)
+        expected = vectors[:, -1] if 2 * (vectors[:, -1] >= 0).sum() >= 80 else -vectors[:, -1]
+        self.assertTrue(np.allclose(v, expected, atol=1e-6))
+
+    def test_hierarchy(self):
+        hierarchies = coarsening.precompute_hierarchies([self.A, self.A[:20, :20]], 2, num_workers=2)
+
+        for h, n in zip(hierarchies, [80, 20]):
+            self.assertEqual(len(h.A_levels), 3)
+            self.assertEqual(h.A_levels[0].shape, (n, n))
+
+            for level, Q in enumerate(h.Q_levels):
+                A = h.A_levels[level + 1]
+                self.assertEqual(Q.shape, (A.shape[0], h.A_levels[level].shape[0]))
+                self.assertTrue(A.shape[0] < h.A_levels[level].shape[0])
+                self.assertTrue((A >= 0).all())
+                self.assertTrue(np.allclose(A, A.T, atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
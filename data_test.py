@@ -1,10 +1,13 @@
 import unittest
 
 import data
+import loader
 
 class TestCora(unittest.TestCase):
-    def setUp(self):
-        self.A, self.X, self.Y = data.parse_cora()
+    @classmethod
+    def setUpClass(cls):
+        # Parse once per class instead of once per test.
+        cls.A, cls.X, cls.Y = data.parse_cora()
 
     def test_A_symmetry(self):
         self.assertTrue( (self.A == self.A.T).all() )
@@ -28,10 +31,13 @@ class TestCora(unittest.TestCase):
 
 
 class TestSparseCora(TestCora):
-    def setUp(self):
-        self.A, self.X, self.Y = data.parse_cora_sparse()
+    @classmethod
+    def setUpClass(cls):
+        cls.A, cls.X, cls.Y = data.parse_cora_sparse()
 
     def test_A_symmetry(self):
-        # Not sure how to do this
-        self.assertTrue(False)
+        self.assertTrue(loader.is_symmetric(self.A))
+
+    def test_no_self_loops(self):
+        self.assertFalse(loader.has_self_loops(self.A))
 
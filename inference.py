@@ -0,0 +1,173 @@
+"""
+Theano-free inference for node classification DCNNs saved with NodeClassificationDCNN.export.
+
+Only NumPy and SciPy are imported, so loading a model takes a fraction of a second:
+
+    model = inference.load('model.npz')
+    model.set_graph(A, X)
+    predictions = model.predict(indices)
+"""
+import json
+
+import numpy as np
+
+import util
+
+
+EXPORT_FORMAT_VERSION = 1
+
+
+def _softmax(Z):
+    E = np.exp(Z - Z.max(1, keepdims=True))
+    return E / E.sum(1, keepdims=True)
+
+
+nonlinearity_map = {
+    'tanh': np.tanh,
+    'sigmoid': lambda Z: 1.0 / (1.0 + np.exp(-Z)),
+    'rectify': lambda Z: np.maximum(Z, 0.0),
+    'linear': lambda Z: Z,
+    'softmax': _softmax,
+}
+
+diffusion_features_map = {
+    'full': lambda A, X, k, threshold: util.A_to_diffusion_features(A, X, k),
+    'post_sparse': util.A_to_post_sparse_diffusion_features,
+    'pre_sparse': util.A_to_pre_sparse_diffusion_features,
+    'post_sparse_push': util.A_to_post_sparse_push_diffusion_features,
+    'pre_sparse_push': util.A_to_pre_sparse_push_diffusion_features,
+}
+
+
+class InferenceModel(object):
+    """
+    A vectorized NumPy forward pass over an exported layer topology.
+
+    The topology is a list of layers, each a dict with an 'op' and the position of its input:
+
+    'features'  the node features X
+    'indices'   the requested node indices
+    'dcnn'      f(K Z * W), with K Z computed by sparse propagation of Z over the graph; when
+                'rows' is set only the rows of the requested nodes are kept
+    'reshape'   reshape to 'shape'
+    'take'      rows of its input given by its 'indices' input
+    'dense'     f(Z W + b), with Z flattened to two dimensions
+
+    Everything that does not depend on the requested nodes is computed once by set_graph.
+    """
+    def __init__(self, topology, arrays):
+        if topology.get('format') != EXPORT_FORMAT_VERSION:
+            raise ValueError('unsupported export format %r' % topology.get('format'))
+
+        self.topology = topology
+        self.layers = topology['layers']
+        self.arrays = arrays
+
+        # A layer is static if its output is the same for every request.
+        self._static = []
+        for layer in self.layers:
+            if layer['op'] == 'indices':
+                self._static.append(False)
+            elif layer['op'] == 'features':
+                self._static.append(True)
+            elif layer['op'] == 'dcnn' and layer['rows']:
+                self._static.append(False)
+            else:
+                self._static.append(all(self._static[i] for i in self._inputs(layer)))
+
+            if layer['op'] == 'dcnn' and not self._static[layer['input']]:
+                raise ValueError('dcnn layers must diffuse node-independent inputs')
+
+        self._values = None
+        self._diffused = None
+
+    def _inputs(self, layer):
+        return [layer[key] for key in ('input', 'indices') if key in layer]
+
+    def _diffuse(self, Z):
+        # Push kernels also prune to the top_k largest entries per row.
+        kwargs = {'top_k': self.topology['top_k']} if 'top_k' in self.topology else {}
+
+        return diffusion_features_map[self.topology['diffusion']](
+            self.A, Z, self.topology['num_hops'], self.topology.get('threshold'), **kwargs
+        )
+
+    def _forward(self, i, values, indices=None):
+        layer = self.layers[i]
+        op = layer['op']
+        nonlinearity = nonlinearity_map[layer['nonlinearity']] if 'nonlinearity' in layer else None
+
+        if op == 'features':
+            return self.X
+        if op == 'indices':
+            return indices
+        if op == 'dcnn':
+            KZ = self._diffused[i]
+            if layer['rows']:
+                KZ = KZ[indices]
+            return nonlinearity(KZ * self.arrays[layer['W']])
+        if op == 'reshape':
+            return values[layer['input']].reshape(layer['shape'])
+        if op == 'take':
+            return values[layer['input']][values[layer['indices']]]
+        if op == 'dense':
+            Z = values[layer['input']]
+            Z = np.dot(Z.reshape(Z.shape[0], -1), self.arrays[layer['W']])
+            if 'b' in layer:
+                Z += self.arrays[layer['b']]
+            return nonlinearity(Z)
+
+        raise ValueError('unknown op %r' % op)
+
+    def set_graph(self, A, X):
+        """
+        Sets the graph to predict on and precomputes the node-independent part of the model.
+
+        :param A: 2d numpy array or scipy.sparse matrix, adjacency matrix
+        :param X: 2d numpy array of node features
+        """
+        self.A = A
+        self.X = np.asarray(X, dtype='float32')
+
+        self._values = {}
+        self._diffused = {}
+        for i, layer in enumerate(self.layers):
+            if layer['op'] == 'dcnn':
+                self._diffused[i] = self._diffuse(self._values[layer['input']])
+            if self._static[i]:
+                self._values[i] = self._forward(i, self._values)
+
+    def predict_proba(self, indices):
+        """
+        :param indices: 1d array of node indices
+        :return: 2d numpy array of class probabilities, one row per node
+        """
+        if self._values is None:
+            raise ValueError('set_graph must be called before predicting')
+
+        indices = np.asarray(indices)
+
+        values = dict(self._values)
+        for i in range(len(self.layers)):
+            if i not in values:
+                values[i] = self._forward(i, values, indices)
+
+        return values[len(self.layers) - 1]
+
+    def predict(self, indices):
+        return self.predict_proba(indices).argmax(1)
+
+
+def load(path):
+    """
+    Loads a model written by NodeClassificationDCNN.export.
+
+    :param path: path to the .npz file
+    :return: InferenceModel
+    """
+    with np.load(path) as f:
+        arrays = dict((name, f[name]) for name in f.files)
+
+    topology = json.loads(str(arrays.pop('topology')))
+
+    return InferenceModel(topology, arrays)
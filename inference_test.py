@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import inference
+import util
+
+
+class TestInferenceModel(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+
+        self.A = np.asarray([
+            [0.0, 1.0, 1.0, 0.0],
+            [1.0, 0.0, 0.0, 0.0],
+            [1.0, 0.0, 0.0, 1.0],
+            [0.0, 0.0, 1.0, 0.0],
+        ])
+        self.X = rng.rand(4, 3).astype('float32')
+
+        self.num_hops = 2
+        self.arrays = {
+            'W_1': rng.randn(1, self.num_hops + 1, 3).astype('float32'),
+            'W_2': rng.randn((self.num_hops + 1) * 3, 2).astype('float32'),
+            'b_2': rng.randn(2).astype('float32'),
+        }
+
+        self.topology = {
+            'format': inference.EXPORT_FORMAT_VERSION,
+            'diffusion': 'full',
+            'num_hops': self.num_hops,
+            'layers': [
+                {'op': 'features'},
+                {'op': 'dcnn', 'input': 0, 'W': 'W_1', 'rows': True, 'nonlinearity': 'tanh'},
+                {'op': 'dense', 'input': 1, 'W': 'W_2', 'b': 'b_2', 'nonlinearity': 'softmax'},
+            ],
+        }
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def expected(self, indices):
+        K = util.A_to_diffusion_kernel(self.A, self.num_hops)
+        Z = np.tanh(np.dot(K[indices], self.X) * self.arrays['W_1']).reshape(len(indices), -1)
+        Z = np.exp(np.dot(Z, self.arrays['W_2']) + self.arrays['b_2'])
+
+        return Z / Z.sum(1, keepdims=True)
+
+    def test_predict_proba(self):
+        model = inference.InferenceModel(self.topology, self.arrays)
+        model.set_graph(self.A, self.X)
+
+        indices = np.asarray([3, 0, 2])
+        np.testing.assert_allclose(model.predict_proba(indices), self.expected(indices), rtol=1e-5)
+
+    def test_load(self):
+        path = os.path.join(self.directory, 'model.npz')
+        np.savez(path, topology=np.asarray(json.dumps(self.topology)), **self.arrays)
+
+        model = inference.load(path)
+        model.set_graph(self.A, self.X)
+
+        np.testing.assert_array_equal(model.predict([1, 2]), self.expected([1, 2]).argmax(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
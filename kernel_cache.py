@@ -0,0 +1,146 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse as sp
+
+import util
+
+
+def A_fingerprint(A):
+    """
+    Computes a hash of the graph that does not depend on how A is stored.
+
+    :param A: 2d numpy array or scipy.sparse matrix
+    :return: string, hex digest
+    """
+    A = sp.csr_matrix(A, dtype='float64', copy=True)
+    A.eliminate_zeros()
+    A.sum_duplicates()
+
+    h = hashlib.sha1()
+    h.update(repr(A.shape).encode('utf-8'))
+    h.update(np.ascontiguousarray(A.indptr, dtype='int64').data)
+    h.update(np.ascontiguousarray(A.indices, dtype='int64').data)
+    h.update(np.ascontiguousarray(A.data, dtype='float64').data)
+
+    return h.hexdigest()
+
+
+def kernel_key(A, build, k, *args, **kwargs):
+    """
+    Computes the cache key of the kernel built by build(A, k, *args, **kwargs).
+
+    :param A: 2d numpy array or scipy.sparse matrix
+    :param build: kernel builder from util, e.g. util.A_to_post_sparse_diffusion_kernel
+    :param k: integer, degree of series
+    :param args: remaining builder arguments, e.g. the diffusion threshold
+    :param kwargs: builder keyword arguments, e.g. the storage dtype
+    :return: string, hex digest
+    """
+    h = hashlib.sha1()
+    h.update(A_fingerprint(A).encode('utf-8'))
+    h.update(repr([build.__name__, int(k)] + [a if a is None else float(a) for a in args]).encode('utf-8'))
+    if kwargs:
+        h.update(repr(sorted((name, str(value)) for name, value in kwargs.items())).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def _save_kernel(path, K):
+    if isinstance(K, util.CSRDiffusionKernel):
+        for i, hop in enumerate(K.hops):
+            hop = hop.sorted_indices()
+            np.save(os.path.join(path, 'hop_%d_data.npy' % i), hop.data)
+            np.save(os.path.join(path, 'hop_%d_indices.npy' % i), hop.indices)
+            np.save(os.path.join(path, 'hop_%d_indptr.npy' % i), hop.indptr)
+        np.save(os.path.join(path, 'shape.npy'), np.asarray(K.shape, dtype='int64'))
+    else:
+        np.save(os.path.join(path, 'K.npy'), np.ascontiguousarray(K))
+
+
+def _load_kernel(path):
+    if not os.path.exists(os.path.join(path, 'shape.npy')):
+        return np.load(os.path.join(path, 'K.npy'), mmap_mode='r')
+
+    num_nodes, num_hops, num_columns = np.load(os.path.join(path, 'shape.npy'))
+
+    hops = []
+    for i in range(num_hops):
+        hops.append(sp.csr_matrix(
+            (
+                np.load(os.path.join(path, 'hop_%d_data.npy' % i), mmap_mode='r'),
+                np.load(os.path.join(path, 'hop_%d_indices.npy' % i), mmap_mode='r'),
+                np.load(os.path.join(path, 'hop_%d_indptr.npy' % i), mmap_mode='r'),
+            ),
+            shape=(num_nodes, num_columns),
+            copy=False,
+        ))
+
+    return util.CSRDiffusionKernel(hops)
+
+
+def copy_on_write(K):
+    """
+    Returns a writable version of a kernel, without touching the files of cached kernels.
+
+    A dense kernel reopened read-only by cached_kernel is reopened with mmap_mode='c', so pages
+    are only copied into private memory once they are written.  Writable kernels, and sparse
+    kernels (which are updated by building new arrays), are returned as they are.
+
+    :param K: kernel, as returned by cached_kernel or a builder from util
+    :return: K, or a writable copy-on-write mapping of it
+    """
+    if not isinstance(K, np.ndarray) or K.flags.writeable:
+        return K
+
+    filename = getattr(K, 'filename', None)
+    if filename is None:
+        return np.array(K)
+
+    writable = np.load(filename, mmap_mode='c')
+    if writable.shape != K.shape:
+        # A view of the first hops of a kernel shared by several models.
+        writable = util.hop_prefix(writable, K.shape[1] - 1)
+
+    return writable
+
+
+def cached_kernel(cache_dir, build, A, k, *args, **kwargs):
+    """
+    Returns build(A, k, *args, **kwargs), reusing a copy stored in cache_dir when one exists.
+
+    Dense kernels are stored as .npy and sparse kernels as one set of .npy arrays per hop.
+    Both are reopened with mmap_mode='r', so processes sharing a cache share its pages.
+    Entries are written to a temporary directory and renamed into place, so a job killed
+    mid-write never leaves a partial entry behind.
+
+    :param cache_dir: string, directory holding cached kernels
+    :param build: kernel builder from util, e.g. util.A_to_diffusion_kernel
+    :param A: 2d numpy array or scipy.sparse matrix
+    :param k: integer, degree of series
+    :param args: remaining builder arguments, e.g. the diffusion threshold
+    :param kwargs: builder keyword arguments, e.g. the storage dtype
+    :return: read-only kernel with the same indexing behaviour as build's result
+    """
+    path = os.path.join(cache_dir, kernel_key(A, build, k, *args, **kwargs))
+
+    if not os.path.isdir(path):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+        try:
+            _save_kernel(tmp_path, build(A, k, *args, **kwargs))
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process stored the same kernel first.
+            if not os.path.isdir(path):
+                raise
+        finally:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+
+    return _load_kernel(path)
@@ -0,0 +1,73 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+
+import kernel_cache
+import util
+
+
+class TestKernelCache(unittest.TestCase):
+    def setUp(self):
+        self.A = np.asarray([
+            [0.0, 1.0, 1.0, 0.0],
+            [1.0, 0.0, 0.0, 0.0],
+            [1.0, 0.0, 0.0, 1.0],
+            [0.0, 0.0, 1.0, 0.0],
+        ])
+
+        self.num_hops = 3
+        self.diffusion_threshold = 0.5
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_fingerprint_ignores_storage(self):
+        self.assertEqual(kernel_cache.A_fingerprint(self.A), kernel_cache.A_fingerprint(sp.coo_matrix(self.A)))
+
+        B = self.A.copy()
+        B[0, 3] = B[3, 0] = 1.0
+        self.assertNotEqual(kernel_cache.A_fingerprint(self.A), kernel_cache.A_fingerprint(B))
+
+    def test_key_depends_on_variant(self):
+        keys = set([
+            kernel_cache.kernel_key(self.A, util.A_to_diffusion_kernel, self.num_hops),
+            kernel_cache.kernel_key(self.A, util.A_to_diffusion_kernel, self.num_hops - 1),
+            kernel_cache.kernel_key(self.A, util.A_to_csr_diffusion_kernel, self.num_hops),
+            kernel_cache.kernel_key(self.A, util.A_to_post_sparse_diffusion_kernel, self.num_hops, 0.5),
+            kernel_cache.kernel_key(self.A, util.A_to_post_sparse_diffusion_kernel, self.num_hops, 0.25),
+        ])
+        self.assertEqual(len(keys), 5)
+
+    def test_dense_kernel_roundtrip(self):
+        expected = util.A_to_post_sparse_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+
+        for _ in range(2):
+            K = kernel_cache.cached_kernel(
+                self.cache_dir, util.A_to_post_sparse_diffusion_kernel, self.A, self.num_hops, self.diffusion_threshold
+            )
+            self.assertTrue(isinstance(K, np.memmap))
+            self.assertTrue(np.array_equal(K, expected))
+
+    def test_csr_kernel_roundtrip(self):
+        expected = util.A_to_csr_diffusion_kernel(self.A, self.num_hops)
+
+        for _ in range(2):
+            K = kernel_cache.cached_kernel(self.cache_dir, util.A_to_csr_diffusion_kernel, self.A, self.num_hops)
+            self.assertFalse(K.hops[1].data.flags.writeable)
+            self.assertTrue(np.array_equal(K[:, :, :], expected[:, :, :]))
+
+    def test_copy_on_write(self):
+        expected = util.A_to_diffusion_kernel(self.A, self.num_hops)
+        K = kernel_cache.cached_kernel(self.cache_dir, util.A_to_diffusion_kernel, self.A, self.num_hops)
+
+        for view in [K, util.hop_prefix(K, 1)]:
+            writable = kernel_cache.copy_on_write(view)
+            self.assertEqual(writable.shape, view.shape)
+            writable[0] = -1.0
+
+        K = kernel_cache.cached_kernel(self.cache_dir, util.A_to_diffusion_kernel, self.A, self.num_hops)
+        self.assertTrue(np.array_equal(K, expected))
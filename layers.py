@@ -1,8 +1,10 @@
 import lasagne
 import lasagne.layers
 import theano
+import theano.sparse
 import theano.tensor as T
 import numpy as np
+from theano.ifelse import ifelse
 
 import params
 
@@ -54,6 +56,24 @@ class DCNNLayer(lasagne.layers.MergeLayer):
         shape = (None, self.parameters.num_hops + 1, self.num_features)
         return shape
 
+class PrecomputedDCNNLayer(DCNNLayer):
+    """A node-level DCNN layer over precomputed diffusion features.
+
+    The single input is the product K X of shape (batch, num_hops + 1, num_features), computed
+    once outside of the Theano graph, so only the weighting and the nonlinearity remain.
+    """
+    def get_output_for(self, inputs, **kwargs):
+        """Compute diffusion convolutional activation of inputs."""
+
+        Apow_dot_X = inputs[0]
+
+        Apow_dot_X_times_W = Apow_dot_X * self.W
+
+        out = self.nonlinearity(Apow_dot_X_times_W)
+
+        return out
+
+
 class SparseDCNNLayer(DCNNLayer):
     """A node-level DCNN layer.
 
@@ -84,11 +104,10 @@ class SparseDCNNLayer(DCNNLayer):
     def get_output_for(self, inputs, **kwargs):
         """Compute diffusion convolutional activation of inputs."""
 
-        Apow = T.horizontal_stack(*inputs[:-1])
-
         X = inputs[-1]
 
-        Apow_dot_X = T.dot(Apow, X)
+        # Each hop is a sparse (batch, N) matrix; only its non-zeros take part in the product.
+        Apow_dot_X = T.stack([theano.sparse.structured_dot(Apow, X) for Apow in inputs[:-1]], axis=1)
 
         Apow_dot_X_times_W = Apow_dot_X * self.W
 
@@ -107,11 +126,15 @@ class AggregatedDCNNLayer(lasagne.layers.MergeLayer):
     def __init__(self, incomings, parameters, layer_num,
                  W=lasagne.init.Normal(0.01),
                  num_features=None,
+                 precomputed=False,
                  **kwargs):
         super(AggregatedDCNNLayer, self).__init__(incomings, **kwargs)
 
         self.parameters = parameters
 
+        # Whether the first input is the power series instead of the adjacency matrix.
+        self.precomputed = precomputed
+
         if num_features is None:
             self.num_features = self.parameters.num_features
         else:
@@ -122,14 +145,26 @@ class AggregatedDCNNLayer(lasagne.layers.MergeLayer):
 
         self.nonlinearity = params.nonlinearity_map[self.parameters.dcnn_nonlinearity]
 
-    def get_output_for(self, inputs, **kwargs):
+    def _power_series(self, A):
         """
-        Compute diffusion convolution of inputs.
+        Returns the normalized power series of A.
 
+        For one graph, A is (nodes, nodes) and the series (hops, nodes, nodes).  For a padded
+        batch (util.pack_graphs), A is (graphs, nodes, nodes) and the series
+        (graphs, hops, nodes, nodes).
         """
+        if self.precomputed:
+            return A
 
-        A = inputs[0]
-        X = inputs[1]
+        if A.ndim == 3:
+            # Normalize every graph by its own degrees.
+            A = A / (T.sum(A, 1).dimshuffle(0, 'x', 1) + 1.0)
+
+            Apow_list = [T.zeros_like(A) + T.eye(A.shape[1], dtype=A.dtype)]
+            for i in range(1, self.parameters.num_hops + 1):
+                Apow_list.append(T.batched_dot(A, Apow_list[-1]))
+
+            return T.stack(Apow_list, axis=1)
 
         # Normalize by degree.
         A = A / (T.sum(A, 0) + 1.0)
@@ -137,21 +172,56 @@ class AggregatedDCNNLayer(lasagne.layers.MergeLayer):
         Apow_list = [T.identity_like(A)]
         for i in range(1, self.parameters.num_hops + 1):
             Apow_list.append(A.dot(Apow_list[-1]))
-        Apow = T.stack(Apow_list)
 
-        Apow_dot_X = T.dot(Apow, X)
+        return T.stack(Apow_list)
 
-        Apow_dot_X_times_W = Apow_dot_X * self.W
+    def _diffuse(self, Apow, X):
+        """
+        Computes Apow X * W: (hops, nodes, features) for one graph, or (graphs, hops, nodes, features)
+        for a padded batch, where X is (graphs, nodes, features).
+        """
+        if X.ndim == 3:
+            num_graphs, num_hops, num_nodes = Apow.shape[0], Apow.shape[1], Apow.shape[2]
+            Apow_dot_X = T.batched_dot(Apow.reshape((num_graphs, num_hops * num_nodes, num_nodes)), X)
+            Apow_dot_X = Apow_dot_X.reshape((num_graphs, num_hops, num_nodes, X.shape[2]))
+
+            return Apow_dot_X * self.W.dimshuffle('x', 0, 1, 2)
+
+        return T.dot(Apow, X) * self.W
+
+    def _mean_over_nodes(self, Apow_dot_X_times_W, inputs):
+        """
+        Mean-reduce activations across nodes.  Returns (graphs, hops, features).
+
+        With a third input, the (graphs, nodes) node weights of a padded batch (1 / n_g for the
+        nodes of graph g, 0 for padding), the mean is taken per graph.
+        """
+        if len(inputs) > 2:
+            return T.sum(Apow_dot_X_times_W * inputs[2].dimshuffle(0, 'x', 1, 'x'), 2)
+
+        return T.mean(Apow_dot_X_times_W, 1).dimshuffle('x', 0, 1)
+
+    def get_output_for(self, inputs, **kwargs):
+        """
+        Compute diffusion convolution of inputs.
+
+        """
+
+        Apow = self._power_series(inputs[0])
+        X = inputs[1]
+
+        Apow_dot_X_times_W = self._diffuse(Apow, X)
 
         out = T.reshape(
-            self.nonlinearity(T.mean(Apow_dot_X_times_W, 1)),
-            (1, (self.parameters.num_hops + 1) * self.num_features)
+            self.nonlinearity(self._mean_over_nodes(Apow_dot_X_times_W, inputs)),
+            (-1, (self.parameters.num_hops + 1) * self.num_features)
         )
 
         return out
 
     def get_output_shape_for(self, input_shapes):
-        shape = (1, (self.parameters.num_hops + 1) * self.num_features)
+        num_graphs = None if len(input_shapes) > 2 else 1
+        shape = (num_graphs, (self.parameters.num_hops + 1) * self.num_features)
         return shape
 
 
@@ -167,31 +237,27 @@ class UnaggregatedDCNNLayer(AggregatedDCNNLayer):
 
         """
 
-        A = inputs[0]
+        Apow = self._power_series(inputs[0])
         X = inputs[1]
 
-        # Normalize by degree.
-        A = A / (T.sum(A, 0) + 1.0)
-
-        Apow_list = [T.identity_like(A)]
-        for i in range(1, self.parameters.num_hops + 1):
-            Apow_list.append(A.dot(Apow_list[-1]))
-        Apow = T.stack(Apow_list)
+        Apow_dot_X_times_W = self._diffuse(Apow, X)
 
-        Apow_dot_X = T.dot(Apow, X)
-
-        Apow_dot_X_times_W = Apow_dot_X * self.W
+        if X.ndim == 3:
+            # Padded batch: (graphs, nodes, hops * features).
+            return T.reshape(
+                self.nonlinearity(Apow_dot_X_times_W).transpose((0, 2, 1, 3)),
+                (X.shape[0], X.shape[1], (self.parameters.num_hops + 1) * self.num_features)
+            )
 
         out = T.reshape(
             self.nonlinearity(Apow_dot_X_times_W).transpose((1, 0, 2)),
-            (A.shape[0], (self.parameters.num_hops + 1) * self.num_features)
+            (X.shape[0], (self.parameters.num_hops + 1) * self.num_features)
         )
 
         return out
 
     def get_output_shape_for(self, input_shapes):
-        num_nodes = input_shapes[0][0]
-        shape = (num_nodes, (self.parameters.num_hops + 1) * self.num_features)
+        shape = tuple(input_shapes[1][:-1]) + ((self.parameters.num_hops + 1) * self.num_features,)
         return shape
 
 
@@ -208,27 +274,14 @@ class AggregatedFeaturesDCNNLayer(AggregatedDCNNLayer):
 
         """
 
-        A = inputs[0]
+        Apow = self._power_series(inputs[0])
         X = inputs[1]
 
-        # Normalize by degree.
-        A = A / (T.sum(A, 0) + 1.0)
-
-        Apow_list = [T.identity_like(A)]
-        for i in range(1, self.parameters.num_hops + 1):
-            Apow_list.append(A.dot(Apow_list[-1]))
-        Apow = T.stack(Apow_list)
-
-        Apow_dot_X = T.dot(Apow, X)
-
-        Apow_dot_X_times_W = Apow_dot_X * self.W
+        Apow_dot_X_times_W = self._diffuse(Apow, X)
 
         out = self.nonlinearity(
             T.mean(
-                T.reshape(
-                    T.mean(Apow_dot_X_times_W, 1),
-                    (1, (self.parameters.num_hops + 1), self.num_features)
-                ),
+                self._mean_over_nodes(Apow_dot_X_times_W, inputs),
                 2
             )
         )
@@ -236,7 +289,8 @@ class AggregatedFeaturesDCNNLayer(AggregatedDCNNLayer):
         return out
 
     def get_output_shape_for(self, input_shapes):
-        shape = (1, self.parameters.num_hops + 1)
+        num_graphs = None if len(input_shapes) > 2 else 1
+        shape = (num_graphs, self.parameters.num_hops + 1)
         return shape
 
 
@@ -308,12 +362,22 @@ class GraphReductionLayer(lasagne.layers.MergeLayer):
 
 
 class LearnableGraphReductionLayer(GraphReductionLayer):
+    """Merges the pair of nodes with the highest structural and (learned) feature score.
+
+    By default every pair is scored at once, which takes O(N^2 F) memory.  With chunk_size set,
+    only candidate pairs are scored, chunk_size at a time, in O(chunk_size (N + F)) memory: the
+    pairs of an optional third incoming, a (pairs, 2) integer matrix such as
+    util.candidate_pairs(A), or else the edges of A.  Candidates get the same scores as in the
+    dense mode.  Without any candidate (e.g. an edgeless graph) A is returned unchanged, as
+    merging any pair of an edgeless graph leaves it unchanged in dense mode too.
+    """
     def __init__(self,
                  incoming,
                  parameters,
                  layer_num,
                  W=lasagne.init.Normal(0.01),
-                 num_features=None):
+                 num_features=None,
+                 chunk_size=None):
         super(LearnableGraphReductionLayer, self).__init__(incoming, parameters)
 
         if num_features is None:
@@ -321,6 +385,8 @@ class LearnableGraphReductionLayer(GraphReductionLayer):
         else:
             self.num_features = num_features
 
+        self.chunk_size = chunk_size
+
         self.W = self.add_param(
             W,
             (1, self.parameters.num_hops + 1, self.num_features), name='DCNN_REDUCTION_%d' % layer_num
@@ -355,10 +421,50 @@ class LearnableGraphReductionLayer(GraphReductionLayer):
             A * (D + D.T - T.dot(A, A) - 2)
         )
 
+    def _candidate_scores(self, rows, cols, A, A_T, d, X):
+        """Computes the summed structural and feature losses of the pairs (rows, cols)."""
+        A2 = T.sum(A[rows] * A_T[cols], axis=1)
+        a = A[rows, cols]
+
+        triangles = a * A2
+        arrows = (T.eq(rows, cols) - a) * A2 + a * (d[rows] + d[cols] - A2 - 2)
+
+        # The dense mode broadcasts the structural loss across features before summing.
+        structural = X.shape[1] * (1 + a + triangles + arrows)
+        features = T.dot((X[rows] - X[cols]) ** 2, self.W.flatten())
+
+        return structural + features
+
+    def _best_candidate(self, A, X, pairs):
+        """Returns the candidate pair with the highest score, scoring chunk_size pairs at a time."""
+        A_T = A.T
+        d = T.sum(A, axis=1)
+
+        def score_chunk(start, rows, cols):
+            scores = self._candidate_scores(
+                rows[start:start + self.chunk_size], cols[start:start + self.chunk_size], A, A_T, d, X
+            )
+            return T.max(scores), start + T.argmax(scores)
+
+        (chunk_max, chunk_argmax), _ = theano.scan(
+            score_chunk,
+            sequences=T.arange(0, pairs[0].shape[0], self.chunk_size),
+            non_sequences=list(pairs),
+        )
+        best = chunk_argmax[T.argmax(chunk_max)]
+
+        return [pairs[0][best], pairs[1][best]]
+
     def get_output_for(self, inputs):
         A = inputs[0]
         X = inputs[1]
 
+        if self.chunk_size is not None:
+            pairs = [inputs[2][:, 0], inputs[2][:, 1]] if len(inputs) > 2 else list(T.nonzero(A))
+
+            # Lazy, so the scan and its argmax never run over an empty set of candidates.
+            return ifelse(T.gt(pairs[0].shape[0], 0), self.reduce(A, self._best_candidate(A, X, pairs)), A)
+
         num_nodes = A.shape[0]
         structural_symbolic_loss = T.addbroadcast(
             T.reshape(
@@ -393,6 +499,18 @@ def _2d_slice(M, ind1, ind2):
     return temp
 
 
+class SparseProjectionLayer(lasagne.layers.MergeLayer):
+    """Applies a sparse projection Q, the first input, to node features X, the second input."""
+    def get_output_for(self, inputs, **kwargs):
+        Q = inputs[0]
+        X = inputs[1]
+
+        return theano.sparse.structured_dot(Q, X)
+
+    def get_output_shape_for(self, input_shapes):
+        return (None, input_shapes[1][1])
+
+
 class SmallestEigenvecLayer(lasagne.layers.MergeLayer):
     def __init__(self, incoming, parameters):
         super(SmallestEigenvecLayer, self).__init__(incoming)
@@ -0,0 +1,62 @@
+import unittest
+
+import lasagne
+import numpy as np
+import theano
+import theano.tensor as T
+
+import benchmark
+import layers
+import util
+
+
+class TestLearnableGraphReductionLayer(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+
+        A = np.triu((rng.rand(12, 12) < 0.3).astype(theano.config.floatX), 1)
+        self.A = A + A.T
+        self.X = rng.rand(12, 3).astype(theano.config.floatX)
+        self.W = rng.randn(1, 1, 3).astype(theano.config.floatX)
+
+        # The dense mode broadcasts W over the hop axis, so it takes num_hops = 0.
+        self.parameters = benchmark.BenchmarkParameters(num_features=3, num_hops=0)
+
+    def reduction(self, chunk_size=None, candidates=False):
+        """Compiles the layer's output as a function of A, X and, with candidates, a pair matrix."""
+        l_in = [lasagne.layers.InputLayer((None, None), T.matrix('A')), lasagne.layers.InputLayer((None, 3), T.matrix('X'))]
+        if candidates:
+            l_in.append(lasagne.layers.InputLayer((None, 2), T.lmatrix('pairs')))
+
+        layer = layers.LearnableGraphReductionLayer(l_in, self.parameters, 1, W=self.W, chunk_size=chunk_size)
+
+        return theano.function([l.input_var for l in l_in], lasagne.layers.get_output(layer))
+
+    def test_chunked_scan_matches_dense(self):
+        expected = self.reduction()(self.A, self.X)
+        self.assertFalse(np.allclose(expected, self.A))
+
+        # Every pair as a candidate, in chunks that do not divide their number.
+        pairs = np.transpose(np.nonzero(np.ones((12, 12)))).astype('int64')
+        for chunk_size in [1, 7, 1000]:
+            np.testing.assert_allclose(self.reduction(chunk_size, candidates=True)(self.A, self.X, pairs), expected)
+
+    def test_edges_are_default_candidates(self):
+        pairs = util.candidate_pairs(self.A)
+
+        np.testing.assert_allclose(
+            self.reduction(5)(self.A, self.X), self.reduction(5, candidates=True)(self.A, self.X, pairs)
+        )
+
+    def test_edgeless_graph(self):
+        A = np.zeros_like(self.A)
+        expected = self.reduction()(A, self.X)
+
+        np.testing.assert_allclose(self.reduction(5)(A, self.X), expected)
+        np.testing.assert_allclose(
+            self.reduction(5, candidates=True)(A, self.X, util.candidate_pairs(A, top_k=3)), expected
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
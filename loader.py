@@ -0,0 +1,267 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse as sp
+
+
+# Bytes of text parsed at a time.
+DEFAULT_CHUNK_SIZE = 1 << 24
+
+
+def _chunks(path, chunk_size, comments='#'):
+    """Yields the non-empty, non-comment lines of a text file, about chunk_size bytes at a time."""
+    with open(path) as f:
+        lines, size = [], 0
+
+        for line in f:
+            if line.strip() and not line.startswith(comments):
+                lines.append(line)
+                size += len(line)
+
+            if size >= chunk_size:
+                yield lines
+                lines, size = [], 0
+
+        if lines:
+            yield lines
+
+
+def _map_ids(ids, values):
+    """Maps external node ids to positions in the sorted ids array; unknown ids map to -1."""
+    positions = np.searchsorted(ids, values)
+    positions[positions == len(ids)] = 0
+
+    return np.where(ids[positions] == values, positions, -1)
+
+
+def stream_nodes(path, chunk_size=DEFAULT_CHUNK_SIZE, labels=True):
+    """
+    Reads a node table with lines "<id> <feature>* [<label>]", e.g. Cora's cora.content.
+
+    Features are accumulated chunk by chunk into a CSR matrix, so only one chunk is ever dense.
+
+    :param path: string, path of the node table
+    :param chunk_size: integer, approximate number of bytes parsed at a time
+    :param labels: boolean, whether the last column is a class label
+    :return: int64 ids (in file order), CSR float32 features, and the labels as strings (or None)
+    """
+    ids, features, names = [], [], []
+
+    for lines in _chunks(path, chunk_size):
+        # Only the id and label columns become Python strings; the features are parsed by NumPy.
+        columns = [line.split(None, 1) for line in lines]
+        ids.append(np.asarray([column[0] for column in columns], dtype='int64'))
+
+        values = [column[1] if len(column) > 1 else '' for column in columns]
+        if labels:
+            values = [value.rsplit(None, 1) for value in values]
+            names.append(np.asarray([value[-1] for value in values]))
+            values = [value[0] if len(value) > 1 else '' for value in values]
+
+        features.append(sp.csr_matrix(
+            np.fromstring(' '.join(values), dtype='float32', sep=' ').reshape(len(lines), -1)
+        ))
+
+    X = sp.vstack(features, format='csr') if features else sp.csr_matrix((0, 0), dtype='float32')
+
+    return np.concatenate(ids), X, np.concatenate(names) if labels else None
+
+
+def stream_edges(path, num_nodes=None, ids=None, chunk_size=DEFAULT_CHUNK_SIZE, symmetric=True, self_loops=False):
+    """
+    Reads an edge list with lines "<source> <target> [...]" into a 0/1 CSR adjacency matrix.
+
+    Edges are parsed chunk by chunk into COO index arrays; a dense matrix is never built.
+
+    :param path: string, path of the edge list, e.g. Cora's cora.cites
+    :param num_nodes: integer, number of nodes; defaults to len(ids) or the largest index + 1
+    :param ids: optional sorted int64 array of node ids; edge endpoints are mapped to positions in
+                ids and edges with unknown endpoints are dropped.  Without ids, endpoints are
+                used as indices directly.
+    :param chunk_size: integer, approximate number of bytes parsed at a time
+    :param symmetric: boolean, whether to add the reverse of every edge
+    :param self_loops: boolean, whether to keep edges from a node to itself
+    :return: scipy.sparse.csr_matrix
+    """
+    rows, cols = [], []
+
+    for lines in _chunks(path, chunk_size):
+        edges = np.fromstring(''.join(lines), dtype='int64', sep=' ').reshape(len(lines), -1)[:, :2]
+
+        if ids is not None:
+            edges = _map_ids(ids, edges)
+            edges = edges[(edges >= 0).all(1)]
+
+        if not self_loops:
+            edges = edges[edges[:, 0] != edges[:, 1]]
+
+        rows.append(edges[:, 0])
+        cols.append(edges[:, 1])
+
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype='int64')
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype='int64')
+
+    if num_nodes is None:
+        num_nodes = len(ids) if ids is not None else int(max(rows.max(), cols.max())) + 1 if len(rows) else 0
+
+    if symmetric:
+        rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+
+    A = sp.coo_matrix((np.ones(len(rows), dtype='float32'), (rows, cols)), shape=(num_nodes, num_nodes)).tocsr()
+    A.data[:] = 1.0
+
+    return A
+
+
+def is_symmetric(A):
+    """
+    :param A: scipy.sparse matrix
+    :return: boolean, whether A equals its transpose
+    """
+    return (A != A.T).nnz == 0
+
+
+def has_self_loops(A):
+    """
+    :param A: scipy.sparse matrix
+    :return: boolean, whether any diagonal entry is non-zero
+    """
+    return bool((A.diagonal() != 0).any())
+
+
+def degrees(A):
+    """
+    :param A: scipy.sparse matrix
+    :return: 1d numpy array of column sums
+    """
+    return np.asarray(A.sum(0)).ravel()
+
+
+def check_graph(A):
+    """
+    Runs the graph sanity checks directly on the sparse representation.
+
+    :param A: scipy.sparse matrix
+    :return: dict with symmetric, self_loops, min, max and max_degree
+    """
+    A = sp.csr_matrix(A)
+    d = degrees(A)
+
+    return dict(
+        symmetric=is_symmetric(A),
+        self_loops=has_self_loops(A),
+        min=float(A.min()) if A.nnz else 0.0,
+        max=float(A.max()) if A.nnz else 0.0,
+        max_degree=float(d.max()) if len(d) else 0.0,
+    )
+
+
+def _one_hot(names):
+    classes, y = np.unique(names, return_inverse=True)
+
+    Y = np.zeros((len(names), len(classes)), dtype='int32')
+    Y[np.arange(len(names)), y] = 1
+
+    return Y
+
+
+def _save_csr(path, name, M):
+    np.save(os.path.join(path, '%s_data.npy' % name), M.data)
+    np.save(os.path.join(path, '%s_indices.npy' % name), M.indices)
+    np.save(os.path.join(path, '%s_indptr.npy' % name), M.indptr)
+    np.save(os.path.join(path, '%s_shape.npy' % name), np.asarray(M.shape, dtype='int64'))
+
+
+def _load_csr(path, name):
+    return sp.csr_matrix(
+        (
+            np.load(os.path.join(path, '%s_data.npy' % name), mmap_mode='r'),
+            np.load(os.path.join(path, '%s_indices.npy' % name), mmap_mode='r'),
+            np.load(os.path.join(path, '%s_indptr.npy' % name), mmap_mode='r'),
+        ),
+        shape=tuple(np.load(os.path.join(path, '%s_shape.npy' % name))),
+        copy=False,
+    )
+
+
+def _source_key(*paths):
+    """Identifies source files by path, size and modification time."""
+    h = hashlib.sha1()
+    for path in paths:
+        if path is not None:
+            stat = os.stat(path)
+            h.update(repr((os.path.abspath(path), stat.st_size, stat.st_mtime)).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def _parse_graph(edges_path, nodes_path, chunk_size):
+    ids, X, Y = None, None, None
+
+    if nodes_path is not None:
+        ids, X, names = stream_nodes(nodes_path, chunk_size)
+        order = np.argsort(ids, kind='mergesort')
+        ids, X, Y = ids[order], X[order], _one_hot(names[order])
+
+    A = stream_edges(edges_path, ids=ids, chunk_size=chunk_size)
+
+    return A, X, Y, ids
+
+
+def load_graph(edges_path, nodes_path=None, cache_dir=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Loads a graph from an edge list and an optional node table, e.g.
+
+        A, X, Y, ids = load_graph('cora/cora.cites', 'cora/cora.content', cache_dir='cache')
+
+    With cache_dir, the parsed arrays are stored as .npy files keyed by the source files' paths,
+    sizes and modification times.  Later runs reopen them with mmap_mode='r' instead of parsing.
+    Entries are written to a temporary directory and renamed into place.
+
+    :param edges_path: string, path of the edge list
+    :param nodes_path: optional string, path of the node table; nodes are sorted by id
+    :param cache_dir: optional string, directory holding parsed graphs
+    :param chunk_size: integer, approximate number of bytes parsed at a time
+    :return: CSR adjacency matrix, CSR features, one-hot int32 labels and int64 node ids (the last
+             three are None without nodes_path)
+    """
+    if cache_dir is None:
+        return _parse_graph(edges_path, nodes_path, chunk_size)
+
+    path = os.path.join(cache_dir, _source_key(edges_path, nodes_path))
+
+    if not os.path.isdir(path):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        A, X, Y, ids = _parse_graph(edges_path, nodes_path, chunk_size)
+
+        tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+        try:
+            _save_csr(tmp_path, 'A', A)
+            if nodes_path is not None:
+                _save_csr(tmp_path, 'X', X)
+                np.save(os.path.join(tmp_path, 'Y.npy'), Y)
+                np.save(os.path.join(tmp_path, 'ids.npy'), ids)
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process stored the same graph first.
+            if not os.path.isdir(path):
+                raise
+        finally:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+
+    A = _load_csr(path, 'A')
+    if nodes_path is None:
+        return A, None, None, None
+
+    return (
+        A,
+        _load_csr(path, 'X'),
+        np.load(os.path.join(path, 'Y.npy'), mmap_mode='r'),
+        np.load(os.path.join(path, 'ids.npy'), mmap_mode='r'),
+    )
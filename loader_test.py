@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import loader
+
+
+class TestLoader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        self.nodes_path = os.path.join(self.directory, 'graph.content')
+        with open(self.nodes_path, 'w') as f:
+            f.write('30 0 1 0 b\n')
+            f.write('10 1 0 0 a\n')
+            f.write('20 0 0 1 b\n')
+            f.write('40 1 1 0 a\n')
+
+        self.edges_path = os.path.join(self.directory, 'graph.cites')
+        with open(self.edges_path, 'w') as f:
+            f.write('# source target\n')
+            f.write('10 20\n')
+            f.write('20 30\n')
+            f.write('30 20\n')
+            f.write('30 30\n')
+            f.write('40 99\n')
+            f.write('\n')
+            f.write('10 40\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_graph(self, A, X, Y, ids):
+        self.assertEqual(list(ids), [10, 20, 30, 40])
+        self.assertEqual(A.toarray().tolist(), [
+            [0, 1, 0, 1],
+            [1, 0, 1, 0],
+            [0, 1, 0, 0],
+            [1, 0, 0, 0],
+        ])
+        self.assertEqual(X.toarray().tolist(), [[1, 0, 0], [0, 0, 1], [0, 1, 0], [1, 1, 0]])
+        self.assertEqual(np.asarray(Y).tolist(), [[1, 0], [0, 1], [0, 1], [1, 0]])
+
+    def test_load_graph(self):
+        # A chunk size of 2 bytes puts every line in its own chunk.
+        self.check_graph(*loader.load_graph(self.edges_path, self.nodes_path, chunk_size=2))
+
+    def test_cache(self):
+        cache_dir = os.path.join(self.directory, 'cache')
+
+        self.check_graph(*loader.load_graph(self.edges_path, self.nodes_path, cache_dir=cache_dir))
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        A, X, Y, ids = loader.load_graph(self.edges_path, self.nodes_path, cache_dir=cache_dir)
+        self.check_graph(A, X, Y, ids)
+        self.assertFalse(A.data.flags.writeable)
+
+    def test_check_graph(self):
+        A = loader.load_graph(self.edges_path, self.nodes_path)[0].tolil()
+
+        self.assertEqual(loader.check_graph(A), dict(symmetric=True, self_loops=False, min=0.0, max=1.0, max_degree=2.0))
+
+        A[0, 0] = 1.0
+        A[2, 3] = 1.0
+        checks = loader.check_graph(A)
+        self.assertFalse(checks['symmetric'])
+        self.assertTrue(checks['self_loops'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,113 @@
+import json
+import os
+
 import lasagne
 import numpy as np
+import scipy.sparse as sp
 import theano
+import theano.sparse
 import theano.tensor as T
 
-from sklearn import metrics
-
+import callbacks as callbacks_module
+import checkpoint
+import coarsening
+import inference
+import kernel_cache
 import layers
 import params
+import prefetch
 import util
 
 
+# Hyperparameters that change the compiled Theano graph of a model.
+_GRAPH_PARAMETER_NAMES = (
+    'num_hops', 'num_nodes', 'num_features', 'num_classes', 'learning_rate', 'loss_fn', 'update_fn',
+    'momentum', 'dcnn_nonlinearity', 'dense_nonlinearity', 'out_nonlinearity', 'num_dcnn_layers',
+    'num_dense_layers', 'dense_layer_size', 'diffusion_features',
+)
+
+# Training loop state saved by fit with every checkpoint; a checkpoint without it cannot be resumed.
+_CHECKPOINT_LOOP_KEYS = (
+    'loop_epoch', 'loop_stopped', 'loop_train_indices', 'loop_validation_losses', 'loop_validation_loss_window',
+)
+
+# Compiled functions shared across model instances: key -> (function, shared variables it was compiled with).
+_compiled_functions = {}
+
+# Nodes fed per call by evaluate and predict_proba, bounding the kernel rows gathered at once.
+EVALUATION_CHUNK_SIZE = 1024
+
+
+def _compile_function(model, name, inputs, outputs, updates=None):
+    """Compiles a Theano function for model.
+
+    When model.params.share_compiled_functions is set, a function compiled earlier for a model of the same
+    class and graph hyperparameters is copied onto this model's shared variables instead of being
+    recompiled, which skips graph optimization.
+    """
+    if not getattr(model.params, 'share_compiled_functions', False):
+        return theano.function(inputs, outputs, updates=updates)
+
+    # Options such as graph_batch_size or precompute_power_series add or retype inputs, so the
+    # input types are part of the key as well as the hyperparameters.
+    key = (type(model).__name__, name, tuple(str(v.type) for v in inputs)) + tuple(
+        (parameter_name, getattr(model.params, parameter_name, None)) for parameter_name in _GRAPH_PARAMETER_NAMES
+    )
+    shared_variables = model._shared_variables()
+
+    if key in _compiled_functions:
+        fn, template_shared_variables = _compiled_functions[key]
+        swap = dict(zip(template_shared_variables, shared_variables))
+
+        function_shared_variables = [i.variable for i in fn.maker.inputs if i.implicit]
+        if len(template_shared_variables) == len(shared_variables) and all(v in swap for v in function_shared_variables):
+            copied = fn.copy(swap=dict((v, swap[v]) for v in function_shared_variables))
+
+            # Function.copy always returns a list of outputs; keep the calling convention of fn.
+            copied.unpack_single = fn.unpack_single
+            copied.return_none = fn.return_none
+
+            return copied
+
+    fn = theano.function(inputs, outputs, updates=updates)
+    _compiled_functions[key] = (fn, shared_variables)
+
+    return fn
+
+
+def _compile_evaluation(model):
+    """Compiles one function of (inputs, Y) returning the mean loss, the predicted classes and the class probabilities."""
+    prediction = lasagne.layers.get_output(model.l_out)
+    loss = lasagne.objectives.aggregate(params.loss_map[model.params.loss_fn](prediction, model.var_Y), mode='mean')
+
+    return _compile_function(
+        model, 'evaluate', model._input_vars + [model.var_Y], [loss, T.argmax(prediction, axis=1), prediction]
+    )
+
+
+class _RunningMetrics(object):
+    """Accumulates the mean loss and the accuracy of an evaluation one step at a time."""
+    def __init__(self):
+        self.loss = 0.0
+        self.correct = 0
+        self.num_samples = 0
+
+    def update(self, loss, predictions, Y):
+        """
+        :param loss: mean loss of the step
+        :param predictions: 1d array of predicted classes
+        :param Y: 2d one-hot array of the actual classes
+        """
+        if len(predictions):
+            self.loss += float(loss) * len(predictions)
+            self.correct += int((predictions == Y.argmax(1)).sum())
+            self.num_samples += len(predictions)
+
+    def result(self):
+        num_samples = max(self.num_samples, 1)
+        return dict(loss=self.loss / num_samples, accuracy=float(self.correct) / num_samples, num_samples=self.num_samples)
+
+
 class NodeClassificationDCNN(object):
     """A DCNN model for node classification.
 
@@ -24,10 +122,22 @@ class NodeClassificationDCNN(object):
         self.var_X = T.matrix('X')
         self.var_Y = T.imatrix('Y')
 
-        self.l_in_k = lasagne.layers.InputLayer((None, self.params.num_hops + 1, self.params.num_nodes), input_var=self.var_K)
         self.l_in_x = lasagne.layers.InputLayer((self.params.num_nodes, self.params.num_features), input_var=self.var_X)
 
-        self._compute_diffusion_kernel(A)
+        self.A = A
+
+        if self._use_diffusion_features():
+            # The network is fed K X directly, so it never sees the kernel or X.
+            self.l_in_k = lasagne.layers.InputLayer((None, self.params.num_hops + 1, self.params.num_features), input_var=self.var_K)
+            self._input_vars = [self.var_K]
+
+            self.KX = None
+            self._diffusion_features_source = None
+        else:
+            self.l_in_k = lasagne.layers.InputLayer((None, self.params.num_hops + 1, self.params.num_nodes), input_var=self.var_K)
+            self._input_vars = [self.var_K, self.var_X]
+
+            self._compute_diffusion_kernel(A)
 
         # Overridable to customize init behavior.
         self._register_model_layers()
@@ -42,97 +152,581 @@ class NodeClassificationDCNN(object):
         if self.params.momentum:
             self._updates = lasagne.updates.apply_momentum(self._updates, model_parameters)
 
-        self.apply_loss_and_update = theano.function([self.var_K, self.var_X, self.var_Y], self._loss, updates=self._updates)
-        self.apply_loss = theano.function([self.var_K, self.var_X, self.var_Y], self._loss)
+        self.apply_loss_and_update = _compile_function(
+            self, 'apply_loss_and_update', self._input_vars + [self.var_Y], self._loss, updates=self._updates
+        )
+        self.apply_loss = _compile_function(self, 'apply_loss', self._input_vars + [self.var_Y], self._loss)
+
+        # Compiled on first use by predict_proba and representations.
+        self._proba_fn = None
+        self._representation_fn = None
+        self._evaluate_fn = None
+        self._prefetcher = None
+        self._diffusion_operators = None
+
+    def _shared_variables(self):
+        """Returns the model parameters followed by the optimizer state, in a stable order."""
+        variables = lasagne.layers.get_all_params(self.l_out)
+        return variables + [v for v in self._updates if v not in variables]
+
+    def _use_diffusion_features(self):
+        # Precompute K X once instead of feeding K and X on every step; valid while X is fixed.
+        return getattr(self.params, 'diffusion_features', False)
+
+    def _compute_diffusion_features(self, X):
+        return util.A_to_diffusion_features(self.A, X, self.params.num_hops)
+
+    def _diffusion_features(self, X):
+        if self._diffusion_features_source is not X:
+            self.KX = self._compute_diffusion_features(X)
+            self._diffusion_features_source = X
+
+        return self.KX
+
+    def _batch_rows_source(self, X):
+        """Returns the array whose rows are gathered per batch, or None if batches are not row slices."""
+        if self._use_diffusion_features():
+            return self._diffusion_features(X)
+
+        return self.K
+
+    def _batch_inputs(self, X, indices, rows=None):
+        """
+        Returns the model inputs for the given nodes, matching self._input_vars.
+
+        :param rows: the already gathered rows of _batch_rows_source(X) for indices, if available
+        """
+        if rows is None:
+            rows = self._batch_rows_source(X)[indices, :, :]
+
+        if self._use_diffusion_features():
+            return [rows]
+
+        return [rows, X]
+
+    def _kernel_backend(self):
+        # 'dense' materializes the (N, num_hops + 1, N) kernel; 'csr' keeps one sparse matrix per hop;
+        # 'lazy' computes the rows of each batch on demand; 'push' (thresholded models only) prunes
+        # entries below the diffusion threshold while the kernel is built.
+        return getattr(self.params, 'kernel_backend', 'dense')
+
+    def _shared_diffusion_kernel(self):
+        # A kernel with at least num_hops hops built once for several models, e.g. by sweep.py.
+        K = getattr(self.params, 'diffusion_kernel', None)
+
+        return None if K is None else util.hop_prefix(K, self.params.num_hops)
+
+    def _build_diffusion_kernel(self, kernel_map, A, *args):
+        shared = self._shared_diffusion_kernel()
+        if shared is not None:
+            return shared
+
+        backend = self._kernel_backend()
+        kwargs = {}
+
+        if backend == 'push':
+            args += (getattr(self.params, 'diffusion_top_k', None),)
+        elif backend == 'lazy':
+            cache_size = getattr(self.params, 'lazy_kernel_cache_size', util.LAZY_KERNEL_CACHE_SIZE)
+            return kernel_map[backend](A, self.params.num_hops, *args, cache_size=cache_size)
+        elif backend == 'dense':
+            # Storage precision (e.g. 'float16') and a byte budget for building the dense kernel.
+            if getattr(self.params, 'kernel_dtype', None) is not None:
+                kwargs['dtype'] = self.params.kernel_dtype
+            if getattr(self.params, 'kernel_memory_budget', None) is not None:
+                kwargs['memory_budget'] = self.params.kernel_memory_budget
+
+        # Reuse kernels stored on disk by earlier runs on the same graph.
+        cache_dir = getattr(self.params, 'kernel_cache_dir', None)
+        if cache_dir is not None:
+            return kernel_cache.cached_kernel(cache_dir, kernel_map[backend], A, self.params.num_hops, *args, **kwargs)
+
+        return kernel_map[backend](A, self.params.num_hops, *args, **kwargs)
 
     def _compute_diffusion_kernel(self, A):
-        self.K = util.A_to_diffusion_kernel(A, self.params.num_hops)
+        self.K = self._build_diffusion_kernel(util.diffusion_kernel_map, A)
 
-    def _register_model_layers(self):
-        self.l_dcnn = layers.DCNNLayer(
+    @classmethod
+    def build_diffusion_kernel(cls, parameters, A):
+        """
+        Builds the kernel that a model of this class computes for parameters and A.
+
+        A kernel built for num_hops = H can be shared by models of the same class with any
+        num_hops <= H through params.diffusion_kernel; each model uses a view of its first hops.
+        """
+        model = cls.__new__(cls)
+        model.params = parameters
+        model._compute_diffusion_kernel(A)
+
+        return model.K
+
+    def _register_dcnn_layer(self):
+        if self._use_diffusion_features():
+            return layers.PrecomputedDCNNLayer(
+                [self.l_in_k],
+                self.params,
+                1,
+            )
+
+        return layers.DCNNLayer(
             [self.l_in_k, self.l_in_x],
             self.params,
             1,
         )
 
+    def _register_model_layers(self):
+        self.l_dcnn = self._register_dcnn_layer()
+
         self.l_out = lasagne.layers.DenseLayer(
             self.l_dcnn,
             num_units=self.params.num_classes,
             nonlinearity=params.nonlinearity_map[self.params.out_nonlinearity],
         )
 
-    def train_step(self, X, Y, batch_indices):
+    def train_step(self, X, Y, batch_indices, rows=None):
+        inputs = self._batch_inputs(X, batch_indices, rows) + [Y[batch_indices, :]]
         return self.apply_loss_and_update(
-            self.K[batch_indices, :, :], X, Y[batch_indices, :]
+            *inputs
         )
 
     def validation_step(self, X, Y, valid_indices):
-        return self.apply_loss(
-            self.K[valid_indices, :, :], X, Y[valid_indices, :]
+        return self.evaluate(X, Y, valid_indices)['loss']
+
+    def _evaluation_chunk_size(self):
+        # None evaluates all the indices in one call.
+        return getattr(self.params, 'evaluation_chunk_size', EVALUATION_CHUNK_SIZE)
+
+    def _evaluation_chunks(self, X, indices):
+        """Yields (start, end, inputs) for consecutive chunks of indices, gathering rows into one reused buffer."""
+        chunk_size = self._evaluation_chunk_size() or max(len(indices), 1)
+        source = self._batch_rows_source(X)
+        buffer = None
+
+        for start in range(0, max(len(indices), 1), chunk_size):
+            chunk = indices[start:start + chunk_size]
+
+            rows = None
+            if source is not None:
+                if buffer is None:
+                    buffer = np.empty((min(chunk_size, len(indices)),) + tuple(source.shape[1:]), dtype=source.dtype)
+                rows = util.gather_rows(source, chunk, out=buffer[:len(chunk)])
+
+            yield start, start + len(chunk), self._batch_inputs(X, chunk, rows)
+
+    def evaluate(self, X, Y, indices):
+        """
+        Computes the loss, accuracy, predictions and class probabilities of nodes in one forward pass.
+
+        The indices are fed params.evaluation_chunk_size (default EVALUATION_CHUNK_SIZE) at a
+        time to a single compiled function, and the metrics are accumulated chunk by chunk, so
+        only one chunk of kernel rows is held at a time.
+
+        :return: dict with loss (the mean over indices), accuracy, num_samples, predictions and
+                 probabilities
+        """
+        if self._evaluate_fn is None:
+            self._evaluate_fn = _compile_evaluation(self)
+
+        running = _RunningMetrics()
+        predictions = np.zeros(len(indices), dtype='int64')
+        probabilities = np.zeros((len(indices), self.params.num_classes), dtype=theano.config.floatX)
+
+        for start, end, inputs in self._evaluation_chunks(X, indices):
+            y = Y[indices[start:end], :]
+            loss, predictions[start:end], probabilities[start:end] = self._evaluate_fn(*(inputs + [y]))
+            running.update(loss, predictions[start:end], y)
+
+        return dict(running.result(), predictions=predictions, probabilities=probabilities)
+
+    def _training_batches(self, X, batches):
+        """Yields (batch_indices, rows), gathering rows ahead of time when params.prefetch_depth > 0."""
+        depth = getattr(self.params, 'prefetch_depth', 0)
+        source = self._batch_rows_source(X)
+
+        if depth > 0 and source is not None:
+            use_process = getattr(self.params, 'prefetch_process', False)
+
+            # Keep one prefetcher, and so its buffers, for every epoch over the same rows.
+            prefetcher = self._prefetcher
+            if prefetcher is None or prefetcher.source is not source or (prefetcher.depth, prefetcher.use_process) != (
+                depth, use_process
+            ):
+                prefetcher = self._prefetcher = prefetch.BatchPrefetcher(
+                    source, depth=depth, use_process=use_process, max_rows=self.params.batch_size
+                )
+
+            return prefetcher.iterate(batches)
+
+        # Gather as each batch is requested, so the gather is timed separately from the step.
+        return (
+            (batch_indices, None if source is None else util.gather_rows(source, batch_indices))
+            for batch_indices in batches
         )
 
-    def fit(self, X, Y, train_indices, valid_indices):
+    def save_checkpoint(self, path, **loop_state):
+        """
+        Atomically writes the model parameters, optimizer state, NumPy RNG state and loop_state.
+
+        :param path: string, .npz file
+        :param loop_state: numpy arrays or scalars, returned again by load_checkpoint
+        """
+        arrays = checkpoint.rng_state_arrays()
+        arrays['config'] = np.asarray(self._checkpoint_config())
+        for i, variable in enumerate(self._shared_variables()):
+            arrays['variable_%d' % i] = variable.get_value(borrow=True)
+        for name, value in loop_state.items():
+            arrays['loop_%s' % name] = np.asarray(value)
+
+        checkpoint.write(path, arrays)
+
+    def _checkpoint_config(self):
+        """Describes the model class and graph hyperparameters a checkpoint can be restored into."""
+        return json.dumps(dict(
+            [('class', type(self).__name__)] +
+            [(name, getattr(self.params, name, None)) for name in _GRAPH_PARAMETER_NAMES]
+        ), sort_keys=True, default=str)
+
+    def load_checkpoint(self, path):
+        """
+        Restores a checkpoint written by save_checkpoint into this model and the NumPy RNG.
+
+        The model must have been built with the same class and hyperparameters.  Building it
+        with params.kernel_cache_dir reuses the kernel on disk, and with
+        params.share_compiled_functions reuses functions compiled earlier in the process.
+
+        :return: dict, the loop state
+        :raises ValueError: if the checkpoint was written by a different model
+        """
+        return self._restore_checkpoint(path, checkpoint.read(path))
+
+    def _restore_checkpoint(self, path, arrays):
+        if 'config' in arrays and str(arrays['config']) != self._checkpoint_config():
+            raise ValueError('checkpoint %s was written by a model of another class or hyperparameters: %s' % (
+                path, arrays['config']
+            ))
+
+        variables = self._shared_variables()
+        names = ['variable_%d' % i for i in range(len(variables))]
+        if len([name for name in arrays if name.startswith('variable_')]) != len(variables) or any(
+            arrays[name].shape != variable.get_value(borrow=True).shape for name, variable in zip(names, variables)
+        ):
+            raise ValueError('checkpoint %s does not match the variables of this model' % path)
+
+        for name, variable in zip(names, variables):
+            variable.set_value(arrays[name])
+        checkpoint.set_rng_state(arrays)
 
+        return dict((name[len('loop_'):], value) for name, value in arrays.items() if name.startswith('loop_'))
+
+    def fit(self, X, Y, train_indices, valid_indices, callbacks=()):
+        """
+        Trains the model.
+
+        With params.checkpoint_path set, a checkpoint is written every params.checkpoint_every
+        epochs (default 1) and when training stops.  If the file already exists, training
+        resumes from it: parameters, optimizer state, RNG, epoch, early stopping window and the
+        order of train_indices are restored, and the remaining epochs continue as if training
+        had never been interrupted.  A checkpoint of a run that already stopped early or trained
+        all num_epochs epochs is refused, instead of returning its old losses without training.
+
+        :param callbacks: list of callbacks.Callback, given a record after every batch and epoch
+        :return: list of the validation loss of every epoch
+        """
         num_nodes = X.shape[0]
 
         print 'Training model...'
         validation_losses = []
         validation_loss_window = np.zeros(self.params.stop_window_size)
         validation_loss_window[:] = float('+inf')
-
-        for epoch in range(self.params.num_epochs):
+        start_epoch = 0
+
+        checkpoint_path = getattr(self.params, 'checkpoint_path', None)
+        checkpoint_every = getattr(self.params, 'checkpoint_every', 1)
+
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            arrays = checkpoint.read(checkpoint_path)
+
+            # Refuse before anything is restored, so the model is left as it was.
+            missing = [key for key in _CHECKPOINT_LOOP_KEYS if key not in arrays]
+            if missing:
+                raise ValueError('checkpoint %s holds no training loop state (missing %s); it cannot be resumed' % (
+                    checkpoint_path, ', '.join(missing)
+                ))
+            if arrays['loop_stopped'] or int(arrays['loop_epoch']) + 1 >= self.params.num_epochs:
+                raise ValueError(
+                    'checkpoint %s holds a finished run (epoch %d%s); remove it or set another checkpoint_path' % (
+                        checkpoint_path, int(arrays['loop_epoch']), ', stopped early' if arrays['loop_stopped'] else ''
+                    )
+                )
+            if len(arrays['loop_train_indices']) != len(train_indices):
+                raise ValueError('checkpoint %s was written for %d training nodes, not %d' % (
+                    checkpoint_path, len(arrays['loop_train_indices']), len(train_indices)
+                ))
+
+            state = self._restore_checkpoint(checkpoint_path, arrays)
+
+            validation_losses = list(state['validation_losses'])
+            validation_loss_window[:] = state['validation_loss_window']
+            train_indices[:] = state['train_indices']
+            start_epoch = int(state['epoch']) + 1
+
+            print 'Resuming from %s after epoch %d' % (checkpoint_path, start_epoch - 1)
+
+        for epoch in range(start_epoch, self.params.num_epochs):
+            for callback in callbacks:
+                callback.on_epoch_start(self, epoch)
+
+            timers = callbacks_module.EpochTimers()
             train_loss = 0.0
 
             np.random.shuffle(train_indices)
 
             num_batch = num_nodes // self.params.batch_size
 
+            batches = []
             for batch in range(num_batch):
                 start = batch * self.params.batch_size
                 end = min((batch + 1) * self.params.batch_size, train_indices.shape[0])
 
                 if start < end:
-                    train_loss += self.train_step(X, Y, train_indices[start:end])
+                    batches.append(train_indices[start:end])
+
+            timers.lap()
+            for batch, (batch_indices, rows) in enumerate(self._training_batches(X, batches)):
+                gather_s = timers.lap('gather')
+                loss = self.train_step(X, Y, batch_indices, rows)
+                step_s = timers.lap('step')
+
+                train_loss += loss
+
+                for callback in callbacks:
+                    callback.on_batch_end(self, dict(
+                        epoch=epoch, batch=batch, num_samples=len(batch_indices), loss=float(loss),
+                        gather_s=gather_s, step_s=step_s,
+                    ))
+                timers.lap()
 
             train_loss /= num_batch
 
-            valid_loss = self.validation_step(X, Y, valid_indices)
+            evaluation = self.evaluate(X, Y, valid_indices)
+            valid_loss = evaluation['loss']
+            timers.lap('validation')
 
             print "Epoch %d mean training error: %.6f" % (epoch, train_loss)
             print "Epoch %d validation error: %.6f" % (epoch, valid_loss)
 
-            if self.params.print_train_accuracy:
-                predictions = self.predict(X, train_indices)
-                actuals = Y[train_indices, :].argmax(1)
+            accuracies = {}
+            timers.lap()
 
-                print "Epoch %d training accuracy: %.4f" % (epoch, metrics.accuracy_score(predictions, actuals))
+            if self.params.print_train_accuracy:
+                accuracies['train_accuracy'] = self.evaluate(X, Y, train_indices)['accuracy']
+                print "Epoch %d training accuracy: %.4f" % (epoch, accuracies['train_accuracy'])
 
             if self.params.print_valid_accuracy:
-                predictions = self.predict(X, valid_indices)
-                actuals = Y[valid_indices, :].argmax(1)
+                # Computed by the validation pass; the forward pass is not repeated.
+                accuracies['valid_accuracy'] = evaluation['accuracy']
+                print "Epoch %d validation accuracy: %.4f" % (epoch, accuracies['valid_accuracy'])
+
+            timers.lap('accuracy')
 
-                print "Epoch %d validation accuracy: %.4f" % (epoch, metrics.accuracy_score(predictions, actuals), )
+            record = timers.record(
+                epoch=epoch, num_samples=sum(len(b) for b in batches),
+                train_loss=float(train_loss), valid_loss=float(valid_loss), **accuracies
+            )
+            for callback in callbacks:
+                callback.on_epoch_end(self, record)
 
             validation_losses.append(valid_loss)
 
-            if self.params.stop_early:
-                if valid_loss >= validation_loss_window.mean():
-                    print 'Validation loss did not decrease. Stopping early.'
-                    break
+            stop = self.params.stop_early and valid_loss >= validation_loss_window.mean()
+            if not stop:
+                validation_loss_window[epoch % self.params.stop_window_size] = valid_loss
 
-            validation_loss_window[epoch % self.params.stop_window_size] = valid_loss
+            last = stop or epoch == self.params.num_epochs - 1
+            if checkpoint_path is not None and (last or (epoch + 1) % checkpoint_every == 0):
+                self.save_checkpoint(
+                    checkpoint_path, epoch=epoch, stopped=stop, train_indices=train_indices,
+                    validation_losses=validation_losses, validation_loss_window=validation_loss_window,
+                )
 
-    def predict(self, X, prediction_indices):
-        pred = lasagne.layers.get_output(self.l_out)
+            if stop:
+                print 'Validation loss did not decrease. Stopping early.'
+                break
+
+        return validation_losses
 
-        # Create a function that applies the model to data to predict a class
-        pred_fn = theano.function([self.var_K, self.var_X], T.argmax(pred, axis=1))
+    def predict_proba(self, X, prediction_indices):
+        if self._proba_fn is None:
+            pred = lasagne.layers.get_output(self.l_out)
 
-        # Return the predictions
-        predictions = pred_fn(self.K[prediction_indices, :, :], X)
+            # Create a function that applies the model to data, once per model
+            self._proba_fn = _compile_function(self, 'predict_proba', self._input_vars, pred)
+
+        return np.concatenate([
+            self._proba_fn(*inputs) for _, _, inputs in self._evaluation_chunks(X, prediction_indices)
+        ])
+
+    def predict(self, X, prediction_indices):
+        # Return the predicted classes
+        predictions = self.predict_proba(X, prediction_indices).argmax(1)
 
         return predictions
 
+    def representations(self, X, indices):
+        """
+        Returns the learned representation of nodes: the flattened input of the output layer.
+
+        These are the item representations rerank.rerank diversifies over.
+
+        :return: 2d numpy array, one row per node
+        """
+        if self._representation_fn is None:
+            hidden = lasagne.layers.get_output(self.l_out.input_layer)
+            self._representation_fn = _compile_function(
+                self, 'representations', self._input_vars, hidden.flatten(2)
+            )
+
+        return self._representation_fn(*self._batch_inputs(X, indices))
+
+    def _diffusion_config(self):
+        """Describes the diffusion kernel for inference.InferenceModel."""
+        return {'diffusion': 'full'}
+
+    def _update_diffusion_operators(self, A, changed, config):
+        """
+        Returns the normalized adjacency and the first kernel hop of the new adjacency A.
+
+        Both are kept between updates, and only the rows around the changed nodes are recomputed.
+        """
+        if self._diffusion_operators is None:
+            P = util._normalized_adjacency(self.A)
+            degrees = np.asarray(sp.csr_matrix(self.A).sum(0), dtype='float64').ravel()
+            first_hop = util._threshold_csr(P, config['threshold']) if config['diffusion'] == 'pre_sparse' else P
+        else:
+            P, degrees, first_hop = self._diffusion_operators
+
+        P, patched = util.update_normalized_adjacency(P, degrees, A, changed)
+        if config['diffusion'] == 'pre_sparse':
+            first_hop = util._replace_csr_rows(first_hop, patched, util._threshold_csr(P[patched], config['threshold']))
+        else:
+            first_hop = P
+
+        self._diffusion_operators = (P, degrees, first_hop)
+
+        return P, first_hop
+
+    def update_edges(self, insertions=(), deletions=()):
+        """
+        Inserts and deletes edges of the graph, refreshing only the affected part of the kernel.
+
+        The kernel (or the diffusion features, when params.diffusion_features is set) is updated
+        in place for the nodes within num_hops of a changed edge; the rest is left untouched.
+
+        :param insertions: sequence of (u, v) node pairs to connect
+        :param deletions: sequence of (u, v) node pairs to disconnect
+        """
+        A, changed = util.apply_edge_changes(self.A, insertions, deletions)
+        rows = util.affected_rows(self.A, A, changed, self.params.num_hops)
+
+        config = self._diffusion_config()
+        P, first_hop = self._update_diffusion_operators(A, changed, config)
+        threshold = config['threshold'] if config['diffusion'] == 'post_sparse' else None
+
+        if self._use_diffusion_features():
+            if self.KX is not None:
+                util.update_diffusion_features(self.KX, P, first_hop, self._diffusion_features_source, rows, threshold)
+        elif self.K is not None:
+            # Push kernels were pruned while they were built, so their rows are recomputed the same way.
+            push = None
+            if self._kernel_backend() == 'push':
+                push = (config['threshold'], getattr(self.params, 'diffusion_top_k', None))
+
+            # A kernel reopened read-only from kernel_cache_dir is updated in a private copy-on-write mapping.
+            self.K = kernel_cache.copy_on_write(self.K)
+            util.update_diffusion_kernel(self.K, P, first_hop, rows, threshold, push=push)
+
+        self.A = A
+
+    def _export_layers(self):
+        """Translates the Lasagne layers into the topology of inference.InferenceModel."""
+        # Without an indices input the kernel input holds the rows of the requested nodes.
+        rows = getattr(self, 'l_indices', None) is None
+
+        topology = []
+        arrays = {}
+        positions = {}
+
+        def add(layer, spec):
+            positions[layer] = len(topology)
+            topology.append(spec)
+
+        kernel_layers = self.l_in_k if isinstance(self.l_in_k, list) else [self.l_in_k]
+
+        for layer in lasagne.layers.get_all_layers(self.l_out):
+            if layer in kernel_layers:
+                if self._use_diffusion_features():
+                    # Precomputed K X is recomputed from X at inference time.
+                    add(layer, {'op': 'features'})
+            elif layer is self.l_in_x:
+                add(layer, {'op': 'features'})
+            elif layer is getattr(self, 'l_indices', None):
+                add(layer, {'op': 'indices'})
+            elif isinstance(layer, layers.DCNNLayer):
+                W = 'W_%d' % len(topology)
+                arrays[W] = layer.get_params()[0].get_value()
+                add(layer, {
+                    'op': 'dcnn', 'input': positions[layer.input_layers[-1]], 'W': W, 'rows': rows,
+                    'nonlinearity': layer.nonlinearity.__name__,
+                })
+            elif isinstance(layer, lasagne.layers.ReshapeLayer):
+                add(layer, {'op': 'reshape', 'input': positions[layer.input_layer], 'shape': list(layer.shape)})
+            elif isinstance(layer, layers.ArrayIndexLayer):
+                add(layer, {
+                    'op': 'take', 'input': positions[layer.input_layers[0]], 'indices': positions[layer.input_layers[1]],
+                })
+            elif isinstance(layer, lasagne.layers.DenseLayer):
+                spec = {
+                    'op': 'dense', 'input': positions[layer.input_layer], 'W': 'W_%d' % len(topology),
+                    'nonlinearity': layer.nonlinearity.__name__,
+                }
+                arrays[spec['W']] = layer.W.get_value()
+                if layer.b is not None:
+                    spec['b'] = 'b_%d' % len(topology)
+                    arrays[spec['b']] = layer.b.get_value()
+                add(layer, spec)
+            else:
+                raise ValueError('cannot export layer %s' % type(layer).__name__)
+
+        for spec in topology:
+            if spec.get('nonlinearity', 'linear') not in inference.nonlinearity_map:
+                raise ValueError('cannot export nonlinearity %s' % spec['nonlinearity'])
+
+        return topology, arrays
+
+    def export(self, path):
+        """
+        Writes the learned parameters and the layer topology to a .npz file.
+
+        The file is loaded with inference.load, which predicts with NumPy and SciPy only.
+
+        :param path: path of the .npz file
+        """
+        topology, arrays = self._export_layers()
+
+        config = dict(
+            self._diffusion_config(),
+            format=inference.EXPORT_FORMAT_VERSION,
+            num_hops=self.params.num_hops,
+            layers=topology,
+        )
+
+        # A push kernel prunes while it walks, so inference has to diffuse the same way.
+        if self._kernel_backend() == 'push' and not self._use_diffusion_features():
+            config['diffusion'] += '_push'
+            config['top_k'] = getattr(self.params, 'diffusion_top_k', None)
+
+        np.savez(path, topology=np.asarray(json.dumps(config)), **arrays)
+
 
 class TrueSparseNodeClassificationDCNN(NodeClassificationDCNN):
     """A DCNN model for node classification with truly sparse pre-thresholding.
@@ -143,7 +737,12 @@ class TrueSparseNodeClassificationDCNN(NodeClassificationDCNN):
     """
 
     def _compute_diffusion_kernel(self, A):
-        self.K = util.sparse_A_to_diffusion_kernel(
+        self.K = self._shared_diffusion_kernel()
+        if self.K is not None:
+            return
+
+        # One CSR matrix per hop; each step feeds only the rows of its batch.
+        self.K = util.A_to_csr_diffusion_kernel(
             A,
             self.params.num_hops
         )
@@ -167,7 +766,7 @@ class TrueSparseNodeClassificationDCNN(NodeClassificationDCNN):
 
         self.var_K = []
         for i in range(self.params.num_hops + 1):
-            self.var_K.append(T.matrix('K_%d' % i))
+            self.var_K.append(theano.sparse.csr_matrix('K_%d' % i, dtype=util.CSRDiffusionKernel.dtype.name))
 
         self.var_X = T.matrix('X')
         self.var_Y = T.imatrix('Y')
@@ -175,6 +774,7 @@ class TrueSparseNodeClassificationDCNN(NodeClassificationDCNN):
         self.l_in_k = [lasagne.layers.InputLayer((None, self.params.num_nodes), input_var=vK) for vK in self.var_K]
         self.l_in_x = lasagne.layers.InputLayer((self.params.num_nodes, self.params.num_features), input_var=self.var_X)
 
+        self.A = A
         self._compute_diffusion_kernel(A)
 
         # Overridable to customize init behavior.
@@ -190,35 +790,64 @@ class TrueSparseNodeClassificationDCNN(NodeClassificationDCNN):
         if self.params.momentum:
             self._updates = lasagne.updates.apply_momentum(self._updates, model_parameters)
 
-        self.apply_loss_and_update = theano.function(self.var_K + [self.var_X, self.var_Y], self._loss, updates=self._updates)
-        self.apply_loss = theano.function(self.var_K + [self.var_X, self.var_Y], self._loss)
+        self._input_vars = self.var_K + [self.var_X]
 
-    def train_step(self, X, Y, batch_indices):
-        #inputs = [k[batch_indices, :] for k in self.K] + [X, Y[batch_indices, :]]
-        inputs = self.K + [X, Y[batch_indices, :]]
-        return self.apply_loss_and_update(
-            *inputs
+        self.apply_loss_and_update = _compile_function(
+            self, 'apply_loss_and_update', self._input_vars + [self.var_Y], self._loss, updates=self._updates
         )
+        self.apply_loss = _compile_function(self, 'apply_loss', self._input_vars + [self.var_Y], self._loss)
 
-    def validation_step(self, X, Y, valid_indices):
-        return self.apply_loss(
-            self.K[valid_indices, :, :], X, Y[valid_indices, :]
-        )
+        self._proba_fn = None
+        self._representation_fn = None
+        self._evaluate_fn = None
+        self._prefetcher = None
+        self._diffusion_operators = None
+
+    def _use_diffusion_features(self):
+        return False
+
+    def _batch_rows_source(self, X):
+        return None
+
+    def _batch_inputs(self, X, indices, rows=None):
+        return [hop[indices] for hop in self.K.hops] + [X]
 
 
 class PostSparseNodeClassificationDCNN(NodeClassificationDCNN):
+    def _diffusion_config(self):
+        return {'diffusion': 'post_sparse', 'threshold': self.params.diffusion_threshold}
+
     def _compute_diffusion_kernel(self, A):
-        self.K = util.A_to_post_sparse_diffusion_kernel(
+        self.K = self._build_diffusion_kernel(
+            util.post_sparse_diffusion_kernel_map,
             A,
+            self.params.diffusion_threshold
+        )
+
+    def _compute_diffusion_features(self, X):
+        return util.A_to_post_sparse_diffusion_features(
+            self.A,
+            X,
             self.params.num_hops,
             self.params.diffusion_threshold
         )
 
 
 class PreSparseNodeClassificationDCNN(NodeClassificationDCNN):
+    def _diffusion_config(self):
+        return {'diffusion': 'pre_sparse', 'threshold': self.params.diffusion_threshold}
+
     def _compute_diffusion_kernel(self, A):
-        self.K = util.A_to_pre_sparse_diffusion_kernel(
+        self.K = self._build_diffusion_kernel(
+            util.pre_sparse_diffusion_kernel_map,
             A,
+            self.params.diffusion_threshold
+        )
+
+    def _compute_diffusion_features(self, X):
+        return util.A_to_pre_sparse_diffusion_features(
+            self.A,
+            X,
             self.params.num_hops,
             self.params.diffusion_threshold
         )
@@ -248,7 +877,11 @@ class DeepNodeClassificationDCNN(NodeClassificationDCNN):
             input_var=self.var_I
         )
 
-        self.K = util.A_to_diffusion_kernel(A, self.params.num_hops)
+        self.A = A
+        self.K = self._shared_diffusion_kernel()
+        if self.K is None and self._neighborhood_fanouts() is None:
+            # With neighborhood_fanouts every call builds the kernel of its own receptive field instead.
+            self.K = util.A_to_diffusion_kernel(A, self.params.num_hops)
 
         # Overridable to customize init behavior.
         self._register_model_layers()
@@ -263,9 +896,68 @@ class DeepNodeClassificationDCNN(NodeClassificationDCNN):
         if self.params.momentum:
             self._updates = lasagne.updates.apply_momentum(self._updates, model_parameters)
 
-        self.apply_loss_and_update = theano.function([self.var_K, self.var_X, self.var_I, self.var_Y], self._loss,
-                                                     updates=self._updates)
-        self.apply_loss = theano.function([self.var_K, self.var_X, self.var_I, self.var_Y], self._loss)
+        self._input_vars = [self.var_K, self.var_X, self.var_I]
+
+        self.apply_loss_and_update = _compile_function(
+            self, 'apply_loss_and_update', self._input_vars + [self.var_Y], self._loss, updates=self._updates
+        )
+        self.apply_loss = _compile_function(self, 'apply_loss', self._input_vars + [self.var_Y], self._loss)
+
+        self._proba_fn = None
+        self._representation_fn = None
+        self._evaluate_fn = None
+        self._prefetcher = None
+        self._diffusion_operators = None
+
+    def _batch_rows_source(self, X):
+        # The deep model takes the whole kernel and selects nodes in the graph.
+        return None
+
+    def _evaluation_chunk_size(self):
+        # Without sampling every call propagates over the whole graph, so chunking would only repeat the work.
+        if self._neighborhood_fanouts() is None:
+            return None
+
+        return super(DeepNodeClassificationDCNN, self)._evaluation_chunk_size()
+
+    def _batch_inputs(self, X, indices, rows=None):
+        """
+        With params.neighborhood_fanouts set, each call propagates only over the receptive field of
+        indices, num_dcnn_layers * num_hops hops deep, sampled with that many neighbors per node
+        and hop (a single integer applies to every hop; None keeps all neighbors).  This holds for
+        training steps as well as evaluation and prediction, which are fed one chunk at a time, so
+        the full kernel is never built.
+        """
+        fanouts = self._neighborhood_fanouts()
+        if fanouts is not None:
+            return self._sampled_batch_inputs(X, indices, fanouts)
+
+        return [self.K, X, indices]
+
+    def _neighborhood_fanouts(self):
+        """Returns one fanout per hop of the receptive field, or None to train on the full graph."""
+        fanouts = getattr(self.params, 'neighborhood_fanouts', None)
+        if fanouts is None or isinstance(fanouts, (list, tuple)):
+            return fanouts
+
+        return [fanouts] * (self.params.num_dcnn_layers * self.params.num_hops)
+
+    def _sampled_batch_inputs(self, X, indices, fanouts):
+        """
+        Builds the inputs of a step over the sampled receptive field of indices.
+
+        The kernel covers only the sampled nodes, and indices become their positions in it.
+        """
+        if getattr(self, '_sampling_graph', None) is None or self._sampling_graph[0] is not self.A:
+            A = sp.csr_matrix(self.A)
+            self._sampling_graph = (self.A, A, np.asarray(A.sum(0)).ravel())
+        _, A, degrees = self._sampling_graph
+
+        nodes = util.sample_neighborhood(A, indices, fanouts)
+        dtype = 'float32' if self.K is None else self.K.dtype
+        K = util.subgraph_diffusion_kernel(A, nodes, self.params.num_hops, degrees, dtype=dtype)
+
+        return [K, X[nodes], np.arange(len(indices), dtype='int32')]
 
     def _register_model_layers(self):
         features_layer = self.l_in_x
@@ -296,26 +988,6 @@ class DeepNodeClassificationDCNN(NodeClassificationDCNN):
             nonlinearity=params.nonlinearity_map[self.params.out_nonlinearity],
         )
 
-    def train_step(self, X, Y, batch_indices):
-        return self.apply_loss_and_update(
-            self.K, X, batch_indices, Y[batch_indices, :]
-        )
-
-    def validation_step(self, X, Y, valid_indices):
-        return self.apply_loss(
-            self.K, X, valid_indices, Y[valid_indices, :]
-        )
-
-    def predict(self, X, prediction_indices):
-        pred = lasagne.layers.get_output(self.l_out)
-
-        # Create a function that applies the model to data to predict a class
-        pred_fn = theano.function([self.var_K, self.var_X, self.var_I], T.argmax(pred, axis=1))
-
-        # Return the predictions
-        predictions = pred_fn(self.K, X, prediction_indices)
-
-        return predictions
 
 
 class DeepDenseNodeClassificationDCNN(NodeClassificationDCNN):
@@ -326,11 +998,7 @@ class DeepDenseNodeClassificationDCNN(NodeClassificationDCNN):
     (K, X) -> DCNN -> Dense -> Dense -> ... -> Dense -> Out
     """
     def _register_model_layers(self):
-        self.l_dcnn = layers.DCNNLayer(
-            [self.l_in_k, self.l_in_x],
-            self.params,
-            1,
-        )
+        self.l_dcnn = self._register_dcnn_layer()
 
         input = self.l_dcnn
 
@@ -357,15 +1025,46 @@ class GraphClassificationDCNN(object):
 
     (P, X) -> DCNN -> Dense -> Out
     """
+    # Whether several graphs can be packed into one zero-padded batch per step.
+    supports_graph_batches = True
+    # Whether the DCNN layers can take precomputed power series instead of adjacency matrices.
+    supports_precomputed_power_series = True
+
     def __init__(self, parameters):
         self.params = parameters
 
-        self.var_A = T.matrix('A')
-        self.var_X = T.matrix('X')
         self.var_Y = T.imatrix('Y')
 
-        self.l_in_a = lasagne.layers.InputLayer((None, None), input_var=self.var_A)
-        self.l_in_x = lasagne.layers.InputLayer((None, self.params.num_features), input_var=self.var_X)
+        if self._batch_graphs() and not self.supports_graph_batches:
+            raise NotImplementedError('%s cannot train on packed graph batches' % type(self).__name__)
+
+        # Packed batches add a leading graph axis to A and X (see util.pack_graphs).
+        batch_shape = (None,) if self._batch_graphs() else ()
+
+        if self._precompute_power_series():
+            if not self.supports_precomputed_power_series:
+                raise NotImplementedError('%s needs the adjacency matrix of every graph' % type(self).__name__)
+
+            self.var_A = T.tensor4('Apow') if self._batch_graphs() else T.tensor3('Apow')
+            self.l_in_a = lasagne.layers.InputLayer(
+                batch_shape + (self.params.num_hops + 1, None, None), input_var=self.var_A
+            )
+        else:
+            self.var_A = T.tensor3('A') if self._batch_graphs() else T.matrix('A')
+            self.l_in_a = lasagne.layers.InputLayer(batch_shape + (None, None), input_var=self.var_A)
+
+        self._graph_inputs_source = None
+        self._graph_inputs_cache = None
+
+        self.var_X = T.tensor3('X') if self._batch_graphs() else T.matrix('X')
+        self.l_in_x = lasagne.layers.InputLayer(batch_shape + (None, self.params.num_features), input_var=self.var_X)
+        self._input_vars = [self.var_A, self.var_X]
+
+        if self._batch_graphs():
+            # Node weights S: S[g, i] = 1 / n_g for the nodes of graph g, 0 for padding.
+            self.var_S = T.matrix('S')
+            self.l_in_s = lasagne.layers.InputLayer((None, None), input_var=self.var_S)
+            self._input_vars.append(self.var_S)
 
         # Overridable to customize init behavior.
         self._register_model_layers()
@@ -380,17 +1079,78 @@ class GraphClassificationDCNN(object):
         if self.params.momentum:
             self._updates = lasagne.updates.apply_momentum(self._updates, model_parameters)
 
-        self.apply_loss_and_update = theano.function([self.var_A, self.var_X, self.var_Y], loss, updates=self._updates)
-        self.apply_loss = theano.function([self.var_A, self.var_X, self.var_Y], loss)
+        self.apply_loss_and_update = _compile_function(
+            self, 'apply_loss_and_update', self._input_vars + [self.var_Y], loss, updates=self._updates
+        )
+        self.apply_loss = _compile_function(self, 'apply_loss', self._input_vars + [self.var_Y], loss)
 
         pred = lasagne.layers.get_output(self.l_out)
-        self.pred_fn = theano.function([self.var_A, self.var_X], T.argmax(pred, axis=1))
+        self.pred_fn = _compile_function(self, 'pred_fn', self._input_vars, T.argmax(pred, axis=1))
+
+        self._evaluate_fn = None
+
+    def _batch_graphs(self):
+        # Number of graphs packed into one block-diagonal graph per step; 1 trains graph by graph.
+        return getattr(self.params, 'graph_batch_size', 1) > 1
+
+    def _precompute_power_series(self):
+        # Feed each graph's power series, computed once per graph list, instead of computing it in every step.
+        return getattr(self.params, 'precompute_power_series', False)
+
+    def _preprocess_graphs(self, A):
+        """Returns what is fed to the model for each graph: A itself, or the power series of A."""
+        if not self._precompute_power_series():
+            return A
+
+        return util.precompute_power_series(
+            A, self.params.num_hops, dtype=self.var_A.dtype,
+            num_workers=getattr(self.params, 'power_series_workers', None),
+        )
+
+    def _graph_inputs(self, A):
+        """Returns _preprocess_graphs(A), computed once per list of graphs."""
+        if self._graph_inputs_source is not A:
+            self._graph_inputs_cache = self._preprocess_graphs(A)
+            self._graph_inputs_source = A
+
+        return self._graph_inputs_cache
+
+    def _step_inputs(self, a, x, s=None):
+        """Returns the inputs of the compiled functions, matching self._input_vars."""
+        return [a, x] if s is None else [a, x, s]
+
+    def _segment_incomings(self):
+        """Extra incomings for the node-aggregating layer: the node weights when batching."""
+        return [self.l_in_s] if self._batch_graphs() else []
+
+    def _graph_batches(self, A, X, Y, indices, shuffle=False):
+        """Yields (a, x, s, y) for the given graphs, one graph (s is None) or one packed batch at a time."""
+        A = self._graph_inputs(A)
+
+        if not self._batch_graphs():
+            for index in indices:
+                yield A[index], X[index], None, Y[index]
+            return
+
+        pack = util.pack_power_series if self._precompute_power_series() else util.pack_graphs
+
+        sizes = [X[index].shape[0] for index in indices]
+        for batch in util.bucket_graphs(sizes, self.params.graph_batch_size, shuffle=shuffle):
+            batch_indices = [indices[b] for b in batch]
+            a, x, s = pack(A, X, batch_indices)
+            yield a, x, s, np.vstack([Y[index] for index in batch_indices])
+
+    def _shared_variables(self):
+        """Returns the model parameters followed by the optimizer state, in a stable order."""
+        variables = lasagne.layers.get_all_params(self.l_out)
+        return variables + [v for v in self._updates if v not in variables]
 
     def _register_model_layers(self):
         self.l_dcnn = layers.AggregatedDCNNLayer(
-            [self.l_in_a, self.l_in_x],
+            [self.l_in_a, self.l_in_x] + self._segment_incomings(),
             self.params,
             1,
+            precomputed=self._precompute_power_series(),
         )
 
         self.l_out = lasagne.layers.DenseLayer(
@@ -399,35 +1159,79 @@ class GraphClassificationDCNN(object):
             nonlinearity=params.nonlinearity_map[self.params.out_nonlinearity],
         )
 
-    def train_step(self, a, x, y):
+    def train_step(self, a, x, y, s=None):
+        inputs = self._step_inputs(a, x, s)
         return self.apply_loss_and_update(
-            a, x, y
+            *(inputs + [y])
         )
 
-    def validation_step(self, a, x, y):
+    def validation_step(self, a, x, y, s=None):
+        inputs = self._step_inputs(a, x, s)
         return self.apply_loss(
-            a, x, y
+            *(inputs + [y])
         )
 
-    def fit(self, A, X, Y, train_indices, valid_indices):
+    def evaluate(self, A, X, Y, indices):
+        """
+        Computes the mean loss and the accuracy of graphs in one forward pass.
+
+        Graphs are fed one at a time, or one packed batch at a time with params.graph_batch_size,
+        to a single compiled function, and the metrics are accumulated step by step.
+
+        :return: dict with loss (the mean over graphs), accuracy and num_samples
+        """
+        if self._evaluate_fn is None:
+            self._evaluate_fn = _compile_evaluation(self)
+
+        running = _RunningMetrics()
+        for a, x, s, y in self._graph_batches(A, X, Y, indices):
+            loss, predictions, _ = self._evaluate_fn(*(self._step_inputs(a, x, s) + [y]))
+            running.update(loss, predictions, y)
+
+        return running.result()
+
+    def fit(self, A, X, Y, train_indices, valid_indices, callbacks=()):
+        """
+        Trains the model.
+
+        :param callbacks: list of callbacks.Callback, given a record after every batch and epoch
+        :return: list of the validation loss of every epoch
+        """
         print 'Training model...'
         validation_losses = []
         validation_loss_window = np.zeros(self.params.stop_window_size)
         validation_loss_window[:] = float('+inf')
 
         for epoch in range(self.params.num_epochs):
+            for callback in callbacks:
+                callback.on_epoch_start(self, epoch)
+
+            timers = callbacks_module.EpochTimers()
+
             np.random.shuffle(train_indices)
 
             train_loss = 0.0
 
-            for index in train_indices:
-                train_loss += self.train_step(A[index], X[index], Y[index])
+            # Losses are per-graph means, so weight each step by its number of graphs.
+            timers.lap()
+            for batch, (a, x, s, y) in enumerate(self._graph_batches(A, X, Y, train_indices, shuffle=True)):
+                gather_s = timers.lap('gather')
+                loss = self.train_step(a, x, y, s)
+                step_s = timers.lap('step')
+
+                train_loss += loss * y.shape[0]
+
+                for callback in callbacks:
+                    callback.on_batch_end(self, dict(
+                        epoch=epoch, batch=batch, num_samples=y.shape[0], loss=float(loss),
+                        gather_s=gather_s, step_s=step_s,
+                    ))
+                timers.lap()
             train_loss /= len(train_indices)
 
-            valid_loss = 0.0
-            for index in valid_indices:
-                valid_loss = self.validation_step(A[index], X[index], Y[index])
-            valid_loss /= len(valid_indices)
+            evaluation = self.evaluate(A, X, Y, valid_indices)
+            valid_loss = evaluation['loss']
+            timers.lap('validation')
 
             print "Epoch %d mean training error: %.6f" % (epoch, train_loss)
             print "Epoch %d mean validation error: %.6f" % (epoch, valid_loss)
@@ -435,25 +1239,26 @@ class GraphClassificationDCNN(object):
             if np.isnan(train_loss) or np.isnan(valid_loss):
                 raise ValueError
 
-            train_acc = 0.0
+            accuracies = {}
+            timers.lap()
+
             if self.params.print_train_accuracy:
-                for index in train_indices:
-                    pred = self.predict(A[index], X[index])
-                    actual = Y[index].argmax()
-                    if pred == actual:
-                        train_acc += 1.0
-                train_acc /= len(train_indices)
-                print "Epoch %d training accuracy: %.4f" % (epoch, train_acc)
-
-            valid_acc = 0.0
+                accuracies['train_accuracy'] = self.evaluate(A, X, Y, train_indices)['accuracy']
+                print "Epoch %d training accuracy: %.4f" % (epoch, accuracies['train_accuracy'])
+
             if self.params.print_valid_accuracy:
-                for index in valid_indices:
-                    pred = self.predict(A[index], X[index])
-                    actual = Y[index].argmax()
-                    if pred == actual:
-                        valid_acc += 1.0
-                valid_acc /= len(train_indices)
-                print "Epoch %d validation accuracy: %.4f" % (epoch, valid_acc)
+                # Computed by the validation pass; the forward pass is not repeated.
+                accuracies['valid_accuracy'] = evaluation['accuracy']
+                print "Epoch %d validation accuracy: %.4f" % (epoch, accuracies['valid_accuracy'])
+
+            timers.lap('accuracy')
+
+            record = timers.record(
+                epoch=epoch, num_samples=len(train_indices),
+                train_loss=float(train_loss), valid_loss=float(valid_loss), **accuracies
+            )
+            for callback in callbacks:
+                callback.on_epoch_end(self, record)
 
             validation_losses.append(valid_loss)
 
@@ -464,9 +1269,20 @@ class GraphClassificationDCNN(object):
 
             validation_loss_window[epoch % self.params.stop_window_size] = valid_loss
 
-    def predict(self, a, x):
-        # Return the predictions
-        predictions = self.pred_fn(a, x)
+        return validation_losses
+
+    def predict(self, a, x, s=None):
+        # Return the predictions, one per graph when a, x are a packed batch with node weights s
+        if self._precompute_power_series() and np.ndim(a) == 2:
+            a = util.graph_power_series(a, self.params.num_hops, dtype=self.var_A.dtype)
+
+        if s is None and self._batch_graphs():
+            # A single graph is a batch of one.
+            a, x = a[None], x[None]
+            s = np.full((1, x.shape[1]), 1.0 / x.shape[1], dtype=x.dtype)
+
+        inputs = self._step_inputs(a, x, s)
+        predictions = self.pred_fn(*inputs)
 
         return predictions
 
@@ -480,9 +1296,10 @@ class GraphClassificationFeatureAggregatedDCNN(GraphClassificationDCNN):
     """
     def _register_model_layers(self):
         self.l_dcnn = layers.AggregatedFeaturesDCNNLayer(
-            [self.l_in_a, self.l_in_x],
+            [self.l_in_a, self.l_in_x] + self._segment_incomings(),
             self.params,
             1,
+            precomputed=self._precompute_power_series(),
         )
 
         self.l_out = lasagne.layers.DenseLayer(
@@ -508,16 +1325,18 @@ class DeepGraphClassificationDCNN(GraphClassificationDCNN):
                 [self.l_in_a, features_layer],
                 self.params,
                 i + 1,
-                num_features=num_features
+                num_features=num_features,
+                precomputed=self._precompute_power_series(),
             )
             features_layer = l_dcnn
             num_features *= (self.params.num_hops + 1)
 
         l_dcnn = layers.AggregatedDCNNLayer(
-            [self.l_in_a, features_layer],
+            [self.l_in_a, features_layer] + self._segment_incomings(),
             self.params,
             i + 1,
             num_features=num_features,
+            precomputed=self._precompute_power_series(),
         )
 
         self.l_out = lasagne.layers.DenseLayer(
@@ -534,6 +1353,9 @@ class DeepGraphClassificationDCNNWithReduction(DeepGraphClassificationDCNN):
 
         (P, X) -> DCNN -> Reduction -> DCNN -> ... -> DCNN -> Dense -> Out
         """
+    # Reductions act on the whole input graph, so graphs cannot be packed together.
+    supports_graph_batches = False
+    supports_precomputed_power_series = False
 
     def _register_model_layers(self):
         graph_layer = self.l_in_a
@@ -576,6 +1398,9 @@ class DeepGraphClassificationDCNNWithKronReduction(DeepGraphClassificationDCNN):
 
         (P, X) -> DCNN -> Reduction -> DCNN -> ... -> DCNN -> Dense -> Out
         """
+    # Reductions act on the whole input graph, so graphs cannot be packed together.
+    supports_graph_batches = False
+    supports_precomputed_power_series = False
 
     def _register_model_layers(self):
         graph_layer = self.l_in_a
@@ -620,3 +1445,76 @@ class DeepGraphClassificationDCNNWithKronReduction(DeepGraphClassificationDCNN):
             nonlinearity=params.nonlinearity_map[self.params.out_nonlinearity]
         )
 
+
+class DeepGraphClassificationDCNNWithOfflineKronReduction(DeepGraphClassificationDCNN):
+    """A Deep DCNN for graph classification with Kron reductions computed ahead of training.
+
+        The reduction hierarchy of each graph (see coarsening.py) is computed once, so a step
+        only applies the precomputed reduced graphs and sparse feature projections.
+
+        (P, X) -> DCNN -> Projection -> DCNN -> ... -> DCNN -> Dense -> Out
+        """
+    # Every graph has its own hierarchy, so graphs cannot be packed together.
+    supports_graph_batches = False
+    supports_precomputed_power_series = False
+
+    def _num_levels(self):
+        return self.params.num_dcnn_layers - 1
+
+    def _register_model_layers(self):
+        graph_layers = [self.l_in_a] + [
+            lasagne.layers.InputLayer((None, None), input_var=T.matrix('A_%d' % (level + 1)))
+            for level in range(self._num_levels())
+        ]
+        projection_layers = [
+            lasagne.layers.InputLayer(
+                (None, None), input_var=theano.sparse.csr_matrix('Q_%d' % level, dtype=self.var_X.dtype)
+            )
+            for level in range(self._num_levels())
+        ]
+        self._input_vars = [l.input_var for l in graph_layers + projection_layers] + [self.var_X]
+
+        features_layer = self.l_in_x
+        num_features = self.params.num_features
+
+        for i in range(self._num_levels()):
+            l_dcnn = layers.UnaggregatedDCNNLayer(
+                [graph_layers[i], features_layer],
+                self.params,
+                i,
+                num_features=num_features
+            )
+            num_features *= (self.params.num_hops + 1)
+
+            features_layer = layers.SparseProjectionLayer([projection_layers[i], l_dcnn])
+
+        l_dcnn = layers.AggregatedDCNNLayer(
+            [graph_layers[-1], features_layer],
+            self.params,
+            self._num_levels(),
+            num_features=num_features,
+        )
+
+        self.l_out = lasagne.layers.DenseLayer(
+            l_dcnn,
+            num_units=self.params.num_classes,
+            nonlinearity=params.nonlinearity_map[self.params.out_nonlinearity]
+        )
+
+    def _coarsen(self, a):
+        return coarsening.coarsen(a, self._num_levels(), dtype=self.var_X.dtype)
+
+    def _preprocess_graphs(self, A):
+        return coarsening.precompute_hierarchies(
+            A, self._num_levels(), dtype=self.var_X.dtype,
+            num_workers=getattr(self.params, 'coarsening_workers', None),
+        )
+
+    def _step_inputs(self, a, x, s=None):
+        return list(a.A_levels) + list(a.Q_levels) + [x]
+
+    def predict(self, a, x, s=None):
+        if not isinstance(a, coarsening.GraphHierarchy):
+            a = self._coarsen(a)
+
+        return super(DeepGraphClassificationDCNNWithOfflineKronReduction, self).predict(a, x, s)
@@ -0,0 +1,388 @@
+import os
+import shutil
+import sys
+import StringIO
+import tempfile
+import unittest
+
+import numpy as np
+
+import benchmark
+import callbacks
+import checkpoint
+import inference
+import models
+
+
+def _quiet(fn, *args, **kwargs):
+    """Calls fn without the progress fit prints."""
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        sys.stdout = stdout
+
+
+class TestCompiledFunctionSharing(unittest.TestCase):
+    def setUp(self):
+        self.A, self.X, self.Y = benchmark._graph_data(benchmark.erdos_renyi_graph, 6, 8, 0.4, 3, 2, 0)
+
+    def parameters(self, **kwargs):
+        return benchmark.BenchmarkParameters(
+            num_features=3, num_classes=2, share_compiled_functions=True, **kwargs
+        )
+
+    def test_input_types_split_the_key(self):
+        variants = [{}, {'graph_batch_size': 3}, {'precompute_power_series': True, 'power_series_workers': 1}]
+
+        for kwargs in variants + variants:
+            model = models.GraphClassificationDCNN(self.parameters(**kwargs))
+            _quiet(model.fit, self.A, self.X, self.Y, np.arange(4), np.arange(4, 6))
+
+
+class TestGraphBatches(unittest.TestCase):
+    def setUp(self):
+        self.A, self.X, self.Y = benchmark._graph_data(benchmark.erdos_renyi_graph, 7, 8, 0.4, 3, 2, 0)
+        self.indices = np.arange(7)
+
+    def check_batches_match_single_graphs(self, model_class, **kwargs):
+        single = model_class(benchmark.BenchmarkParameters(num_features=3, num_classes=2, **kwargs))
+        batched = model_class(benchmark.BenchmarkParameters(num_features=3, num_classes=2, graph_batch_size=3, **kwargs))
+        for source, target in zip(single._shared_variables(), batched._shared_variables()):
+            target.set_value(source.get_value())
+
+        expected = single.evaluate(self.A, self.X, self.Y, self.indices)
+        evaluation = batched.evaluate(self.A, self.X, self.Y, self.indices)
+        self.assertTrue(np.allclose(evaluation['loss'], expected['loss']))
+        self.assertEqual(evaluation['accuracy'], expected['accuracy'])
+
+        for i in self.indices:
+            self.assertEqual(batched.predict(self.A[i], self.X[i]), single.predict(self.A[i], self.X[i]))
+
+    def test_shallow(self):
+        self.check_batches_match_single_graphs(models.GraphClassificationDCNN)
+        self.check_batches_match_single_graphs(models.GraphClassificationFeatureAggregatedDCNN)
+
+    def test_deep(self):
+        self.check_batches_match_single_graphs(models.DeepGraphClassificationDCNN, dcnn_nonlinearity='sigmoid')
+
+    def test_precomputed_power_series(self):
+        self.check_batches_match_single_graphs(
+            models.DeepGraphClassificationDCNN, precompute_power_series=True, power_series_workers=1
+        )
+
+
+class TestEvaluate(unittest.TestCase):
+    def setUp(self):
+        self.A = benchmark.community_graph(60, 0.1, seed=0)[0].toarray()
+        self.X, self.Y = benchmark._node_data(self.A, 4, 3, 0)
+        self.indices = np.random.RandomState(0).permutation(60)[:25].astype('int32')
+
+    def check_node_model(self, model_class, **kwargs):
+        np.random.seed(0)
+        model = model_class(benchmark.BenchmarkParameters(
+            num_nodes=60, num_features=4, num_classes=3, evaluation_chunk_size=7, **kwargs
+        ), self.A)
+
+        chunked = model.evaluate(self.X, self.Y, self.indices)
+        probabilities = model.predict_proba(self.X, self.indices)
+        model.params.evaluation_chunk_size = None
+        unchunked = model.evaluate(self.X, self.Y, self.indices)
+
+        # One call over every index, through the training loss function.
+        loss = model.apply_loss(*(model._batch_inputs(self.X, self.indices) + [self.Y[self.indices]]))
+        accuracy = np.mean(probabilities.argmax(1) == self.Y[self.indices].argmax(1))
+
+        for evaluation in [chunked, unchunked]:
+            self.assertTrue(np.allclose(evaluation['loss'], loss, rtol=1e-5))
+            np.testing.assert_allclose(evaluation['probabilities'], probabilities, rtol=1e-5, atol=1e-7)
+            np.testing.assert_array_equal(evaluation['predictions'], probabilities.argmax(1))
+            self.assertAlmostEqual(evaluation['accuracy'], accuracy)
+            self.assertEqual(evaluation['num_samples'], len(self.indices))
+
+    def test_dense(self):
+        self.check_node_model(models.NodeClassificationDCNN)
+
+    def test_csr(self):
+        self.check_node_model(models.NodeClassificationDCNN, kernel_backend='csr')
+
+    def test_lazy(self):
+        self.check_node_model(models.PostSparseNodeClassificationDCNN, kernel_backend='lazy', diffusion_threshold=0.05)
+
+    def test_diffusion_features(self):
+        self.check_node_model(models.NodeClassificationDCNN, diffusion_features=True)
+
+    def test_true_sparse(self):
+        self.check_node_model(models.TrueSparseNodeClassificationDCNN)
+
+    def test_deep(self):
+        self.check_node_model(models.DeepNodeClassificationDCNN)
+        self.check_node_model(models.DeepDenseNodeClassificationDCNN)
+
+    def test_graph_model(self):
+        A, X, Y = benchmark._graph_data(benchmark.erdos_renyi_graph, 9, 8, 0.4, 3, 2, 0)
+        indices = np.arange(9)
+
+        for kwargs in [{}, {'graph_batch_size': 4}]:
+            model = models.GraphClassificationDCNN(benchmark.BenchmarkParameters(num_features=3, num_classes=2, **kwargs))
+            evaluation = model.evaluate(A, X, Y, indices)
+
+            single = models.GraphClassificationDCNN(benchmark.BenchmarkParameters(num_features=3, num_classes=2))
+            for source, target in zip(model._shared_variables(), single._shared_variables()):
+                target.set_value(source.get_value())
+
+            losses = [single.validation_step(A[i], X[i], Y[i]) for i in indices]
+            predictions = [single.predict(A[i], X[i])[0] for i in indices]
+
+            self.assertTrue(np.allclose(evaluation['loss'], np.mean(losses), rtol=1e-5))
+            labels = [np.argmax(Y[i]) for i in indices]
+            self.assertAlmostEqual(evaluation['accuracy'], np.mean(np.asarray(predictions) == labels))
+            self.assertEqual(evaluation['num_samples'], 9)
+
+
+class TestTrueSparseModel(unittest.TestCase):
+    def setUp(self):
+        self.A = benchmark.community_graph(60, 0.1, seed=0)[0].toarray()
+        self.X, self.Y = benchmark._node_data(self.A, 4, 3, 0)
+
+        indices = np.random.RandomState(0).permutation(60)
+        self.train_indices, self.valid_indices = indices[:40], indices[40:]
+
+    def test_matches_dense_model(self):
+        parameters = benchmark.BenchmarkParameters(
+            num_nodes=60, num_features=4, num_classes=3, num_epochs=5, batch_size=10
+        )
+        dense = models.NodeClassificationDCNN(parameters, self.A)
+        sparse = models.TrueSparseNodeClassificationDCNN(parameters, self.A)
+        for source, target in zip(dense._shared_variables(), sparse._shared_variables()):
+            target.set_value(source.get_value())
+
+        indices = np.arange(60)
+        initial = sparse.predict_proba(self.X, indices)
+        np.testing.assert_allclose(initial, dense.predict_proba(self.X, indices), rtol=1e-4, atol=1e-6)
+
+        validation_losses = []
+        for model in [dense, sparse]:
+            np.random.seed(1)
+            validation_losses.append(_quiet(model.fit, self.X, self.Y, self.train_indices.copy(), self.valid_indices))
+
+        self.assertTrue(np.isfinite(validation_losses[1]).all())
+        np.testing.assert_allclose(validation_losses[1], validation_losses[0], rtol=1e-4)
+
+        probabilities = sparse.predict_proba(self.X, indices)
+        self.assertFalse(np.allclose(probabilities, initial))
+        np.testing.assert_allclose(probabilities, dense.predict_proba(self.X, indices), rtol=1e-4, atol=1e-6)
+        np.testing.assert_array_equal(sparse.predict(self.X, indices), dense.predict(self.X, indices))
+
+
+class TestSampledDeepModel(unittest.TestCase):
+    def setUp(self):
+        self.A = benchmark.community_graph(60, 0.1, seed=0)[0].toarray()
+        self.X, self.Y = benchmark._node_data(self.A, 4, 3, 0)
+
+    def parameters(self, **kwargs):
+        return benchmark.BenchmarkParameters(
+            num_nodes=60, num_features=4, num_classes=3, num_hops=1, num_dcnn_layers=2, num_epochs=2,
+            batch_size=10, evaluation_chunk_size=7, **kwargs
+        )
+
+    def test_full_fanouts_match_full_kernel(self):
+        full = models.DeepNodeClassificationDCNN(self.parameters(), self.A)
+        # Fanouts of None keep every neighbor, so each chunk's receptive field is exact.
+        sampled = models.DeepNodeClassificationDCNN(self.parameters(neighborhood_fanouts=[None, None]), self.A)
+        for source, target in zip(full._shared_variables(), sampled._shared_variables()):
+            target.set_value(source.get_value())
+
+        indices = np.random.RandomState(0).permutation(60)[:30].astype('int32')
+        expected = full.evaluate(self.X, self.Y, indices)
+        evaluation = sampled.evaluate(self.X, self.Y, indices)
+
+        self.assertTrue(np.allclose(evaluation['loss'], expected['loss'], atol=1e-5))
+        np.testing.assert_allclose(evaluation['probabilities'], expected['probabilities'], rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(
+            sampled.predict_proba(self.X, indices), full.predict_proba(self.X, indices), rtol=1e-4, atol=1e-6
+        )
+
+    def test_no_full_kernel(self):
+        model = models.DeepNodeClassificationDCNN(self.parameters(neighborhood_fanouts=2), self.A)
+        self.assertTrue(model.K is None)
+
+        indices = np.random.RandomState(0).permutation(60)
+        validation_losses = _quiet(model.fit, self.X, self.Y, indices[:40], indices[40:])
+
+        self.assertEqual(len(validation_losses), 2)
+        self.assertTrue(np.isfinite(validation_losses).all())
+        self.assertEqual(model.predict(self.X, indices[40:]).shape, (20,))
+
+
+class TestEdgeUpdates(unittest.TestCase):
+    def setUp(self):
+        self.A = benchmark.community_graph(40, 0.1, seed=0)[0].toarray()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_update_matches_rebuild(self, model_class, **kwargs):
+        parameters = benchmark.BenchmarkParameters(
+            num_nodes=40, num_features=4, num_classes=3, diffusion_threshold=0.05, **kwargs
+        )
+        model = model_class(parameters, self.A)
+
+        A = self.A.copy()
+        for insertions, deletions in [([(0, 39), (3, 20)], []), ([(5, 6)], [(0, 39)])]:
+            model.update_edges(insertions, deletions)
+            for u, v in insertions:
+                A[u, v] = A[v, u] = 1.0
+            for u, v in deletions:
+                A[u, v] = A[v, u] = 0.0
+
+        parameters.kernel_cache_dir = None
+        expected = model_class(parameters, A).K
+        self.assertTrue(np.allclose(model.K[:, :, :], expected[:, :, :], atol=1e-6))
+
+    def test_cached_kernel(self):
+        self.check_update_matches_rebuild(models.NodeClassificationDCNN, kernel_cache_dir=self.directory)
+        self.check_update_matches_rebuild(models.PreSparseNodeClassificationDCNN, kernel_cache_dir=self.directory)
+
+        # The cached kernel of the original graph is left as it was.
+        parameters = benchmark.BenchmarkParameters(num_nodes=40, num_features=4, num_classes=3)
+        cached = models.NodeClassificationDCNN(parameters, self.A).K
+        parameters.kernel_cache_dir = self.directory
+        self.assertTrue(np.array_equal(models.NodeClassificationDCNN(parameters, self.A).K, cached))
+
+    def test_push_backend(self):
+        for model_class in [models.PostSparseNodeClassificationDCNN, models.PreSparseNodeClassificationDCNN]:
+            self.check_update_matches_rebuild(model_class, kernel_backend='push', diffusion_top_k=3)
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class _InterruptAt(callbacks.Callback):
+    """Stops training at the start of an epoch, as if the job had been killed."""
+    def __init__(self, epoch):
+        self.epoch = epoch
+
+    def on_epoch_start(self, model, epoch):
+        if epoch == self.epoch:
+            raise _Interrupted()
+
+
+class TestCheckpointResume(unittest.TestCase):
+    def setUp(self):
+        self.A = benchmark.community_graph(60, 0.1, seed=0)[0].toarray()
+        self.X, self.Y = benchmark._node_data(self.A, 4, 3, 0)
+
+        indices = np.random.RandomState(0).permutation(60)
+        self.train_indices, self.valid_indices = indices[:40], indices[40:]
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checkpoint.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build_model(self, **kwargs):
+        np.random.seed(0)
+        parameters = dict(
+            num_nodes=60, num_features=4, num_classes=3, num_epochs=4, batch_size=10, stop_early=False,
+            update_fn='adam',
+        )
+        parameters.update(kwargs)
+        return models.NodeClassificationDCNN(benchmark.BenchmarkParameters(**parameters), self.A)
+
+    def fit(self, model, callbacks=()):
+        return _quiet(model.fit, self.X, self.Y, self.train_indices.copy(), self.valid_indices, callbacks)
+
+    def weights(self, model):
+        return [v.get_value() for v in model._shared_variables()]
+
+    def test_interrupted_run_resumes_exactly(self):
+        expected_model = self.build_model()
+        np.random.seed(1)
+        expected = self.fit(expected_model)
+
+        model = self.build_model(checkpoint_path=self.path)
+        np.random.seed(1)
+        self.assertRaises(_Interrupted, self.fit, model, [_InterruptAt(2)])
+
+        # A new process: fresh weights and RNG, restored from the checkpoint of epoch 1.
+        model = self.build_model(checkpoint_path=self.path)
+        np.random.seed(2)
+        validation_losses = self.fit(model)
+
+        np.testing.assert_allclose(validation_losses, expected, rtol=1e-5)
+        for weights, expected_weights in zip(self.weights(model), self.weights(expected_model)):
+            np.testing.assert_allclose(weights, expected_weights, rtol=1e-5, atol=1e-7)
+
+    def test_finished_run_is_refused(self):
+        self.fit(self.build_model(checkpoint_path=self.path))
+
+        model = self.build_model(checkpoint_path=self.path)
+        weights = self.weights(model)
+        self.assertRaises(ValueError, self.fit, model)
+        self.assertTrue(all((a == b).all() for a, b in zip(self.weights(model), weights)))
+
+        # More epochs continue the finished run.
+        model = self.build_model(checkpoint_path=self.path, num_epochs=5)
+        self.assertEqual(len(self.fit(model)), 5)
+
+    def test_mismatched_model_is_refused(self):
+        model = self.build_model(checkpoint_path=self.path)
+        self.assertRaises(_Interrupted, self.fit, model, [_InterruptAt(1)])
+
+        self.assertRaises(ValueError, self.fit, self.build_model(checkpoint_path=self.path, num_hops=1))
+
+        # Checkpoints without a config still have their variable shapes checked.
+        arrays = checkpoint.read(self.path)
+        del arrays['config']
+        arrays['variable_0'] = np.zeros(arrays['variable_0'].shape + (1,), dtype=arrays['variable_0'].dtype)
+        checkpoint.write(self.path, arrays)
+        self.assertRaises(ValueError, self.build_model().load_checkpoint, self.path)
+
+    def test_checkpoint_without_loop_state_is_refused(self):
+        self.build_model().save_checkpoint(self.path)
+
+        model = self.build_model(checkpoint_path=self.path)
+        weights = self.weights(model)
+        with self.assertRaises(ValueError) as context:
+            self.fit(model)
+        self.assertTrue(self.path in str(context.exception))
+        self.assertTrue(all((a == b).all() for a, b in zip(self.weights(model), weights)))
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.A = benchmark.community_graph(60, 0.1, seed=0)[0].toarray()
+        self.X, self.Y = benchmark._node_data(self.A, 4, 3, 0)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_export_matches(self, model_class, **kwargs):
+        np.random.seed(0)
+        model = model_class(benchmark.BenchmarkParameters(
+            num_nodes=60, num_features=4, num_classes=3, diffusion_threshold=0.05, **kwargs
+        ), self.A)
+
+        path = os.path.join(self.directory, 'model.npz')
+        model.export(path)
+        exported = inference.load(path)
+        exported.set_graph(self.A, self.X)
+
+        indices = np.arange(60)
+        np.testing.assert_allclose(
+            exported.predict_proba(indices), model.predict_proba(self.X, indices), rtol=1e-4, atol=1e-5
+        )
+
+    def test_push_backend(self):
+        for model_class in [models.PostSparseNodeClassificationDCNN, models.PreSparseNodeClassificationDCNN]:
+            self.check_export_matches(model_class, kernel_backend='push', diffusion_top_k=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
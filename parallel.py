@@ -0,0 +1,323 @@
+import argparse
+import json
+import multiprocessing
+import select
+import sys
+import time
+
+import lasagne
+import numpy as np
+import theano
+import theano.tensor as T
+
+import params
+
+
+class DataParallelTrainer(object):
+    """Data-parallel training of a node classification DCNN across worker processes.
+
+    Workers are forked after the model is built, so the kernel, the features and the compiled
+    gradient function are shared copy-on-write instead of being copied.  Model parameters and
+    gradients travel through shared memory; only batch indices and losses go through pipes.
+
+    Two modes are supported:
+
+    'sync'    Each round, every worker computes the gradient of a disjoint mini-batch.  The
+              gradients are averaged (weighted by batch size) and applied once with the model's
+              update_fn, then the new parameters are published to the workers.
+    'hogwild' Workers apply plain SGD steps (learning_rate * gradient) directly to the shared
+              parameters without locking, each pulling the next batch as soon as it is done.
+              Only models with update_fn 'sgd' and no momentum can be trained this way.
+
+    Requires a platform where multiprocessing forks (e.g. Linux).
+    """
+    def __init__(self, model, num_workers, mode='sync'):
+        if mode not in ('sync', 'hogwild'):
+            raise ValueError('unknown mode %r' % mode)
+        if mode == 'hogwild' and (model.params.update_fn != 'sgd' or model.params.momentum):
+            raise ValueError('hogwild applies plain SGD steps; got update_fn=%r, momentum=%r' % (
+                model.params.update_fn, model.params.momentum
+            ))
+
+        self.model = model
+        self.num_workers = num_workers
+        self.mode = mode
+
+        self._parameters = lasagne.layers.get_all_params(model.l_out)
+        self._shapes = [p.get_value(borrow=True).shape for p in self._parameters]
+        self._offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in self._shapes])
+
+        grads = T.grad(model._loss, self._parameters)
+        self._loss_and_grads = theano.function(model._input_vars + [model.var_Y], [model._loss] + grads)
+
+        # Master-side update from averaged gradients, with its own optimizer state.
+        grad_vars = [p.type() for p in self._parameters]
+        update_fn = params.update_map[model.params.update_fn]
+        updates = update_fn(grad_vars, self._parameters, learning_rate=model.params.learning_rate)
+        if model.params.momentum:
+            updates = lasagne.updates.apply_momentum(updates, self._parameters)
+        self._apply_grads = theano.function(grad_vars, [], updates=updates)
+
+        self._dtype = self._parameters[0].get_value(borrow=True).dtype
+        typecode = 'f' if self._dtype == np.float32 else 'd'
+        self._shared_parameters = self._as_array(multiprocessing.RawArray(typecode, int(self._offsets[-1])))
+        self._shared_grads = self._as_array(
+            multiprocessing.RawArray(typecode, int(self._offsets[-1]) * num_workers)
+        ).reshape(num_workers, -1)
+
+        self._workers = []
+        self._connections = []
+
+        # Training time of every epoch of the last fit, in seconds.
+        self.epoch_times = []
+
+    def _as_array(self, raw):
+        return np.frombuffer(raw, dtype=self._dtype)
+
+    def _flatten(self, values, out):
+        for i, value in enumerate(values):
+            out[self._offsets[i]:self._offsets[i + 1]] = np.ravel(value)
+
+    def _publish_parameters(self):
+        self._flatten([p.get_value(borrow=True) for p in self._parameters], self._shared_parameters)
+
+    def _load_parameters(self):
+        for i, p in enumerate(self._parameters):
+            p.set_value(self._shared_parameters[self._offsets[i]:self._offsets[i + 1]].reshape(self._shapes[i]))
+
+    def _worker_loop(self, worker, connection, X, Y):
+        learning_rate = self.model.params.learning_rate
+
+        while True:
+            batch_indices = connection.recv()
+            if batch_indices is None:
+                break
+
+            self._load_parameters()
+
+            inputs = self.model._batch_inputs(X, batch_indices) + [Y[batch_indices, :]]
+            outputs = self._loss_and_grads(*inputs)
+
+            if self.mode == 'sync':
+                self._flatten(outputs[1:], self._shared_grads[worker])
+            else:
+                for i, grad in enumerate(outputs[1:]):
+                    self._shared_parameters[self._offsets[i]:self._offsets[i + 1]] -= learning_rate * np.ravel(grad)
+
+            connection.send(float(outputs[0]))
+
+        connection.close()
+
+    def _start_workers(self, X, Y):
+        self._publish_parameters()
+
+        # Compute the diffusion features (if the model uses them) before forking, so the workers
+        # share one copy instead of each computing its own.
+        self.model._batch_rows_source(X)
+
+        for worker in range(self.num_workers):
+            master_end, worker_end = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=self._worker_loop, args=(worker, worker_end, X, Y))
+            process.daemon = True
+            process.start()
+
+            self._workers.append(process)
+            self._connections.append(master_end)
+
+    def _stop_workers(self):
+        for connection in self._connections:
+            connection.send(None)
+        for process in self._workers:
+            process.join()
+
+        self._workers = []
+        self._connections = []
+
+    def _train_epoch_sync(self, batches):
+        train_loss = 0.0
+
+        for start in range(0, len(batches), self.num_workers):
+            round_batches = batches[start:start + self.num_workers]
+
+            for connection, batch_indices in zip(self._connections, round_batches):
+                connection.send(batch_indices)
+
+            losses = [connection.recv() for connection in self._connections[:len(round_batches)]]
+            train_loss += sum(losses)
+
+            weights = np.asarray([len(b) for b in round_batches], dtype=self._dtype)
+            mean_grad = np.dot(weights / weights.sum(), self._shared_grads[:len(round_batches)])
+
+            self._apply_grads(*[
+                mean_grad[self._offsets[i]:self._offsets[i + 1]].reshape(self._shapes[i])
+                for i in range(len(self._parameters))
+            ])
+            self._publish_parameters()
+
+        return train_loss
+
+    def _train_epoch_hogwild(self, batches):
+        train_loss = 0.0
+
+        pending = list(reversed(batches))
+        busy = []
+        for connection in self._connections:
+            if pending:
+                connection.send(pending.pop())
+                busy.append(connection)
+
+        while busy:
+            ready, _, _ = select.select(busy, [], [])
+            for connection in ready:
+                train_loss += connection.recv()
+                if pending:
+                    connection.send(pending.pop())
+                else:
+                    busy.remove(connection)
+
+        self._load_parameters()
+
+        return train_loss
+
+    def fit(self, X, Y, train_indices, valid_indices):
+        """Trains the model like NodeClassificationDCNN.fit, spreading batches over the workers."""
+        model = self.model
+        num_nodes = X.shape[0]
+
+        self._start_workers(X, Y)
+
+        try:
+            print 'Training model with %d %s workers...' % (self.num_workers, self.mode)
+            validation_losses = []
+            validation_loss_window = np.zeros(model.params.stop_window_size)
+            validation_loss_window[:] = float('+inf')
+            self.epoch_times = []
+
+            for epoch in range(model.params.num_epochs):
+                epoch_start = time.time()
+
+                np.random.shuffle(train_indices)
+
+                num_batch = num_nodes // model.params.batch_size
+
+                batches = []
+                for batch in range(num_batch):
+                    start = batch * model.params.batch_size
+                    end = min((batch + 1) * model.params.batch_size, train_indices.shape[0])
+
+                    if start < end:
+                        batches.append(train_indices[start:end])
+
+                if self.mode == 'sync':
+                    train_loss = self._train_epoch_sync(batches)
+                else:
+                    train_loss = self._train_epoch_hogwild(batches)
+
+                train_loss /= num_batch
+
+                epoch_time = time.time() - epoch_start
+                self.epoch_times.append(epoch_time)
+
+                valid_loss = model.validation_step(X, Y, valid_indices)
+
+                print "Epoch %d mean training error: %.6f" % (epoch, train_loss)
+                print "Epoch %d validation error: %.6f" % (epoch, valid_loss)
+                print "Epoch %d training time: %.3fs" % (epoch, epoch_time)
+
+                validation_losses.append(valid_loss)
+
+                if model.params.stop_early:
+                    if valid_loss >= validation_loss_window.mean():
+                        print 'Validation loss did not decrease. Stopping early.'
+                        break
+
+                validation_loss_window[epoch % model.params.stop_window_size] = valid_loss
+        finally:
+            self._stop_workers()
+
+        return validation_losses
+
+
+def scaling_report(build_model, X, Y, train_indices, valid_indices, worker_counts=(1, 2, 4),
+                   modes=('sync', 'hogwild'), log=sys.stderr):
+    """
+    Measures the epoch time of DataParallelTrainer across numbers of workers.
+
+    The first epoch of every run is left out of the mean, as it includes starting the workers.
+
+    :param build_model: function of the mode returning a freshly initialized model, e.g. with
+                        update_fn 'sgd' for hogwild
+    :param worker_counts: list of integers, numbers of workers to try
+    :param modes: list of 'sync' and / or 'hogwild'
+    :return: list of records with mode, num_workers, epoch_s, speedup (relative to the
+             smallest number of workers of the mode) and final valid_loss
+    """
+    records = []
+    for mode in modes:
+        baseline = None
+        for num_workers in worker_counts:
+            model = build_model(mode)
+            trainer = DataParallelTrainer(model, num_workers, mode=mode)
+            validation_losses = trainer.fit(X, Y, train_indices.copy(), valid_indices)
+
+            times = trainer.epoch_times[1:] or trainer.epoch_times
+            epoch_s = float(np.mean(times))
+            if baseline is None:
+                baseline = epoch_s
+
+            record = dict(
+                mode=mode, num_workers=num_workers, epoch_s=epoch_s, speedup=baseline / epoch_s,
+                valid_loss=float(validation_losses[-1]),
+            )
+            records.append(record)
+
+            log.write('%-8s workers=%-3d epoch_s=%.3f speedup=%.2f valid_loss=%.6f\n' % (
+                mode, num_workers, epoch_s, record['speedup'], record['valid_loss']
+            ))
+
+    return records
+
+
+def main(argv=None):
+    import benchmark
+    import models
+
+    parser = argparse.ArgumentParser(description='Report the epoch-time scaling of data-parallel training.')
+    parser.add_argument('--model', default='NodeClassificationDCNN')
+    parser.add_argument('--graph', default='community', choices=sorted(benchmark.graph_generator_map))
+    parser.add_argument('--num-nodes', type=int, default=5000)
+    parser.add_argument('--density', type=float, default=0.002)
+    parser.add_argument('--num-features', type=int, default=16)
+    parser.add_argument('--num-classes', type=int, default=4)
+    parser.add_argument('--num-epochs', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--modes', nargs='+', default=['sync', 'hogwild'], choices=['sync', 'hogwild'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='parallel_scaling.json')
+    args = parser.parse_args(argv)
+
+    A = benchmark.graph_generator_map[args.graph](args.num_nodes, args.density, seed=args.seed).toarray()
+    X, Y = benchmark._node_data(A, args.num_features, args.num_classes, args.seed)
+
+    indices = np.random.RandomState(args.seed).permutation(args.num_nodes).astype('int32')
+    train_indices = indices[:args.num_nodes // 2]
+    valid_indices = indices[args.num_nodes // 2:]
+
+    def build_model(mode):
+        np.random.seed(args.seed)
+        parameters = benchmark.BenchmarkParameters(
+            num_nodes=args.num_nodes, num_features=args.num_features, num_classes=args.num_classes,
+            num_epochs=args.num_epochs, batch_size=args.batch_size,
+            update_fn='sgd' if mode == 'hogwild' else 'adam',
+        )
+        return getattr(models, args.model)(parameters, A)
+
+    results = scaling_report(build_model, X, Y, train_indices, valid_indices, args.workers, args.modes)
+
+    with open(args.output, 'w') as f:
+        json.dump({'config': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
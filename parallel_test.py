@@ -0,0 +1,85 @@
+import StringIO
+import sys
+import unittest
+
+import lasagne
+import numpy as np
+
+import benchmark
+import models
+import parallel
+
+
+class TestDataParallelTrainer(unittest.TestCase):
+    def setUp(self):
+        self.A = benchmark.community_graph(80, 0.1, seed=0)[0].toarray()
+        self.X, self.Y = benchmark._node_data(self.A, 4, 3, 0)
+
+        indices = np.random.RandomState(0).permutation(80).astype('int32')
+        self.train_indices = indices[:40]
+        self.valid_indices = indices[40:]
+
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def build_model(self, **kwargs):
+        np.random.seed(0)
+        parameters = benchmark.BenchmarkParameters(
+            num_nodes=80, num_features=4, num_classes=3, num_epochs=2, batch_size=10, **kwargs
+        )
+        return models.NodeClassificationDCNN(parameters, self.A)
+
+    def weights(self, model):
+        return [p.get_value() for p in lasagne.layers.get_all_params(model.l_out)]
+
+    def test_sync_single_worker_matches_fit(self):
+        model = self.build_model(update_fn='sgd')
+        np.random.seed(1)
+        expected = model.fit(self.X, self.Y, self.train_indices.copy(), self.valid_indices)
+
+        model = self.build_model(update_fn='sgd')
+        np.random.seed(1)
+        validation_losses = parallel.DataParallelTrainer(model, 1).fit(
+            self.X, self.Y, self.train_indices.copy(), self.valid_indices
+        )
+
+        self.assertTrue(np.allclose(validation_losses, expected, atol=1e-5))
+
+    def test_workers_train(self):
+        for mode in ['sync', 'hogwild']:
+            model = self.build_model(update_fn='sgd', diffusion_features=True)
+            trainer = parallel.DataParallelTrainer(model, 2, mode=mode)
+            before = self.weights(model)
+
+            validation_losses = trainer.fit(self.X, self.Y, self.train_indices.copy(), self.valid_indices)
+
+            self.assertEqual(len(validation_losses), 2)
+            self.assertEqual(len(trainer.epoch_times), 2)
+            self.assertTrue(np.isfinite(validation_losses).all())
+            self.assertFalse(all(np.allclose(a, b) for a, b in zip(before, self.weights(model))))
+
+            # The features were computed once, in the master, before the workers were forked.
+            self.assertTrue(model._diffusion_features_source is self.X)
+
+    def test_hogwild_rejects_adaptive_updates(self):
+        self.assertRaises(ValueError, parallel.DataParallelTrainer, self.build_model(update_fn='adam'), 2, 'hogwild')
+        self.assertRaises(
+            ValueError, parallel.DataParallelTrainer, self.build_model(update_fn='sgd', momentum=True), 2, 'hogwild'
+        )
+
+    def test_scaling_report(self):
+        records = parallel.scaling_report(
+            lambda mode: self.build_model(update_fn='sgd'), self.X, self.Y, self.train_indices,
+            self.valid_indices, worker_counts=(1, 2), log=StringIO.StringIO(),
+        )
+
+        self.assertEqual([(r['mode'], r['num_workers']) for r in records],
+                         [('sync', 1), ('sync', 2), ('hogwild', 1), ('hogwild', 2)])
+        self.assertEqual([r['speedup'] for r in records if r['num_workers'] == 1], [1.0, 1.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
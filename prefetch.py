@@ -0,0 +1,144 @@
+import multiprocessing
+import pickle
+import sys
+import threading
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+import util
+
+
+# Seconds between checks that the producer is still alive while waiting for a batch.
+POLL_INTERVAL = 0.1
+
+
+class BatchPrefetcher(object):
+    """Gathers the kernel rows of upcoming batches while the current step runs.
+
+    Rows are gathered into a fixed set of preallocated buffers that are recycled once the
+    consumer moves on, so no new (batch, num_hops + 1, N) array is allocated per step.  At most
+    depth batches are gathered ahead of the one being consumed.  The buffers are kept for the
+    life of the prefetcher: iterate can be called once per epoch with that epoch's batches, and
+    they are only reallocated if a batch is larger than any before.
+
+    With use_process=False the gather runs in a thread; with use_process=True it runs in a forked
+    process writing into shared-memory buffers, which also overlaps with Theano steps that hold
+    the GIL.  An exception raised while gathering is re-raised by the consumer.
+
+    Iterating yields (batch_indices, rows) in the order of batches.  rows is only valid until
+    the next item is requested.
+    """
+    def __init__(self, source, batches=(), depth=2, use_process=False, max_rows=None):
+        self.source = source
+        self.batches = batches
+        self.depth = depth
+        self.use_process = use_process
+
+        self._buffers = []
+        self._max_rows = 0
+        self._allocate(max(max_rows or 0, max([len(batch) for batch in batches] or [0])))
+
+    def _allocate(self, max_rows):
+        if max_rows <= self._max_rows and self._buffers:
+            return
+
+        row_shape = tuple(self.source.shape[1:])
+        num_buffers = self.depth + 1
+
+        if self.use_process:
+            # Sized in bytes, so every dtype (float16 included) gets exactly the buffer it needs.
+            itemsize = self.source.dtype.itemsize
+            size = max_rows * int(np.prod(row_shape))
+            self._buffers = [
+                np.frombuffer(multiprocessing.RawArray('b', max(size, 1) * itemsize), dtype=self.source.dtype)[:size].reshape(
+                    (max_rows,) + row_shape
+                )
+                for _ in range(num_buffers)
+            ]
+        else:
+            self._buffers = [np.empty((max_rows,) + row_shape, dtype=self.source.dtype) for _ in range(num_buffers)]
+
+        self._max_rows = max_rows
+
+    def _failure(self):
+        """Returns the exception being handled, in a form that can be put on the ready queue."""
+        error = sys.exc_info()[1]
+        if not self.use_process:
+            return error
+
+        try:
+            pickle.dumps(error)
+            return error
+        except Exception:
+            return RuntimeError('prefetching failed:\n' + traceback.format_exc())
+
+    def _produce(self, batches):
+        try:
+            for batch_indices in batches:
+                i = self._free.get()
+                if i is None:
+                    return
+
+                util.gather_rows(self.source, batch_indices, out=self._buffers[i][:len(batch_indices)])
+                self._ready.put(i)
+        except Exception:
+            self._ready.put(self._failure())
+
+    def _next_ready(self, worker):
+        while True:
+            try:
+                item = self._ready.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if worker.is_alive():
+                    continue
+                try:
+                    # The producer may have finished its last put just before exiting.
+                    item = self._ready.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    raise RuntimeError('the prefetching %s exited without producing a batch' % (
+                        'process' if self.use_process else 'thread'
+                    ))
+
+            if isinstance(item, BaseException):
+                raise item
+
+            return item
+
+    def iterate(self, batches):
+        """Yields (batch_indices, rows) for batches, reusing the buffers of earlier iterations."""
+        self._allocate(max([len(batch) for batch in batches] or [0]))
+
+        # Fresh queues, so nothing left over from an iteration that stopped early is seen.
+        if self.use_process:
+            self._free = multiprocessing.Queue()
+            self._ready = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=self._produce, args=(batches,))
+        else:
+            self._free = queue.Queue()
+            self._ready = queue.Queue()
+            worker = threading.Thread(target=self._produce, args=(batches,))
+
+        for i in range(len(self._buffers)):
+            self._free.put(i)
+
+        worker.daemon = True
+        worker.start()
+
+        try:
+            for batch_indices in batches:
+                i = self._next_ready(worker)
+                yield batch_indices, self._buffers[i][:len(batch_indices)]
+                self._free.put(i)
+        finally:
+            # Unblock the producer if iteration stopped early.
+            self._free.put(None)
+            worker.join()
+
+    def __iter__(self):
+        return self.iterate(self.batches)
@@ -0,0 +1,82 @@
+import unittest
+
+import numpy as np
+
+import prefetch
+import util
+
+
+class TestBatchPrefetcher(unittest.TestCase):
+    def setUp(self):
+        A = np.asarray([
+            [0.0, 1.0, 1.0, 0.0],
+            [1.0, 0.0, 0.0, 0.0],
+            [1.0, 0.0, 0.0, 1.0],
+            [0.0, 0.0, 1.0, 0.0],
+        ])
+
+        self.K = util.A_to_diffusion_kernel(A, 2).astype('float32')
+        self.batches = [np.asarray([3, 0]), np.asarray([1]), np.asarray([2, 1, 0])]
+
+    def check_batches(self, source, **kwargs):
+        seen = []
+        for batch_indices, rows in prefetch.BatchPrefetcher(source, self.batches, **kwargs):
+            np.testing.assert_allclose(rows, self.K[batch_indices])
+            seen.append(batch_indices)
+
+        self.assertEqual(len(seen), len(self.batches))
+
+    def test_dense_thread(self):
+        self.check_batches(self.K, depth=2)
+
+    def test_dense_process(self):
+        self.check_batches(self.K, depth=1, use_process=True)
+
+    def test_float16_process(self):
+        K = self.K.astype('float16')
+        prefetcher = prefetch.BatchPrefetcher(K, self.batches, depth=1, use_process=True)
+
+        # The shared buffers hold float16 rows, not float64 ones.
+        for buffer in prefetcher._buffers:
+            self.assertEqual(np.frombuffer(buffer.base, dtype='b').nbytes, buffer.nbytes)
+
+        for batch_indices, rows in prefetcher:
+            np.testing.assert_array_equal(rows, K[batch_indices])
+
+    def test_csr_kernel(self):
+        self.check_batches(util.CSRDiffusionKernel(list(self.K.transpose(1, 0, 2))), depth=2)
+
+    def test_buffers_kept_across_iterations(self):
+        prefetcher = prefetch.BatchPrefetcher(self.K, depth=1, max_rows=3)
+        buffers = list(prefetcher._buffers)
+
+        for batches in [self.batches, self.batches[::-1]]:
+            for batch_indices, rows in prefetcher.iterate(batches):
+                np.testing.assert_allclose(rows, self.K[batch_indices])
+                self.assertTrue(any(np.may_share_memory(rows, buffer) for buffer in buffers))
+
+    def check_producer_error(self, **kwargs):
+        # The second batch is out of range, so gathering it raises in the producer.
+        batches = [self.batches[0], np.asarray([len(self.K)]), self.batches[2]]
+        prefetcher = prefetch.BatchPrefetcher(self.K, batches, **kwargs)
+
+        seen = []
+        with self.assertRaises(IndexError):
+            for batch_indices, rows in prefetcher:
+                seen.append(batch_indices)
+
+        self.assertEqual(len(seen), 1)
+
+    def test_producer_error_thread(self):
+        self.check_producer_error(depth=2)
+
+    def test_producer_error_process(self):
+        self.check_producer_error(depth=1, use_process=True)
+
+    def test_early_stop(self):
+        for batch_indices, rows in prefetch.BatchPrefetcher(self.K, self.batches, depth=1):
+            break
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+"""
+Diversity-aware top-k re-ranking of recommendation candidates.
+
+Each user has a row of candidate items and their relevance scores, e.g. class probabilities
+from NodeClassificationDCNN.predict_proba, and every item has a representation, e.g. from
+NodeClassificationDCNN.representations.  Both re-rankers select k items per user greedily.
+Each step is vectorized across a block of users, so Python only loops over the k steps:
+
+    mmr     maximal marginal relevance: trade_off * relevance - (1 - trade_off) * the maximum
+            cosine similarity to the items already selected
+    dpp     greedy MAP inference for a determinantal point process with kernel
+            L = diag(q) S diag(q), q = exp(alpha * relevance), S the cosine similarities,
+            using incremental Cholesky updates (Chen et al., 2018)
+
+    lists = rerank.rerank(scores, items, 10, method='mmr', candidates=candidates)
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+
+# Users re-ranked together; bounds the (users, candidates, dimensions) blocks held in memory.
+DEFAULT_BLOCK_SIZE = 256
+
+
+def normalize_rows(items):
+    """
+    :param items: 2d numpy array, one representation per row
+    :return: float64 copy of items with unit-norm rows (all-zero rows stay zero)
+    """
+    items = np.asarray(items, dtype='float64')
+    norms = np.sqrt((items ** 2).sum(1, keepdims=True))
+
+    return items / np.maximum(norms, 1e-12)
+
+
+def _select(selected, key, lists, step):
+    """Picks the unselected candidate with the largest key for every user."""
+    key = np.where(selected, -np.inf, key)
+    chosen = key.argmax(1)
+
+    users = np.arange(len(chosen))
+    selected[users, chosen] = True
+    lists[:, step] = chosen
+
+    return chosen
+
+
+def mmr_block(scores, vectors, k, trade_off=0.5, valid=None):
+    """
+    Maximal marginal relevance for a block of users.
+
+    :param scores: 2d numpy array (users, candidates) of relevance scores
+    :param vectors: 3d numpy array (users, candidates, dimensions) of unit-norm representations
+    :param k: integer, length of each list
+    :param trade_off: float in [0, 1]; 1 ranks by relevance alone
+    :param valid: optional 2d boolean array (users, candidates); invalid candidates are never
+                  selected, and positions past a user's valid candidates are arbitrary
+    :return: 2d int64 numpy array (users, k) of positions into the candidates
+    """
+    num_users, num_candidates = scores.shape
+    users = np.arange(num_users)
+
+    lists = np.zeros((num_users, k), dtype='int64')
+    selected = np.zeros((num_users, num_candidates), dtype=bool) if valid is None else ~valid
+    max_similarity = np.zeros((num_users, num_candidates))
+
+    for step in range(k):
+        key = trade_off * scores - (1.0 - trade_off) * max_similarity
+        chosen = _select(selected, key, lists, step)
+
+        similarity = np.einsum('ucd,ud->uc', vectors, vectors[users, chosen])
+        if step == 0:
+            # Similarities can be negative, so the maximum starts from the first selection.
+            max_similarity = similarity
+        else:
+            np.maximum(max_similarity, similarity, out=max_similarity)
+
+    return lists
+
+
+def dpp_block(scores, vectors, k, alpha=1.0, epsilon=1e-10, valid=None):
+    """
+    Greedy determinantal point process MAP inference for a block of users.
+
+    Once a user's remaining candidates add no new direction (their marginal gains fall below
+    epsilon), the rest of the list is filled by relevance.
+
+    :param scores: 2d numpy array (users, candidates) of relevance scores
+    :param vectors: 3d numpy array (users, candidates, dimensions) of unit-norm representations
+    :param k: integer, length of each list
+    :param alpha: float, weight of relevance in the quality q = exp(alpha * relevance)
+    :param epsilon: float, smallest marginal gain still considered
+    :param valid: optional 2d boolean array (users, candidates); invalid candidates are never
+                  selected, and positions past a user's valid candidates are arbitrary
+    :return: 2d int64 numpy array (users, k) of positions into the candidates
+    """
+    num_users, num_candidates = scores.shape
+    users = np.arange(num_users)
+
+    # Scale qualities per user; it does not change the selection but avoids overflow.
+    quality = np.exp(alpha * (scores - scores.max(1, keepdims=True)))
+
+    lists = np.zeros((num_users, k), dtype='int64')
+    selected = np.zeros((num_users, num_candidates), dtype=bool) if valid is None else ~valid
+
+    # gains[u, i] = d_i^2, the squared Cholesky diagonal of candidate i given the selected items.
+    gains = quality ** 2
+    cholesky = np.zeros((k, num_users, num_candidates))
+
+    for step in range(k):
+        # Candidates with no gain left are ranked after all others, by relevance.
+        exhausted = np.log(epsilon) - 1.0 - (scores.max(1, keepdims=True) - scores)
+        key = np.where(gains > epsilon, np.log(np.maximum(gains, epsilon)), exhausted)
+        chosen = _select(selected, key, lists, step)
+
+        if step == k - 1:
+            break
+
+        kernel_row = quality[users, chosen][:, None] * quality * np.einsum(
+            'ucd,ud->uc', vectors, vectors[users, chosen]
+        )
+        projection = np.einsum('tu,tuc->uc', cholesky[:step, users, chosen], cholesky[:step])
+        d = np.sqrt(np.maximum(gains[users, chosen], epsilon))
+
+        e = (kernel_row - projection) / d[:, None]
+        cholesky[step] = e
+        gains = gains - e ** 2
+
+    return lists
+
+
+reranker_map = {
+    'mmr': mmr_block,
+    'dpp': dpp_block,
+}
+
+
+def rerank(scores, items, k, method='mmr', candidates=None, block_size=DEFAULT_BLOCK_SIZE, **kwargs):
+    """
+    Re-ranks every user's candidates into a diversified top-k list.
+
+    :param scores: 2d numpy array (users, candidates) of relevance scores
+    :param items: 2d numpy array (items, dimensions) of item representations
+    :param k: integer, length of each list; at most the number of candidates
+    :param method: 'mmr' or 'dpp'
+    :param candidates: optional 2d integer array (users, candidates) of rows of items; without
+                       it every user's candidates are all the items, in order.  Negative entries,
+                       such as the padding of candidates.IVFIndex.search, are never selected, and
+                       the lists of users with fewer than k other candidates end in -1.
+    :param block_size: integer, number of users re-ranked at a time
+    :param kwargs: passed to the re-ranker, e.g. trade_off for mmr or alpha for dpp
+    :return: 2d int64 numpy array (users, k) of item indices, best first
+    """
+    scores = np.asarray(scores, dtype='float64')
+    vectors = normalize_rows(items)
+    block = reranker_map[method]
+
+    if k > scores.shape[1]:
+        raise ValueError('cannot select %d of %d candidates' % (k, scores.shape[1]))
+
+    lists = np.zeros((scores.shape[0], k), dtype='int64')
+
+    for start in range(0, scores.shape[0], block_size):
+        end = min(start + block_size, scores.shape[0])
+
+        if candidates is None:
+            block_vectors = np.broadcast_to(vectors, (end - start,) + vectors.shape)
+            positions = block(scores[start:end], block_vectors, k, **kwargs)
+            lists[start:end] = positions
+        else:
+            block_candidates = np.asarray(candidates[start:end])
+            valid = block_candidates >= 0
+
+            # Padding gets the user's lowest valid score, so it never skews the arithmetic.
+            block_scores = scores[start:end]
+            lowest = np.where(valid, block_scores, np.inf).min(1, keepdims=True)
+            block_scores = np.where(valid, block_scores, np.where(np.isfinite(lowest), lowest, 0.0))
+
+            positions = block(
+                block_scores, vectors[np.where(valid, block_candidates, 0)], k, valid=valid, **kwargs
+            )
+            block_lists = np.take_along_axis(block_candidates, positions, 1)
+            block_lists[np.arange(k)[None, :] >= valid.sum(1)[:, None]] = -1
+            lists[start:end] = block_lists
+
+    return lists
+
+
+def intra_list_similarity(lists, items):
+    """
+    :param lists: 2d integer array (users, k) of item indices
+    :param items: 2d numpy array (items, dimensions) of item representations
+    :return: 1d numpy array, mean pairwise cosine similarity within each list
+    """
+    vectors = normalize_rows(items)[lists]
+    k = lists.shape[1]
+
+    similarity = np.einsum('ukd,ujd->ukj', vectors, vectors)
+    return (similarity.sum((1, 2)) - np.trace(similarity, axis1=1, axis2=2)) / max(k * (k - 1), 1)
+
+
+def benchmark(ks, num_users, num_candidates, num_dimensions, methods=('mmr', 'dpp'),
+              block_size=DEFAULT_BLOCK_SIZE, seed=0, log=sys.stderr):
+    """
+    Measures re-ranking throughput on random scores and representations.
+
+    :return: list of records with method, k, users_per_s, seconds and the mean intra-list
+             similarity of the re-ranked and of the plain top-k lists
+    """
+    rng = np.random.RandomState(seed)
+    num_items = 10 * num_candidates
+
+    items = rng.randn(num_items, num_dimensions)
+    scores = rng.rand(num_users, num_candidates)
+    candidates = np.argsort(rng.rand(num_users, num_items), 1)[:, :num_candidates]
+
+    top = np.take_along_axis(candidates, np.argsort(-scores, 1), 1)
+
+    records = []
+    for method in methods:
+        for k in ks:
+            start = time.time()
+            lists = rerank(scores, items, k, method=method, candidates=candidates, block_size=block_size)
+            seconds = time.time() - start
+
+            record = dict(
+                method=method, k=k, num_users=num_users, num_candidates=num_candidates,
+                num_dimensions=num_dimensions, block_size=block_size, seconds=seconds,
+                users_per_s=num_users / seconds,
+                similarity=float(intra_list_similarity(lists, items).mean()),
+                top_k_similarity=float(intra_list_similarity(top[:, :k], items).mean()),
+            )
+            records.append(record)
+
+            log.write('%-4s k=%-4d users_per_s=%.0f similarity=%.4f (top-k %.4f)\n' % (
+                method, k, record['users_per_s'], record['similarity'], record['top_k_similarity']
+            ))
+
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark diversified re-ranking throughput.')
+    parser.add_argument('--ks', type=int, nargs='+', default=[10, 20, 50, 100])
+    parser.add_argument('--methods', nargs='+', default=sorted(reranker_map), choices=sorted(reranker_map))
+    parser.add_argument('--num-users', type=int, default=2000)
+    parser.add_argument('--num-candidates', type=int, default=500)
+    parser.add_argument('--num-dimensions', type=int, default=64)
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='rerank_benchmark.json')
+    args = parser.parse_args(argv)
+
+    results = benchmark(
+        args.ks, args.num_users, args.num_candidates, args.num_dimensions,
+        methods=args.methods, block_size=args.block_size, seed=args.seed,
+    )
+
+    with open(args.output, 'w') as f:
+        json.dump({'config': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
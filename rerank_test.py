@@ -0,0 +1,79 @@
+import unittest
+
+import numpy as np
+
+import rerank
+
+
+class TestRerank(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+
+        self.items = rng.randn(100, 5)
+        self.scores = rng.rand(7, 30)
+        self.candidates = np.argsort(rng.rand(7, 100), 1)[:, :30]
+        self.vectors = rerank.normalize_rows(self.items)
+
+    def greedy(self, user, k, objective):
+        """Reference implementation: tries every candidate at every step."""
+        selected = []
+        for _ in range(k):
+            remaining = [i for i in range(30) if i not in selected]
+            selected.append(max(remaining, key=lambda i: objective(user, selected, i)))
+
+        return [self.candidates[user, i] for i in selected]
+
+    def mmr_objective(self, user, selected, i):
+        similarities = [self.vectors[self.candidates[user, i]].dot(self.vectors[self.candidates[user, j]]) for j in selected]
+        return 0.5 * self.scores[user, i] - 0.5 * max(similarities or [0.0])
+
+    def dpp_objective(self, user, selected, i):
+        q = np.exp(self.scores[user])
+        V = self.vectors[self.candidates[user]]
+        L = q[:, None] * V.dot(V.T) * q[None, :]
+
+        sign, logdet = np.linalg.slogdet(L[np.ix_(selected + [i], selected + [i])])
+        return logdet if sign > 0 else -np.inf
+
+    def test_mmr(self):
+        lists = rerank.rerank(self.scores, self.items, 8, 'mmr', self.candidates, block_size=3)
+
+        for user in range(7):
+            self.assertEqual(list(lists[user]), self.greedy(user, 8, self.mmr_objective))
+
+    def test_dpp(self):
+        lists = rerank.rerank(self.scores, self.items, 5, 'dpp', self.candidates, block_size=3)
+
+        for user in range(7):
+            self.assertEqual(list(lists[user]), self.greedy(user, 5, self.dpp_objective))
+
+    def test_dpp_beyond_rank(self):
+        # Only 5 directions exist, so the last entries of each list are filled by relevance.
+        lists = rerank.rerank(self.scores, self.items, 12, 'dpp', self.candidates)
+
+        self.assertTrue(all(len(set(row)) == 12 for row in lists))
+
+    def test_padded_candidates(self):
+        # Candidate lists padded like candidates.IVFIndex.search: index -1 with score -inf.
+        candidates = self.candidates.copy()
+        scores = self.scores.copy()
+        candidates[0, 6:] = -1
+        scores[0, 6:] = -np.inf
+
+        for method in ['mmr', 'dpp']:
+            lists = rerank.rerank(scores, self.items, 8, method, candidates, block_size=3)
+            expected = rerank.rerank(self.scores, self.items, 8, method, self.candidates, block_size=3)
+
+            self.assertEqual(list(lists[0, :6]), list(rerank.rerank(
+                self.scores[:1, :6], self.items, 6, method, self.candidates[:1, :6]
+            )[0]))
+            self.assertEqual(list(lists[0, 6:]), [-1, -1])
+            self.assertTrue((lists[1:] == expected[1:]).all())
+
+    def test_relevance_only(self):
+        lists = rerank.rerank(self.scores[:, :20], self.items[:20], 4, 'mmr', trade_off=1.0)
+        self.assertTrue((lists == np.argsort(-self.scores[:, :20], 1)[:, :4]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+"""
+Hyperparameter sweeps of node classification DCNNs that share diffusion kernels.
+
+The kernel built for num_hops = H holds the kernel of every smaller hop count as its prefix
+K[:, :h + 1, :] (see util.hop_prefix).  A sweep therefore groups its configurations by the
+parameters that change the kernel other than num_hops, builds one kernel per group with the
+largest num_hops of the group, and gives every configuration a view of its first hops through
+params.diffusion_kernel.  Configurations are trained in worker processes forked after the
+kernels are built, so the kernels are shared copy-on-write instead of being copied.  With
+params.kernel_cache_dir set the kernels are memmaps, which also carry over to later sweeps.
+
+    grid = {'num_hops': [1, 2, 3], 'learning_rate': [0.01, 0.05]}
+    results = sweep.run_sweep('NodeClassificationDCNN', base, grid, A, X, Y, train, valid, num_workers=4)
+
+Results are ranked by their best validation loss.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+import traceback
+
+import numpy as np
+
+import benchmark
+
+
+# Hyperparameters that change the kernel, besides num_hops.
+KERNEL_PARAMETER_NAMES = (
+    'diffusion_threshold', 'kernel_backend', 'kernel_dtype', 'diffusion_top_k', 'lazy_kernel_cache_size',
+)
+
+
+class SweepParameters(object):
+    """Model hyperparameters of one configuration, with the attributes the models read."""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def expand_grid(grid):
+    """
+    :param grid: dict of parameter name -> list of values
+    :return: list of dicts, one per combination of values, in a stable order
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def _kernel_group(parameters):
+    if parameters.get('diffusion_features', False):
+        # Diffusion features are computed from X by each model; there is no kernel to share.
+        return None
+
+    return tuple((name, parameters.get(name)) for name in KERNEL_PARAMETER_NAMES)
+
+
+def build_shared_kernels(model_class, configs, A, log=sys.stderr):
+    """
+    Builds one kernel per group of configurations, for the largest num_hops of the group.
+
+    :param model_class: node classification model class, e.g. models.NodeClassificationDCNN
+    :param configs: list of dicts of complete model hyperparameters
+    :param A: 2d numpy array, adjacency matrix
+    :return: list with the shared kernel of every configuration (None for configurations
+             that do not use a kernel)
+    """
+    groups = {}
+    for i, parameters in enumerate(configs):
+        group = _kernel_group(parameters)
+        if group is not None:
+            groups.setdefault(group, []).append(i)
+
+    kernels = [None] * len(configs)
+    for group, members in sorted(groups.items()):
+        largest = max(members, key=lambda i: configs[i]['num_hops'])
+
+        start = time.time()
+        K = model_class.build_diffusion_kernel(SweepParameters(**configs[largest]), A)
+        log.write('built kernel %s with %d hops for %d configurations in %.3fs\n' % (
+            ' '.join('%s=%s' % item for item in group if item[1] is not None) or 'default',
+            configs[largest]['num_hops'], len(members), time.time() - start,
+        ))
+
+        for i in members:
+            kernels[i] = K
+
+    return kernels
+
+
+# State inherited by forked workers: (model name, configs, kernels, A, X, Y, train, valid, seed).
+_sweep_state = None
+
+
+def _run_config(i):
+    import models
+
+    model_name, configs, kernels, A, X, Y, train_indices, valid_indices, seed = _sweep_state
+    record = dict(index=i, config=configs[i])
+
+    # Model training prints progress; keep the sweep output clean.
+    with benchmark.quiet_stdout():
+        try:
+            # Every configuration starts from the same initialization and shuffling, wherever it runs.
+            np.random.seed(seed)
+
+            parameters = SweepParameters(diffusion_kernel=kernels[i], **configs[i])
+
+            start = time.time()
+            model = getattr(models, model_name)(parameters, A)
+            record['construct_s'] = time.time() - start
+
+            start = time.time()
+            validation_losses = model.fit(X, Y, train_indices.copy(), valid_indices)
+            record['fit_s'] = time.time() - start
+
+            record['validation_losses'] = [float(loss) for loss in validation_losses]
+            record['valid_loss'] = min(record['validation_losses'])
+            record['best_epoch'] = int(np.argmin(record['validation_losses']))
+        except Exception:
+            record['error'] = traceback.format_exc().strip().splitlines()[-1]
+
+    return record
+
+
+def rank(results):
+    """Sorts results by best validation loss, failed configurations last, and numbers them."""
+    def key(record):
+        failed = 'error' in record or np.isnan(record['valid_loss'])
+        return failed, None if failed else record['valid_loss'], record['index']
+
+    results = sorted(results, key=key)
+    for position, record in enumerate(results):
+        record['rank'] = position + 1
+
+    return results
+
+
+def run_sweep(model_name, base, grid, A, X, Y, train_indices, valid_indices, num_workers=None, seed=0,
+              log=sys.stderr):
+    """
+    Trains one model per configuration of the grid and ranks them by validation loss.
+
+    :param model_name: name of a node classification model class in models
+    :param base: dict of hyperparameters shared by every configuration
+    :param grid: dict of parameter name -> list of values, swept over every combination
+    :param A: 2d numpy array, adjacency matrix
+    :param num_workers: number of worker processes; None uses one per CPU, 1 trains in-process
+    :param seed: NumPy seed set before building each model
+    :return: list of records with config, rank, valid_loss, best_epoch, validation_losses and
+             timings (or error), best first
+    """
+    import models
+
+    global _sweep_state
+
+    configs = [dict(base, **config) for config in expand_grid(grid)]
+
+    start = time.time()
+    kernels = build_shared_kernels(getattr(models, model_name), configs, A, log=log)
+    kernel_s = time.time() - start
+
+    _sweep_state = (model_name, configs, kernels, A, X, Y, train_indices, valid_indices, seed)
+    try:
+        if num_workers == 1:
+            results = [_run_config(i) for i in range(len(configs))]
+        else:
+            # One process per configuration, so each starts from a clean heap.
+            pool = multiprocessing.Pool(num_workers, maxtasksperchild=1)
+            try:
+                results = pool.map(_run_config, range(len(configs)), 1)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+    finally:
+        _sweep_state = None
+
+    results = rank(results)
+
+    fit_s = sum(record.get('fit_s', 0.0) for record in results)
+    log.write('kernels %.3fs, training %.3fs over %d configurations\n' % (kernel_s, fit_s, len(configs)))
+    for record in results:
+        log.write('%3d %s %s\n' % (
+            record['rank'],
+            record.get('error') or 'valid_loss=%.6f epoch=%d fit_s=%.3f' % (
+                record['valid_loss'], record['best_epoch'], record['fit_s']
+            ),
+            ' '.join('%s=%s' % (name, record['config'][name]) for name in sorted(grid)),
+        ))
+
+    return results
+
+
+def _parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweep node classification DCNN hyperparameters on a synthetic graph.')
+    parser.add_argument('--model', default='NodeClassificationDCNN')
+    parser.add_argument('--graph', default='community', choices=sorted(benchmark.graph_generator_map))
+    parser.add_argument('--num-nodes', type=int, default=2000)
+    parser.add_argument('--density', type=float, default=0.005)
+    parser.add_argument('--num-features', type=int, default=16)
+    parser.add_argument('--num-classes', type=int, default=4)
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='set a hyperparameter of every configuration, e.g. num_epochs=20')
+    parser.add_argument('--grid', action='append', default=[], metavar='NAME=VALUE,VALUE',
+                        help='sweep a hyperparameter, e.g. num_hops=1,2,3')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='sweep.json')
+    args = parser.parse_args(argv)
+
+    A = benchmark.graph_generator_map[args.graph](args.num_nodes, args.density, seed=args.seed).toarray()
+    X, Y = benchmark._node_data(A, args.num_features, args.num_classes, args.seed)
+
+    indices = np.random.RandomState(args.seed).permutation(args.num_nodes).astype('int32')
+    train_indices = indices[:args.num_nodes // 2]
+    valid_indices = indices[args.num_nodes // 2:]
+
+    base = dict(benchmark.DEFAULT_PARAMETERS, num_nodes=args.num_nodes, num_features=args.num_features,
+                num_classes=args.num_classes)
+    for override in args.param:
+        name, value = override.split('=', 1)
+        base[name] = _parse_value(value)
+
+    grid = {}
+    for sweep in args.grid:
+        name, values = sweep.split('=', 1)
+        grid[name] = [_parse_value(value) for value in values.split(',')]
+
+    results = run_sweep(
+        args.model, base, grid, A, X, Y, train_indices, valid_indices, num_workers=args.workers, seed=args.seed
+    )
+
+    with open(args.output, 'w') as f:
+        json.dump({'config': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+
+import benchmark
+import models
+import sweep
+
+
+class TestSweep(unittest.TestCase):
+    def setUp(self):
+        self.A = benchmark.community_graph(60, 0.1, seed=0)[0].toarray()
+        self.X, self.Y = benchmark._node_data(self.A, 4, 3, 0)
+
+        indices = np.random.RandomState(0).permutation(60).astype('int32')
+        self.train_indices = indices[:30]
+        self.valid_indices = indices[30:]
+
+        self.base = dict(
+            benchmark.DEFAULT_PARAMETERS, num_nodes=60, num_features=4, num_classes=3, num_epochs=2, batch_size=10,
+        )
+        self.grid = {'num_hops': [1, 3], 'learning_rate': [0.01, 0.05]}
+
+    def test_expand_grid(self):
+        configs = sweep.expand_grid(self.grid)
+        self.assertEqual(len(configs), 4)
+        self.assertEqual(configs[0], {'learning_rate': 0.01, 'num_hops': 1})
+
+    def test_shared_kernels(self):
+        configs = [dict(self.base, **config) for config in sweep.expand_grid(self.grid)]
+        configs.append(dict(self.base, num_hops=2, diffusion_threshold=0.2))
+
+        kernels = sweep.build_shared_kernels(models.PostSparseNodeClassificationDCNN, configs, self.A, log=open('/dev/null', 'w'))
+        self.assertEqual(len(set(id(K) for K in kernels)), 2)
+        self.assertEqual(kernels[0].shape[1], 4)
+        self.assertEqual(kernels[-1].shape[1], 3)
+
+    def test_sweep_matches_separate_runs(self):
+        results = sweep.run_sweep(
+            'NodeClassificationDCNN', self.base, self.grid, self.A, self.X, self.Y,
+            self.train_indices, self.valid_indices, num_workers=2, log=open('/dev/null', 'w'),
+        )
+
+        self.assertEqual([r['rank'] for r in results], [1, 2, 3, 4])
+        self.assertTrue(all('error' not in r for r in results))
+        losses = [r['valid_loss'] for r in results]
+        self.assertEqual(losses, sorted(losses))
+
+        # A configuration trained on a slice of the shared kernel matches one that built its own.
+        record = [r for r in results if r['config']['num_hops'] == 1][0]
+        np.random.seed(0)
+        model = models.NodeClassificationDCNN(sweep.SweepParameters(**record['config']), self.A)
+        validation_losses = model.fit(self.X, self.Y, self.train_indices.copy(), self.valid_indices)
+        self.assertTrue(np.allclose(validation_losses, record['validation_losses']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,27 +1,25 @@
+import collections
+import multiprocessing
+
 import numpy as np
 import scipy.sparse as sp
 
-def A_to_diffusion_kernel(A, k):
+def A_to_diffusion_kernel(A, k, dtype='float32', memory_budget=None, stats=None):
     """
     Computes [A**0, A**1, ..., A**k]
 
     :param A: 2d numpy array
     :param k: integer, degree of series
+    :param dtype: storage type of the kernel, e.g. 'float32' or 'float16'
+    :param memory_budget: optional number of bytes the build may use, see _dense_diffusion_kernel
+    :param stats: optional dict, filled with the memory accounting of the build
     :return: 3d numpy array [A**0, A**1, ..., A**k]
     """
     assert k >= 0
 
-    Apow = [np.identity(A.shape[0])]
-
-    if k > 0:
-        d = A.sum(0)
+    P = _normalized_adjacency(A)
 
-        Apow.append(A / (d + 1.0))
-
-        for i in range(2, k + 1):
-            Apow.append(np.dot(A / (d + 1.0), Apow[-1]))
-
-    return np.transpose(np.asarray(Apow, dtype='float32'), (1, 0, 2))
+    return _dense_diffusion_kernel(P, P, k, dtype=dtype, memory_budget=memory_budget, stats=stats)
 
 
 def sparse_A_to_diffusion_kernel(A, k):
@@ -42,24 +40,1106 @@ def sparse_A_to_diffusion_kernel(A, k):
     return Apow
 
 
-def A_to_post_sparse_diffusion_kernel(A, k, threshold):
-    K = A_to_diffusion_kernel(A, k)
+def A_to_post_sparse_diffusion_kernel(A, k, threshold, dtype='float32', memory_budget=None, stats=None):
+    assert k >= 0
+
+    P = _normalized_adjacency(A)
+
+    return _dense_diffusion_kernel(
+        P, P, k, threshold=threshold, dtype=dtype, memory_budget=memory_budget, stats=stats
+    )
+
+def A_to_pre_sparse_diffusion_kernel(A, k, threshold, dtype='float32', memory_budget=None, stats=None):
+    assert k >= 0
+
+    P = _normalized_adjacency(A)
+
+    return _dense_diffusion_kernel(
+        P, _threshold_csr(P, threshold), k, dtype=dtype, memory_budget=memory_budget, stats=stats
+    )
+
+
+def _normalized_adjacency(A):
+    """
+    Computes A / (A.sum(0) + 1) as a CSR matrix without densifying A.
+
+    :param A: 2d numpy array or scipy.sparse matrix
+    :return: scipy.sparse.csr_matrix
+    """
+    A = sp.csr_matrix(A, dtype='float64')
+
+    d = np.asarray(A.sum(0)).ravel()
+
+    return A.dot(sp.diags(1.0 / (d + 1.0))).tocsr()
+
+
+def _threshold_csr(M, threshold):
+    M = M.copy()
+    M.data[M.data <= threshold] = 0.0
+    M.eliminate_zeros()
+
+    return M
 
-    K[K <= threshold] = 0.0
+
+# Densify the normalized adjacency above this fraction of non-zeros; BLAS then beats sparse products.
+DENSE_OPERATOR_DENSITY = 0.1
+
+# Columns of a dense kernel computed together when no memory budget is given.
+DENSE_KERNEL_CHUNK_SIZE = 1024
+
+
+def _operator_bytes(M):
+    if sp.issparse(M):
+        return M.data.nbytes + M.indices.nbytes + M.indptr.nbytes
+
+    return M.nbytes
+
+
+def _dense_diffusion_kernel(P, first_hop, k, threshold=None, dtype='float32', memory_budget=None, stats=None):
+    """
+    Writes the hops P**0, first_hop, P first_hop, ... into a preallocated (N, k + 1, N) array.
+
+    Hops are computed in float64 for a block of columns at a time, [P**i](:, J) = P [P**(i-1)](:, J),
+    and cast into the kernel as they are written, so no full-size float64 copy is ever held.
+    Without a budget blocks are DENSE_KERNEL_CHUNK_SIZE columns wide.  With a budget the block
+    is as wide as the budget allows; if even the kernel itself does not fit, the build is refused
+    before anything is allocated.
+
+    :param P: scipy.sparse matrix, normalized adjacency
+    :param first_hop: scipy.sparse matrix, first hop (P, or P thresholded for pre-sparse kernels)
+    :param k: integer, degree of series
+    :param threshold: optional float; entries <= threshold are zeroed, as in post-sparse kernels
+    :param dtype: storage type of the kernel, e.g. 'float32' or 'float16'
+    :param memory_budget: optional number of bytes for the kernel plus all temporaries
+    :param stats: optional dict, filled with kernel_bytes, operator_bytes, workspace_bytes,
+                  peak_bytes, chunk_size and num_chunks
+    :return: 3d numpy array of shape (N, k + 1, N)
+    :raises MemoryError: if the kernel cannot be built within memory_budget
+    """
+    num_nodes = P.shape[0]
+    dtype = np.dtype(dtype)
+
+    kernel_bytes = num_nodes * (k + 1) * num_nodes * dtype.itemsize
+    # Per column of a block: the current and the next hop in float64, and the cast copy.
+    column_bytes = num_nodes * (2 * 8 + dtype.itemsize)
+
+    operators = [P] if first_hop is P else [P, first_hop]
+    if P.nnz > DENSE_OPERATOR_DENSITY * num_nodes * num_nodes:
+        dense_bytes = len(operators) * num_nodes * num_nodes * 8
+        if memory_budget is None or kernel_bytes + dense_bytes + column_bytes <= memory_budget:
+            operators = [M.toarray() for M in operators]
+    operator_bytes = sum(_operator_bytes(M) for M in operators)
+    P, first_hop = operators[0], operators[-1]
+
+    if memory_budget is None:
+        chunk_size = max(1, min(num_nodes, DENSE_KERNEL_CHUNK_SIZE))
+    else:
+        chunk_size = min(num_nodes, int((memory_budget - kernel_bytes - operator_bytes) // column_bytes))
+        if chunk_size < 1:
+            raise MemoryError(
+                'a %d-hop kernel of %d nodes needs at least %d bytes, over the budget of %d' % (
+                    k, num_nodes, kernel_bytes + operator_bytes + column_bytes, memory_budget
+                )
+            )
+
+    num_chunks = -(-num_nodes // chunk_size) if num_nodes else 0
+
+    if stats is not None:
+        stats.update(
+            kernel_bytes=kernel_bytes,
+            operator_bytes=operator_bytes,
+            workspace_bytes=chunk_size * column_bytes,
+            peak_bytes=kernel_bytes + operator_bytes + chunk_size * column_bytes,
+            chunk_size=chunk_size,
+            num_chunks=num_chunks,
+        )
+
+    K = np.zeros((num_nodes, k + 1, num_nodes), dtype=dtype)
+    K[np.arange(num_nodes), 0, np.arange(num_nodes)] = 1.0
+    if threshold is not None and threshold >= 1.0:
+        K[:, 0, :] = 0.0
+
+    for start in range(0, num_nodes, chunk_size):
+        columns = slice(start, min(start + chunk_size, num_nodes))
+
+        hop = None
+        for i in range(1, k + 1):
+            if i == 1:
+                hop = first_hop[:, columns]
+                hop = hop.toarray() if sp.issparse(hop) else np.array(hop)
+            else:
+                hop = P.dot(hop)
+
+            block = hop.astype(dtype)
+            if threshold is not None:
+                block[block <= threshold] = 0.0
+            K[:, i, columns] = block
 
     return K
 
-def A_to_pre_sparse_diffusion_kernel(A, k, threshold):
-    Apow = [np.identity(A.shape[0])]
+
+class _RowGatheredKernel(object):
+    """
+    Base class for diffusion kernels that are never materialized as a dense (N, k + 1, N) array.
+
+    Indexing behaves like the dense kernel: K[indices, :, :] gathers the requested rows of
+    every hop into a dense float32 block, so models can use it in place of the array returned
+    by A_to_diffusion_kernel.  Subclasses implement gather.
+    """
+    dtype = np.dtype('float32')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        rows = key[0]
+        if isinstance(rows, slice):
+            rows = np.arange(self.shape[0])[rows]
+        elif np.isscalar(rows):
+            return self.gather([rows])[(0,) + key[1:]]
+
+        return self.gather(rows)[(slice(None),) + key[1:]]
+
+    def _as_indices(self, rows):
+        rows = np.asarray(rows)
+        if rows.dtype == np.bool_:
+            rows = np.flatnonzero(rows)
+
+        return rows
+
+    def gather(self, rows, out=None):
+        """
+        Gathers the kernel rows for the given nodes.
+
+        :param rows: 1d array of node indices (or boolean mask)
+        :param out: optional preallocated array of shape (len(rows), k + 1, N) to fill
+        :return: 3d numpy array of shape (len(rows), k + 1, N)
+        """
+        raise NotImplementedError
+
+
+class CSRDiffusionKernel(_RowGatheredKernel):
+    """
+    A diffusion kernel [A**0, A**1, ..., A**k] stored as one CSR matrix per hop.
+    """
+    def __init__(self, hops):
+        self.hops = [
+            hop if sp.isspmatrix_csr(hop) and hop.dtype == np.float32 else sp.csr_matrix(hop, dtype='float32')
+            for hop in hops
+        ]
+
+        self.shape = (self.hops[0].shape[0], len(self.hops), self.hops[0].shape[1])
+
+    @property
+    def nnz(self):
+        return sum(hop.nnz for hop in self.hops)
+
+    def gather(self, rows, out=None):
+        rows = self._as_indices(rows)
+
+        if out is None:
+            out = np.zeros((rows.shape[0], self.shape[1], self.shape[2]), dtype=self.dtype)
+        else:
+            out[...] = 0
+
+        for i, hop in enumerate(self.hops):
+            block = hop[rows]
+            block_rows = np.repeat(np.arange(rows.shape[0]), np.diff(block.indptr))
+            out[block_rows, i, block.indices] = block.data
+
+        return out
+
+
+def gather_rows(K, rows, out=None):
+    """
+    Gathers K[rows] for a dense array or a row-gathered kernel.
+
+    :param K: numpy array, or a CSRDiffusionKernel / LazyDiffusionKernel
+    :param rows: 1d array of row indices
+    :param out: optional preallocated array of shape (len(rows),) + K.shape[1:] to fill
+    :return: the gathered rows (out, if given)
+    """
+    if isinstance(K, _RowGatheredKernel):
+        return K.gather(rows, out=out)
+
+    return np.take(K, rows, axis=0, out=out)
+
+
+LAZY_KERNEL_CACHE_SIZE = 4096
+
+
+def _diffusion_rows(P, first_hop, nodes, k, threshold=None):
+    """
+    Computes the kernel rows of the given nodes by sparse walks from their indicator vectors.
+
+    :return: list of k + 1 CSR matrices of shape (len(nodes), N), the rows of each hop
+    """
+    num_rows = len(nodes)
+
+    walk = sp.csr_matrix(
+        (np.ones(num_rows), (np.arange(num_rows), nodes)),
+        shape=(num_rows, P.shape[1])
+    )
+
+    hops = [walk]
+    for i in range(1, k + 1):
+        hops.append(walk.dot(first_hop))
+
+        if first_hop is P:
+            walk = hops[-1]
+        elif i < k:
+            walk = walk.dot(P)
+
+    if threshold is not None:
+        hops = [_threshold_csr(hop, threshold) for hop in hops]
+
+    return hops
+
+
+class LazyDiffusionKernel(_RowGatheredKernel):
+    """
+    A diffusion kernel whose rows are computed on demand.
+
+    The rows of hop i for a batch are obtained by repeated sparse products of the batch
+    indicator vectors with the normalized adjacency, so the full kernel is never stored.
+    Only the most recently used cache_size rows are kept, in an LRU cache.
+    """
+    def __init__(self, P, first_hop, k, threshold=None, cache_size=LAZY_KERNEL_CACHE_SIZE):
+        self.P = P
+        self.first_hop = first_hop
+        self.threshold = threshold
+        self.cache_size = cache_size
+
+        self.shape = (P.shape[0], k + 1, P.shape[1])
+
+        self._cache = collections.OrderedDict()
+
+    def _compute_rows(self, nodes):
+        """Computes the (k + 1, N) CSR block of each node in nodes."""
+        num_rows = len(nodes)
+        num_hops = self.shape[1]
+
+        hops = _diffusion_rows(self.P, self.first_hop, nodes, num_hops - 1, self.threshold)
+
+        # Reorder from hop-major to node-major so each node's rows are contiguous.
+        stacked = sp.vstack(hops, format='csr', dtype='float32')
+        stacked = stacked[np.arange(num_hops * num_rows).reshape(num_hops, num_rows).T.ravel()]
+
+        return dict(
+            (node, stacked[j * num_hops:(j + 1) * num_hops]) for j, node in enumerate(nodes)
+        )
+
+    def gather(self, rows, out=None):
+        rows = self._as_indices(rows)
+        num_hops = self.shape[1]
+
+        missing = [node for node in np.unique(rows) if node not in self._cache]
+        computed = self._compute_rows(missing) if missing else {}
+
+        blocks = []
+        for node in rows:
+            if node in computed:
+                blocks.append(computed[node])
+            else:
+                blocks.append(self._cache.pop(node))
+                self._cache[node] = blocks[-1]
+
+        for node in missing:
+            self._cache[node] = computed[node]
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        if out is None:
+            out = np.zeros((rows.shape[0], num_hops, self.shape[2]), dtype=self.dtype)
+        else:
+            out[...] = 0
+
+        if blocks:
+            block = sp.vstack(blocks, format='csr')
+            block_rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+            out[block_rows // num_hops, block_rows % num_hops, block.indices] = block.data
+
+        return out
+
+
+def _csr_diffusion_hops(P, first_hop, k):
+    hops = [sp.identity(P.shape[0], dtype='float64', format='csr')]
 
     if k > 0:
-        d = A.sum(0)
+        hops.append(first_hop)
 
-        Apow.append(A / (d + 1.0))
+        for i in range(2, k + 1):
+            hops.append(P.dot(hops[-1]))
+
+    return hops
+
+
+def A_to_csr_diffusion_kernel(A, k):
+    """
+    Computes [A**0, A**1, ..., A**k] with every hop kept as a CSR matrix.
+
+    Matches A_to_diffusion_kernel, but build time and memory scale with the number of
+    non-zeros in each hop instead of N**2.
+
+    :param A: 2d numpy array or scipy.sparse matrix
+    :param k: integer, degree of series
+    :return: CSRDiffusionKernel
+    """
+    assert k >= 0
+
+    P = _normalized_adjacency(A)
+
+    return CSRDiffusionKernel(_csr_diffusion_hops(P, P, k))
+
+
+def A_to_post_sparse_csr_diffusion_kernel(A, k, threshold):
+    K = A_to_csr_diffusion_kernel(A, k)
+
+    K.hops = [_threshold_csr(hop, threshold) for hop in K.hops]
+
+    return K
+
+
+def A_to_pre_sparse_csr_diffusion_kernel(A, k, threshold):
+    assert k >= 0
+
+    P = _normalized_adjacency(A)
+
+    return CSRDiffusionKernel(_csr_diffusion_hops(P, _threshold_csr(P, threshold), k))
+
+
+
+def _prune_rows(M, epsilon, top_k=None):
+    """Drops the entries of M that are <= epsilon, then keeps at most top_k entries per row."""
+    M = _threshold_csr(M, epsilon)
+
+    if top_k is not None and M.nnz > 0 and np.diff(M.indptr).max() > top_k:
+        rows = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+        # Ties are broken by column, so the result does not depend on how the entries are stored.
+        order = np.lexsort((M.indices, -M.data, rows))
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.shape[0]) - M.indptr[rows[order]]
+
+        M.data[rank >= top_k] = 0.0
+        M.eliminate_zeros()
+
+    return M
+
+
+def _push_rows(P, first_hop, nodes, k, epsilon, top_k=None):
+    """
+    Computes the rows of the given nodes of a push kernel, see _push_diffusion_kernel.
+
+    :return: list of k + 1 float32 CSR matrices of shape (len(nodes), N), the rows of each hop
+    """
+    num_rows = len(nodes)
+
+    walk = sp.csr_matrix((np.ones(num_rows), (np.arange(num_rows), nodes)), shape=(num_rows, P.shape[1]))
+
+    hops = [walk.astype('float32')]
+    for i in range(1, k + 1):
+        hop = _prune_rows(walk.dot(first_hop), epsilon, top_k)
+        hops.append(hop.astype('float32'))
+
+        if first_hop is P:
+            walk = hop
+        elif i < k:
+            walk = _prune_rows(walk.dot(P), epsilon, top_k)
+
+    return hops
+
+
+def _push_diffusion_kernel(P, first_hop, k, epsilon, top_k=None, chunk_size=1024):
+    """
+    Approximates the hops P**0, first_hop, P first_hop, ... by pushing mass out from every node.
+
+    Row v of hop i is the walk e_v P**(i-1) pushed through first_hop.  Each walk step pushes the
+    entries of the previous step along P; entries <= epsilon are dropped before they are pushed
+    further, and at most top_k entries are kept per row, so time and memory are proportional to
+    the retained mass instead of N**2.
+
+    Error bound: pruning only removes non-negative entries, so no entry is overestimated.  The
+    columns of P (and of first_hop, a thresholded P) sum to d / (d + 1) < 1, so pushing a row
+    never increases its largest error, and without top_k each step adds at most epsilon to it.
+    Every entry of hop i is therefore at most i * epsilon below the exact value; with
+    epsilon = 0 and top_k = None the result is exact.  Entries cut by top_k are not covered by
+    this bound.
+
+    :param P: scipy.sparse matrix, normalized adjacency
+    :param first_hop: scipy.sparse matrix, first hop (P, or P thresholded for pre-sparse kernels)
+    :param k: integer, degree of series
+    :param epsilon: float, entries <= epsilon are dropped
+    :param top_k: integer or None, maximum number of entries kept per row of each hop
+    :param chunk_size: integer, number of rows propagated together
+    :return: CSRDiffusionKernel
+    """
+    num_nodes = P.shape[0]
+
+    blocks = [[] for _ in range(k)]
+    for start in range(0, num_nodes, chunk_size):
+        rows = _push_rows(P, first_hop, np.arange(start, min(start + chunk_size, num_nodes)), k, epsilon, top_k)
+        for i in range(k):
+            blocks[i].append(rows[i + 1])
+
+    hops = [sp.identity(num_nodes, dtype='float32', format='csr')]
+    hops.extend(sp.vstack(hop_blocks, format='csr') for hop_blocks in blocks)
+
+    return CSRDiffusionKernel(hops)
+
+
+def A_to_push_diffusion_kernel(A, k, epsilon, top_k=None, chunk_size=1024):
+    """
+    Approximates [A**0, A**1, ..., A**k] by pushing mass out from every node.
+
+    Every entry of hop i is at most i * epsilon below the exact value when top_k is None, see
+    _push_diffusion_kernel.
+
+    :param A: 2d numpy array or scipy.sparse matrix
+    :param k: integer, degree of series
+    :param epsilon: float, entries <= epsilon are dropped
+    :param top_k: integer or None, maximum number of entries kept per row of each hop
+    :param chunk_size: integer, number of rows propagated together
+    :return: CSRDiffusionKernel
+    """
+    assert k >= 0
+
+    P = _normalized_adjacency(A)
+
+    return _push_diffusion_kernel(P, P, k, epsilon, top_k, chunk_size)
+
+
+def A_to_post_sparse_push_diffusion_kernel(A, k, threshold, top_k=None, epsilon=None):
+    """Push approximation of A_to_post_sparse_diffusion_kernel; epsilon defaults to threshold."""
+    K = A_to_push_diffusion_kernel(A, k, threshold if epsilon is None else epsilon, top_k)
+
+    K.hops = [_threshold_csr(hop, threshold) for hop in K.hops]
+
+    return K
+
+
+def A_to_pre_sparse_push_diffusion_kernel(A, k, threshold, top_k=None, epsilon=None):
+    """Push approximation of A_to_pre_sparse_diffusion_kernel; epsilon defaults to threshold."""
+    assert k >= 0
+
+    P = _normalized_adjacency(A)
+
+    return _push_diffusion_kernel(
+        P, _threshold_csr(P, threshold), k, threshold if epsilon is None else epsilon, top_k
+    )
+
+
+def A_to_lazy_diffusion_kernel(A, k, cache_size=LAZY_KERNEL_CACHE_SIZE):
+    """
+    Returns a kernel equivalent to A_to_diffusion_kernel whose rows are computed per batch.
+
+    :param A: 2d numpy array or scipy.sparse matrix
+    :param k: integer, degree of series
+    :param cache_size: integer, number of node rows kept in the LRU cache
+    :return: LazyDiffusionKernel
+    """
+    assert k >= 0
+
+    P = _normalized_adjacency(A)
+
+    return LazyDiffusionKernel(P, P, k, cache_size=cache_size)
+
+
+def A_to_post_sparse_lazy_diffusion_kernel(A, k, threshold, cache_size=LAZY_KERNEL_CACHE_SIZE):
+    assert k >= 0
+
+    P = _normalized_adjacency(A)
+
+    return LazyDiffusionKernel(P, P, k, threshold=threshold, cache_size=cache_size)
+
+
+def A_to_pre_sparse_lazy_diffusion_kernel(A, k, threshold, cache_size=LAZY_KERNEL_CACHE_SIZE):
+    assert k >= 0
+
+    P = _normalized_adjacency(A)
 
-        Apow[-1][Apow[-1] <= threshold] = 0.0
+    return LazyDiffusionKernel(P, _threshold_csr(P, threshold), k, cache_size=cache_size)
+
+
+def hop_prefix(K, k):
+    """
+    Returns the kernel of degree k contained in a kernel of higher degree, without copying.
+
+    Every builder computes hop i from hop i - 1 alone, so the first k + 1 hops of a kernel
+    built for num_hops >= k are the kernel built for k.
+
+    :param K: kernel returned by any of the builders, including a memmap from kernel_cache
+    :param k: integer, degree of series, at most K.shape[1] - 1
+    :return: a view of the first k + 1 hops of K
+    """
+    if not 0 <= k < K.shape[1]:
+        raise ValueError('kernel of degree %d has no prefix of degree %d' % (K.shape[1] - 1, k))
+
+    if isinstance(K, CSRDiffusionKernel):
+        return CSRDiffusionKernel(K.hops[:k + 1])
+    if isinstance(K, LazyDiffusionKernel):
+        return LazyDiffusionKernel(K.P, K.first_hop, k, threshold=K.threshold, cache_size=K.cache_size)
+
+    return K[:, :k + 1, :]
+
+
+
+def _propagate_features(P, first_hop, X, k):
+    X = X.toarray() if sp.issparse(X) else np.asarray(X)
+
+    features = np.empty((X.shape[0], k + 1, X.shape[1]), dtype='float32')
+    features[:, 0, :] = X
+
+    if k > 0:
+        Z = first_hop.dot(X)
+        features[:, 1, :] = Z
 
         for i in range(2, k + 1):
-            Apow.append(np.dot(A / (d + 1.0), Apow[-1]))
+            Z = P.dot(Z)
+            features[:, i, :] = Z
+
+    return features
+
+
+def A_to_diffusion_features(A, X, k):
+    """
+    Computes [A**0 X, A**1 X, ..., A**k X] by sparse propagation of X.
+
+    This is np.dot(A_to_diffusion_kernel(A, k), X) without ever forming the kernel, so it
+    takes O(k * nnz(A) * F) time and O(N * k * F) memory.
+
+    :param A: 2d numpy array or scipy.sparse matrix
+    :param X: 2d numpy array or scipy.sparse matrix of node features
+    :param k: integer, degree of series
+    :return: 3d numpy array of shape (N, k + 1, F)
+    """
+    assert k >= 0
+
+    P = _normalized_adjacency(A)
+
+    return _propagate_features(P, P, X, k)
+
+
+def _kernel_features(K, X):
+    """Computes np.dot(K, X) for a CSRDiffusionKernel, one hop at a time."""
+    X = X.toarray() if sp.issparse(X) else np.asarray(X)
+
+    features = np.empty((X.shape[0], len(K.hops), X.shape[1]), dtype='float32')
+    for i, hop in enumerate(K.hops):
+        features[:, i, :] = hop.dot(X)
+
+    return features
+
+
+def A_to_post_sparse_diffusion_features(A, X, k, threshold):
+    return _kernel_features(A_to_post_sparse_csr_diffusion_kernel(A, k, threshold), X)
+
+
+def A_to_pre_sparse_diffusion_features(A, X, k, threshold):
+    assert k >= 0
+
+    P = _normalized_adjacency(A)
+
+    return _propagate_features(P, _threshold_csr(P, threshold), X, k)
+
+
+def A_to_post_sparse_push_diffusion_features(A, X, k, threshold, top_k=None):
+    """Computes the diffusion features of the kernel of A_to_post_sparse_push_diffusion_kernel."""
+    return _kernel_features(A_to_post_sparse_push_diffusion_kernel(A, k, threshold, top_k), X)
+
+
+def A_to_pre_sparse_push_diffusion_features(A, X, k, threshold, top_k=None):
+    """Computes the diffusion features of the kernel of A_to_pre_sparse_push_diffusion_kernel."""
+    return _kernel_features(A_to_pre_sparse_push_diffusion_kernel(A, k, threshold, top_k), X)
+
+
+def _edge_matrix(edges, num_nodes):
+    edges = np.asarray(edges, dtype='int64').reshape(-1, 2)
+
+    M = sp.coo_matrix(
+        (np.ones(2 * edges.shape[0]), (edges.ravel(), edges[:, ::-1].ravel())),
+        shape=(num_nodes, num_nodes)
+    ).tocsr()
+    M.data[:] = 1.0
+
+    return M, edges
+
+
+def apply_edge_changes(A, insertions=(), deletions=()):
+    """
+    Inserts and deletes undirected edges.
+
+    :param A: 2d numpy array or scipy.sparse matrix, symmetric 0/1 adjacency matrix
+    :param insertions: sequence of (u, v) node pairs to connect
+    :param deletions: sequence of (u, v) node pairs to disconnect
+    :return: the new adjacency as a CSR matrix, and the sorted endpoints of all changed edges
+    """
+    A = sp.csr_matrix(A, dtype='float64')
+
+    I, insertions = _edge_matrix(insertions, A.shape[0])
+    D, deletions = _edge_matrix(deletions, A.shape[0])
+
+    A = A - A.multiply(D)
+    A = A - A.multiply(I) + I
+    A = sp.csr_matrix(A)
+    A.eliminate_zeros()
+
+    return A, np.unique(np.concatenate([insertions.ravel(), deletions.ravel()]))
+
+
+def affected_rows(A_old, A_new, changed, k):
+    """
+    Finds the kernel rows that change when the edges around some nodes change.
+
+    Changing the edges of node c changes column c of the normalized adjacency, so row i of hop h
+    can only change if i is within h hops of c in the old or the new graph.
+
+    :param A_old: scipy.sparse matrix, adjacency before the change
+    :param A_new: scipy.sparse matrix, adjacency after the change
+    :param changed: 1d array of the endpoints of the changed edges
+    :param k: integer, degree of series
+    :return: list of k + 1 sorted 1d arrays, the changed rows of each hop
+    """
+    U = (abs(sp.csr_matrix(A_old)) + abs(sp.csr_matrix(A_new))).tocsr()
+
+    seed = np.zeros(U.shape[0])
+    seed[changed] = 1.0
+    first = U.dot(seed) > 0
+
+    rows = [np.zeros(0, dtype='int64')]
+    mask = np.zeros(U.shape[0], dtype=bool)
+    for i in range(1, k + 1):
+        mask = first | (U.dot(mask.astype('float64')) > 0)
+        rows.append(np.flatnonzero(mask))
+
+    return rows
+
+
+def _csr_positions(indptr, rows):
+    """Returns the positions in data / indices of the entries of the given rows, in order."""
+    lengths = indptr[rows + 1] - indptr[rows]
+    offsets = np.repeat(indptr[rows] - np.cumsum(lengths) + lengths, lengths)
+
+    return offsets + np.arange(lengths.sum())
+
+
+def _replace_csr_rows(M, rows, new_rows):
+    """
+    Replaces some rows of a CSR matrix.
+
+    When every new row has as many entries as the row it replaces, and M is writable, the
+    entries are overwritten in place.  Otherwise the arrays of M are spliced once, copying the
+    kept entries as they are instead of restacking and reindexing the whole matrix.
+
+    :param M: scipy.sparse.csr_matrix
+    :param rows: sorted 1d array of distinct row indices
+    :param new_rows: scipy.sparse.csr_matrix of shape (len(rows), M.shape[1])
+    :return: M, or a new CSR matrix when the rows changed size
+    """
+    rows = np.asarray(rows, dtype='int64')
+    new_rows = sp.csr_matrix(new_rows)
+    new_rows.sort_indices()
+    new_lengths = np.diff(new_rows.indptr)
+
+    lengths = np.diff(M.indptr)
+    old_positions = _csr_positions(M.indptr, rows)
+
+    if (lengths[rows] == new_lengths).all() and M.data.flags.writeable and M.indices.flags.writeable:
+        M.data[old_positions] = new_rows.data
+        M.indices[old_positions] = new_rows.indices
+        return M
+
+    lengths[rows] = new_lengths
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(M.indptr.dtype)
+    new_positions = _csr_positions(indptr, rows)
+
+    keep = np.ones(M.nnz, dtype=bool)
+    keep[old_positions] = False
+    fill = np.ones(indptr[-1], dtype=bool)
+    fill[new_positions] = False
+
+    data = np.empty(indptr[-1], dtype=M.dtype)
+    indices = np.empty(indptr[-1], dtype=M.indices.dtype)
+    data[fill] = M.data[keep]
+    indices[fill] = M.indices[keep]
+    data[new_positions] = new_rows.data
+    indices[new_positions] = new_rows.indices
+
+    return sp.csr_matrix((data, indices, indptr), shape=M.shape)
+
+
+def update_normalized_adjacency(P, degrees, A, changed):
+    """
+    Updates P = A / (A.sum(0) + 1) after the edges around some nodes changed.
+
+    Only the columns of the changed nodes change, and for a symmetric A those columns only have
+    entries in the rows of the changed nodes and their old and new neighbors, so only those
+    rows are recomputed.
+
+    :param P: normalized adjacency of the old graph, see _normalized_adjacency
+    :param degrees: 1d float array of the column sums of the old adjacency, updated in place
+    :param A: scipy.sparse.csr_matrix, symmetric adjacency of the new graph
+    :param changed: 1d array of the endpoints of the changed edges, see apply_edge_changes
+    :return: the new normalized adjacency, and the sorted rows that were recomputed
+    """
+    changed = np.asarray(changed, dtype='int64')
+    changed_rows = A[changed]
+
+    degrees[changed] = np.asarray(changed_rows.sum(1)).ravel()
+
+    rows = np.unique(np.concatenate([changed, P[changed].indices, changed_rows.indices]).astype('int64'))
+
+    new_rows = sp.csr_matrix(A[rows], dtype='float64', copy=True)
+    new_rows.data /= degrees[new_rows.indices] + 1.0
+
+    return _replace_csr_rows(P, rows, new_rows), rows
+
+
+def update_diffusion_kernel(K, P, first_hop, rows, threshold=None, push=None):
+    """
+    Recomputes the changed rows of a diffusion kernel in place after an edge change.
+
+    Only the rows in rows[-1] (see affected_rows) are recomputed, by sparse walks from those
+    nodes, so the cost follows the size of the affected neighborhood.
+
+    :param K: writable dense kernel array, CSRDiffusionKernel or LazyDiffusionKernel
+    :param P: normalized adjacency of the new graph, see _normalized_adjacency
+    :param first_hop: first hop of the new kernel (P, or P thresholded for pre-sparse kernels)
+    :param rows: list of changed rows per hop, from affected_rows
+    :param threshold: threshold of post-sparse kernels, applied to every recomputed hop
+    :param push: optional (epsilon, top_k) of a push kernel, see _push_diffusion_kernel; its
+        rows are recomputed with the same pruning
+    """
+    k = len(rows) - 1
+    nodes = rows[-1]
+
+    if isinstance(K, LazyDiffusionKernel):
+        K.P = P
+        K.first_hop = first_hop
+        for node in nodes:
+            K._cache.pop(node, None)
+        return
+
+    if push is not None:
+        hops = _push_rows(P, first_hop, nodes, k, *push)
+        if threshold is not None:
+            hops = [_threshold_csr(hop, threshold) for hop in hops]
+    else:
+        hops = _diffusion_rows(P, first_hop, nodes, k, threshold)
+
+    if isinstance(K, CSRDiffusionKernel):
+        for i in range(1, k + 1):
+            K.hops[i] = _replace_csr_rows(K.hops[i], nodes, hops[i])
+    elif isinstance(K, np.ndarray):
+        for i in range(1, k + 1):
+            K[nodes, i, :] = hops[i].toarray()
+    else:
+        raise TypeError('cannot update a kernel of type %s' % type(K).__name__)
+
+
+def update_diffusion_features(features, P, first_hop, X, rows, threshold=None):
+    """
+    Recomputes the changed rows of diffusion features in place after an edge change.
+
+    Hop i of the features only changes in rows[i], and those rows only read hop i - 1 at their
+    neighbors, so the cost follows the size of the affected neighborhood.
+
+    :param features: 3d numpy array of shape (N, k + 1, F), as from A_to_diffusion_features
+    :param P: normalized adjacency of the new graph, see _normalized_adjacency
+    :param first_hop: first hop of the new kernel (P, or P thresholded for pre-sparse features)
+    :param X: 2d numpy array or scipy.sparse matrix of node features
+    :param rows: list of changed rows per hop, from affected_rows
+    :param threshold: threshold of post-sparse features
+    """
+    k = len(rows) - 1
+    X = X.toarray() if sp.issparse(X) else X
+
+    if threshold is not None:
+        # Thresholding P**i does not commute with the product, so walk the rows explicitly.
+        hops = _diffusion_rows(P, first_hop, rows[-1], k, threshold)
+        for i in range(1, k + 1):
+            features[rows[-1], i, :] = hops[i].dot(X)
+        return
+
+    for i in range(1, k + 1):
+        hop = first_hop if i == 1 else P
+        previous = X if i == 1 else features[:, i - 1, :]
+        features[rows[i], i, :] = hop[rows[i]].dot(previous)
+
+
+def sample_neighborhood(A, seeds, fanouts):
+    """
+    Samples the receptive field of some nodes, hop by hop.
+
+    At hop i every node first reached at hop i - 1 keeps at most fanouts[i - 1] of its neighbors,
+    drawn without replacement; a fanout of None keeps all of them.
+
+    :param A: scipy.sparse.csr_matrix, adjacency matrix
+    :param seeds: 1d array of distinct node indices
+    :param fanouts: list of integers or None, one per hop
+    :return: 1d int64 array of the sampled nodes, starting with seeds in their given order
+    """
+    seeds = np.asarray(seeds, dtype='int64')
+
+    visited = np.zeros(A.shape[0], dtype=bool)
+    visited[seeds] = True
+    nodes = [seeds]
+    frontier = seeds
+
+    for fanout in fanouts:
+        if not len(frontier):
+            break
+
+        starts = A.indptr[frontier]
+        counts = A.indptr[frontier + 1] - starts
+
+        # Positions of all the frontier's edges in A.indices, grouped by frontier node.
+        owner = np.repeat(np.arange(len(frontier)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        edges = np.repeat(starts, counts) + offsets
+
+        if fanout is not None:
+            # Rank the edges of each node by a random key and keep the first fanout.
+            order = np.lexsort((np.random.rand(len(edges)), owner))
+            edges = edges[order][offsets < fanout]
+
+        neighbors = np.unique(A.indices[edges])
+        frontier = neighbors[~visited[neighbors]].astype('int64')
+        visited[frontier] = True
+        nodes.append(frontier)
+
+    return np.concatenate(nodes)
+
+
+def subgraph_diffusion_kernel(A, nodes, k, degrees=None, dtype='float32'):
+    """
+    Computes the dense diffusion kernel of the subgraph induced by nodes.
+
+    Columns are normalized by the degrees in the full graph, so the rows of nodes whose k-hop
+    neighborhood lies inside the subgraph are exactly the full kernel's rows, restricted to nodes.
+
+    :param A: scipy.sparse.csr_matrix, adjacency matrix
+    :param nodes: 1d array of node indices, e.g. from sample_neighborhood
+    :param k: integer, degree of series
+    :param degrees: optional 1d array of the column sums of A, to avoid recomputing them
+    :param dtype: storage type of the kernel
+    :return: 3d numpy array of shape (len(nodes), k + 1, len(nodes))
+    """
+    assert k >= 0
+
+    if degrees is None:
+        degrees = np.asarray(A.sum(0)).ravel()
+
+    P = sp.csr_matrix(A[nodes][:, nodes], dtype='float64')
+    P = P.dot(sp.diags(1.0 / (degrees[nodes] + 1.0))).tocsr()
+
+    return _dense_diffusion_kernel(P, P, k, dtype=dtype)
+
+
+def candidate_pairs(A, top_k=None):
+    """
+    Lists the node pairs scored by a chunked LearnableGraphReductionLayer.
+
+    :param A: 2d numpy array or scipy.sparse matrix, adjacency matrix
+    :param top_k: optional integer; instead of the edges, pair each node with the top_k other
+                  nodes it shares the most neighbors with
+    :return: 2d int64 numpy array of shape (pairs, 2)
+    """
+    A = sp.csr_matrix(A, dtype='float64')
+
+    if top_k is None:
+        return np.transpose(A.nonzero()).astype('int64')
+
+    C = A.dot(A).tocsr()
+    C.setdiag(0.0)
+    C.eliminate_zeros()
+
+    rows = np.repeat(np.arange(C.shape[0]), np.diff(C.indptr))
+    order = np.lexsort((-C.data, rows))
+    rank = np.arange(C.nnz) - np.repeat(C.indptr[:-1], np.diff(C.indptr))
+
+    keep = order[rank < top_k]
+    return np.transpose([rows[keep], C.indices[keep]]).astype('int64')
+
+
+diffusion_kernel_map = {
+    'dense': A_to_diffusion_kernel,
+    'csr': A_to_csr_diffusion_kernel,
+    'lazy': A_to_lazy_diffusion_kernel,
+}
+
+post_sparse_diffusion_kernel_map = {
+    'dense': A_to_post_sparse_diffusion_kernel,
+    'csr': A_to_post_sparse_csr_diffusion_kernel,
+    'lazy': A_to_post_sparse_lazy_diffusion_kernel,
+    'push': A_to_post_sparse_push_diffusion_kernel,
+}
+
+pre_sparse_diffusion_kernel_map = {
+    'dense': A_to_pre_sparse_diffusion_kernel,
+    'csr': A_to_pre_sparse_csr_diffusion_kernel,
+    'lazy': A_to_pre_sparse_lazy_diffusion_kernel,
+    'push': A_to_pre_sparse_push_diffusion_kernel,
+}
+
+
+def bucket_graphs(sizes, batch_size, shuffle=False):
+    """
+    Groups graphs of similar size into batches.
+
+    :param sizes: list of integers, number of nodes of each graph
+    :param batch_size: integer, maximum number of graphs per batch
+    :param shuffle: boolean, whether to shuffle the order of the batches
+    :return: list of 1d numpy arrays of positions into sizes
+    """
+    order = np.argsort(sizes, kind='mergesort')
+
+    batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    if shuffle:
+        np.random.shuffle(batches)
+
+    return batches
+
+
+def pack_graphs(A, X, indices):
+    """
+    Packs several graphs into one zero-padded batch.
+
+    Every graph is padded with isolated, featureless nodes up to the largest graph of the batch.
+    Padded nodes have no edges, so they change neither the degree normalization nor the powers
+    of the other nodes, and their node weight is 0.  Batching graphs of similar size
+    (bucket_graphs) keeps the padding small.
+
+    :param A: list of 2d numpy arrays, adjacency matrix of each graph
+    :param X: list of 2d numpy arrays, node features of each graph
+    :param indices: graphs to pack
+    :return: (graphs, nodes, nodes) adjacency, (graphs, nodes, features) features, and the
+             (graphs, nodes) node weights, 1 / n_g for the nodes of graph g and 0 for padding
+    """
+    sizes = [A[index].shape[0] for index in indices]
+    n = max(sizes)
+    dtype = X[indices[0]].dtype
+
+    packed_A = np.zeros((len(indices), n, n), dtype=dtype)
+    packed_X = np.zeros((len(indices), n, X[indices[0]].shape[1]), dtype=dtype)
+    for g, index in enumerate(indices):
+        packed_A[g, :sizes[g], :sizes[g]] = A[index]
+        packed_X[g, :sizes[g]] = X[index]
+
+    return packed_A, packed_X, _node_weights(sizes, n, dtype)
+
+
+def _node_weights(sizes, n, dtype):
+    weights = np.zeros((len(sizes), n), dtype=dtype)
+    for g, size in enumerate(sizes):
+        weights[g, :size] = 1.0 / size
+
+    return weights
+
+
+def graph_power_series(A, k, dtype='float32'):
+    """
+    Computes the power series [P**0, P**1, ..., P**k] of a graph, with P = A / (A.sum(0) + 1).
+
+    This is the series the graph-level DCNN layers otherwise build inside the Theano graph.
+
+    :param A: 2d numpy array, adjacency matrix
+    :param k: integer, degree of series
+    :param dtype: storage type of the series
+    :return: 3d numpy array of shape (k + 1, N, N)
+    """
+    A = np.asarray(A, dtype='float64')
+    P = A / (A.sum(0) + 1.0)
+
+    series = np.empty((k + 1,) + A.shape, dtype=dtype)
+
+    hop = np.eye(A.shape[0])
+    series[0] = hop
+    for i in range(1, k + 1):
+        hop = P.dot(hop)
+        series[i] = hop
+
+    return series
+
+
+class PowerSeriesCache(object):
+    """
+    The power series of many graphs packed into one flat buffer.
+
+    cache[i] is a (k + 1, N_i, N_i) view into the buffer, so looking a graph up copies nothing.
+    """
+    def __init__(self, sizes, k, dtype='float32'):
+        self.sizes = np.asarray(sizes, dtype='int64')
+        self.k = k
+
+        self.offsets = np.concatenate([[0], np.cumsum((k + 1) * self.sizes ** 2)])
+        self.data = np.empty(self.offsets[-1], dtype=dtype)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, index):
+        n = self.sizes[index]
+        return self.data[self.offsets[index]:self.offsets[index + 1]].reshape(self.k + 1, n, n)
+
+
+def _power_series_job(job):
+    A, k, dtype = job
+    return graph_power_series(A, k, dtype)
+
+
+def precompute_power_series(A, k, dtype='float32', num_workers=None, chunk_size=16):
+    """
+    Computes the power series of every graph, across a process pool.
+
+    :param A: list of 2d numpy arrays, adjacency matrix of each graph
+    :param k: integer, degree of series
+    :param dtype: storage type of the series
+    :param num_workers: number of worker processes; None uses one per CPU, 1 computes in-process
+    :param chunk_size: number of graphs sent to a worker at a time
+    :return: PowerSeriesCache
+    """
+    cache = PowerSeriesCache([a.shape[0] for a in A], k, dtype)
+    jobs = [(a, k, dtype) for a in A]
+
+    if num_workers == 1:
+        for i, job in enumerate(jobs):
+            cache[i][...] = _power_series_job(job)
+        return cache
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for i, series in enumerate(pool.imap(_power_series_job, jobs, chunk_size)):
+            cache[i][...] = series
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return cache
+
+
+def pack_power_series(series, X, indices):
+    """
+    Packs the power series of several graphs, zero-padded like pack_graphs packs their adjacency
+    matrices.
+
+    :param series: PowerSeriesCache or list of 3d numpy arrays, power series of each graph
+    :param X: list of 2d numpy arrays, node features of each graph
+    :param indices: graphs to pack
+    :return: (graphs, k + 1, nodes, nodes) series, (graphs, nodes, features) features, and the
+             node weights
+    """
+    sizes = [series[index].shape[1] for index in indices]
+    n = max(sizes)
+    dtype = X[indices[0]].dtype
+
+    packed = np.zeros((len(indices), series[indices[0]].shape[0], n, n), dtype=dtype)
+    packed_X = np.zeros((len(indices), n, X[indices[0]].shape[1]), dtype=dtype)
+    for g, index in enumerate(indices):
+        packed[g, :, :sizes[g], :sizes[g]] = series[index]
+        packed_X[g, :sizes[g]] = X[index]
 
-    return np.transpose(np.asarray(Apow, dtype='float32'), (1, 0, 2))
\ No newline at end of file
+    return packed, packed_X, _node_weights(sizes, n, dtype)
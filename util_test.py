@@ -1,6 +1,7 @@
 import unittest
 
 import numpy as np
+import scipy.sparse as sp
 
 import data
 import util
@@ -53,6 +54,95 @@ class TestDiffusionKernelsSynthetic(unittest.TestCase):
         K = util.A_to_post_sparse_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
         self._skeleton_diffusion_test(K)
 
+    def test_csr_diffusion_kernel(self):
+        K = util.A_to_csr_diffusion_kernel(self.A, self.num_hops)
+        self._skeleton_diffusion_test(K)
+        self.assertTrue(np.allclose(K[:, :, :], util.A_to_diffusion_kernel(self.A, self.num_hops)))
+
+    def test_pre_thresholded_csr_diffusion_kernel(self):
+        K = util.A_to_pre_sparse_csr_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        self._skeleton_diffusion_test(K)
+        self.assertTrue(np.allclose(
+            K[:, :, :],
+            util.A_to_pre_sparse_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        ))
+
+    def test_post_thresholded_csr_diffusion_kernel(self):
+        K = util.A_to_post_sparse_csr_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        self._skeleton_diffusion_test(K)
+        self.assertTrue(np.allclose(
+            K[:, :, :],
+            util.A_to_post_sparse_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        ))
+
+    def test_lazy_diffusion_kernel(self):
+        K = util.A_to_lazy_diffusion_kernel(self.A, self.num_hops, cache_size=2)
+        self._skeleton_diffusion_test(K[:, :, :])
+
+        dense_K = util.A_to_diffusion_kernel(self.A, self.num_hops)
+        indices = np.asarray([1, 0, 1, self.num_nodes - 1])
+        self.assertTrue(np.allclose(K[indices, :, :], dense_K[indices, :, :]))
+        self.assertTrue(len(K._cache) <= 2)
+
+    def test_pre_thresholded_lazy_diffusion_kernel(self):
+        K = util.A_to_pre_sparse_lazy_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        self.assertTrue(np.allclose(
+            K[:, :, :],
+            util.A_to_pre_sparse_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        ))
+
+    def test_post_thresholded_lazy_diffusion_kernel(self):
+        K = util.A_to_post_sparse_lazy_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        self.assertTrue(np.allclose(
+            K[:, :, :],
+            util.A_to_post_sparse_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        ))
+
+    def test_push_diffusion_kernel(self):
+        K = util.A_to_push_diffusion_kernel(self.A, self.num_hops, 0.0)
+        self._skeleton_diffusion_test(K)
+        self.assertTrue(np.allclose(K[:, :, :], util.A_to_diffusion_kernel(self.A, self.num_hops)))
+
+        K = util.A_to_push_diffusion_kernel(self.A, self.num_hops, 0.0, top_k=2)
+        for hop in K.hops:
+            self.assertTrue(np.diff(hop.indptr).max() <= 2)
+
+        K = util.A_to_pre_sparse_push_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        self._skeleton_diffusion_test(K)
+        for hop in K.hops[1:]:
+            self.assertTrue(hop.nnz == 0 or hop.data.min() > self.diffusion_threshold)
+
+    def test_hop_prefix(self):
+        K = util.A_to_post_sparse_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        prefix = util.hop_prefix(K, 1)
+        self.assertTrue(np.shares_memory(prefix, K))
+        self.assertTrue(np.array_equal(
+            prefix, util.A_to_post_sparse_diffusion_kernel(self.A, 1, self.diffusion_threshold)
+        ))
+
+        for K in [util.A_to_csr_diffusion_kernel(self.A, self.num_hops), util.A_to_lazy_diffusion_kernel(self.A, self.num_hops)]:
+            self.assertTrue(np.allclose(util.hop_prefix(K, 1)[:, :, :], util.A_to_diffusion_kernel(self.A, 1)))
+
+        self.assertRaises(ValueError, util.hop_prefix, K, self.num_hops + 1)
+
+    def test_diffusion_features(self):
+        X = np.random.RandomState(0).rand(self.num_nodes, 3)
+
+        K = util.A_to_diffusion_kernel(self.A, self.num_hops)
+        self.assertTrue(np.allclose(util.A_to_diffusion_features(self.A, X, self.num_hops), np.dot(K, X)))
+
+        K = util.A_to_pre_sparse_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        self.assertTrue(np.allclose(
+            util.A_to_pre_sparse_diffusion_features(self.A, X, self.num_hops, self.diffusion_threshold),
+            np.dot(K, X)
+        ))
+
+        K = util.A_to_post_sparse_diffusion_kernel(self.A, self.num_hops, self.diffusion_threshold)
+        self.assertTrue(np.allclose(
+            util.A_to_post_sparse_diffusion_features(self.A, X, self.num_hops, self.diffusion_threshold),
+            np.dot(K, X)
+        ))
+
 class TestDiffusionKernelsCompleteGraph1000(TestDiffusionKernelsSynthetic):
     def _parse_data(self):
         self.A = np.ones((1000, 1000)) - np.eye(1000)
@@ -67,3 +157,285 @@ class TestDiffusionKernelsCora(TestDiffusionKernelsSynthetic):
     def _parse_data(self):
         self.A, _, _ = data.parse_cora()
 
+
+
+class TestGraphBatching(unittest.TestCase):
+    def setUp(self):
+        self.A = [np.ones((n, n)) - np.eye(n) for n in [5, 2, 4, 2, 3]]
+        self.X = [np.arange(2 * n, dtype='float32').reshape(n, 2) for n in [5, 2, 4, 2, 3]]
+
+    def test_bucket_graphs(self):
+        batches = util.bucket_graphs([A.shape[0] for A in self.A], 2)
+        self.assertEqual([list(b) for b in batches], [[1, 3], [4, 2], [0]])
+
+    def test_pack_graphs(self):
+        A, X, S = util.pack_graphs(self.A, self.X, [0, 2])
+
+        self.assertEqual(A.shape, (2, 5, 5))
+        self.assertTrue((A[0] == self.A[0]).all())
+        self.assertTrue((A[1, :4, :4] == self.A[2]).all())
+        self.assertEqual(A[1, 4].sum() + A[1, :, 4].sum(), 0.0)
+        self.assertTrue((X[1, :4] == self.X[2]).all())
+        self.assertTrue((X[1, 4] == 0).all())
+        self.assertTrue(np.allclose((S[:, :, None] * X).sum(1), [self.X[0].mean(0), self.X[2].mean(0)]))
+
+    def test_pack_power_series(self):
+        cache = util.precompute_power_series(self.A, 2, num_workers=2)
+        series, X, S = util.pack_power_series(cache, self.X, [0, 2])
+
+        self.assertEqual(series.shape, (2, 3, 5, 5))
+        self.assertTrue(np.allclose(series[0], util.graph_power_series(self.A[0], 2)))
+        self.assertTrue(np.allclose(series[1, :, :4, :4], util.graph_power_series(self.A[2], 2)))
+        self.assertTrue((cache[4] == util.graph_power_series(self.A[4], 2)).all())
+        self.assertTrue(np.allclose((S[:, :, None] * X).sum(1), [self.X[0].mean(0), self.X[2].mean(0)]))
+
+
+class TestPushDiffusionKernels(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+
+        A = np.triu((rng.rand(200, 200) < 0.1).astype('float64'), 1)
+        self.A = A + A.T
+
+        self.num_hops = 3
+        self.epsilon = 0.05
+
+    def test_error_bound(self):
+        K = util.A_to_push_diffusion_kernel(self.A, self.num_hops, self.epsilon)[:, :, :]
+        exact = util.A_to_diffusion_kernel(self.A, self.num_hops)
+
+        for i in range(self.num_hops + 1):
+            error = exact[:, i, :] - K[:, i, :]
+            self.assertTrue(error.min() >= -1e-6)
+            self.assertTrue(error.max() <= i * self.epsilon + 1e-6)
+
+        # The bound is reached closely enough that pruning has to be doing something.
+        self.assertTrue((exact - K).max() > self.epsilon / 2)
+
+    def test_post_sparse_tracks_dense(self):
+        K = util.A_to_post_sparse_push_diffusion_kernel(self.A, self.num_hops, self.epsilon)[:, :, :]
+        dense = util.A_to_post_sparse_diffusion_kernel(self.A, self.num_hops, self.epsilon)
+
+        exact = util.A_to_post_sparse_push_diffusion_kernel(self.A, self.num_hops, self.epsilon, epsilon=0.0)
+        self.assertTrue(np.allclose(exact[:, :, :], dense))
+
+        # An entry dropped only by the push is at most the threshold plus the push error.
+        for i in range(self.num_hops + 1):
+            self.assertTrue(np.abs(dense[:, i, :] - K[:, i, :]).max() <= (i + 1) * self.epsilon + 1e-6)
+
+    def test_pre_sparse_tracks_dense(self):
+        K = util.A_to_pre_sparse_push_diffusion_kernel(self.A, self.num_hops, self.epsilon)[:, :, :]
+        dense = util.A_to_pre_sparse_diffusion_kernel(self.A, self.num_hops, self.epsilon)
+
+        exact = util.A_to_pre_sparse_push_diffusion_kernel(self.A, self.num_hops, self.epsilon, epsilon=0.0)
+        self.assertTrue(np.allclose(exact[:, :, :], dense))
+
+        self.assertTrue(np.allclose(K[:, 1, :], dense[:, 1, :]))
+        for i in range(self.num_hops + 1):
+            error = dense[:, i, :] - K[:, i, :]
+            self.assertTrue(error.min() >= -1e-6)
+            self.assertTrue(error.max() <= i * self.epsilon + 1e-6)
+
+
+
+class TestIncrementalUpdates(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+
+        A = np.triu((rng.rand(30, 30) < 0.1).astype('float64'), 1)
+        self.A = A + A.T
+        self.X = rng.rand(30, 4).astype('float32')
+
+        self.num_hops = 3
+        self.threshold = 0.05
+        self.insertions = [(0, 1), (5, 17)]
+        self.deletions = [tuple(np.transpose(np.nonzero(np.triu(self.A)))[0])]
+
+        self.A_new, self.changed = util.apply_edge_changes(self.A, self.insertions, self.deletions)
+        self.rows = util.affected_rows(self.A, self.A_new, self.changed, self.num_hops)
+        self.P = util._normalized_adjacency(self.A_new)
+
+    def test_apply_edge_changes(self):
+        A = self.A_new.toarray()
+
+        self.assertTrue((A == A.T).all())
+        self.assertEqual(A[0, 1], 1.0)
+        self.assertEqual(A[self.deletions[0]], 0.0)
+        self.assertEqual(np.abs(A - self.A).sum(), 2 * np.abs(A - self.A)[np.triu_indices(30)].sum())
+
+    def test_affected_rows(self):
+        K = util.A_to_diffusion_kernel(self.A, self.num_hops)
+        K_new = util.A_to_diffusion_kernel(self.A_new.toarray(), self.num_hops)
+
+        for i in range(1, self.num_hops + 1):
+            changed = np.flatnonzero(np.abs(K[:, i, :] - K_new[:, i, :]).max(1) > 0)
+            self.assertTrue(set(changed) <= set(self.rows[i]))
+
+    def test_update_dense_kernel(self):
+        K = util.A_to_diffusion_kernel(self.A, self.num_hops)
+        util.update_diffusion_kernel(K, self.P, self.P, self.rows)
+
+        self.assertTrue(np.allclose(K, util.A_to_diffusion_kernel(self.A_new.toarray(), self.num_hops)))
+
+    def test_update_csr_kernel(self):
+        K = util.A_to_post_sparse_csr_diffusion_kernel(self.A, self.num_hops, self.threshold)
+        util.update_diffusion_kernel(K, self.P, self.P, self.rows, self.threshold)
+
+        expected = util.A_to_post_sparse_diffusion_kernel(self.A_new.toarray(), self.num_hops, self.threshold)
+        self.assertTrue(np.allclose(K[:, :, :], expected))
+
+    def test_update_lazy_kernel(self):
+        K = util.A_to_lazy_diffusion_kernel(self.A, self.num_hops)
+        K[:, :, :]
+        util.update_diffusion_kernel(K, self.P, self.P, self.rows)
+
+        self.assertTrue(np.allclose(K[:, :, :], util.A_to_diffusion_kernel(self.A_new.toarray(), self.num_hops)))
+
+    def test_update_normalized_adjacency(self):
+        P = util._normalized_adjacency(self.A)
+        degrees = self.A.sum(0)
+
+        P, rows = util.update_normalized_adjacency(P, degrees, self.A_new, self.changed)
+
+        self.assertTrue(np.allclose(P.toarray(), self.P.toarray()))
+        self.assertTrue(np.allclose(degrees, self.A_new.sum(0)))
+        self.assertTrue(set(self.changed) <= set(rows))
+        self.assertTrue(len(rows) < 30)
+
+    def test_replace_csr_rows(self):
+        M = sp.csr_matrix(self.A)
+        rows = np.asarray([2, 7])
+
+        # Rows of the same size are overwritten in place.
+        same = sp.csr_matrix(self.A[rows] * 2.0)
+        self.assertTrue(util._replace_csr_rows(M, rows, same) is M)
+        self.assertTrue(np.allclose(M.toarray()[rows], self.A[rows] * 2.0))
+
+        expected = M.toarray()
+        expected[rows] = self.A_new.toarray()[[0, 5]]
+        replaced = util._replace_csr_rows(M, rows, self.A_new[[0, 5]])
+        self.assertTrue(np.allclose(replaced.toarray(), expected))
+
+    def test_update_push_kernel(self):
+        top_k = 4
+        K = util.A_to_post_sparse_push_diffusion_kernel(self.A, self.num_hops, self.threshold, top_k)
+        util.update_diffusion_kernel(
+            K, self.P, self.P, self.rows, self.threshold, push=(self.threshold, top_k)
+        )
+
+        expected = util.A_to_post_sparse_push_diffusion_kernel(self.A_new, self.num_hops, self.threshold, top_k)
+        self.assertTrue(np.allclose(K[:, :, :], expected[:, :, :]))
+
+        K = util.A_to_pre_sparse_push_diffusion_kernel(self.A, self.num_hops, self.threshold, top_k)
+        util.update_diffusion_kernel(
+            K, self.P, util._threshold_csr(self.P, self.threshold), self.rows, push=(self.threshold, top_k)
+        )
+
+        expected = util.A_to_pre_sparse_push_diffusion_kernel(self.A_new, self.num_hops, self.threshold, top_k)
+        self.assertTrue(np.allclose(K[:, :, :], expected[:, :, :]))
+
+    def test_update_features(self):
+        features = util.A_to_pre_sparse_diffusion_features(self.A, self.X, self.num_hops, self.threshold)
+        util.update_diffusion_features(
+            features, self.P, util._threshold_csr(self.P, self.threshold), self.X, self.rows
+        )
+
+        expected = util.A_to_pre_sparse_diffusion_features(self.A_new, self.X, self.num_hops, self.threshold)
+        self.assertTrue(np.allclose(features, expected, atol=1e-6))
+
+    def test_update_post_sparse_features(self):
+        features = util.A_to_post_sparse_diffusion_features(self.A, self.X, self.num_hops, self.threshold)
+        util.update_diffusion_features(features, self.P, self.P, self.X, self.rows, self.threshold)
+
+        expected = util.A_to_post_sparse_diffusion_features(self.A_new, self.X, self.num_hops, self.threshold)
+        self.assertTrue(np.allclose(features, expected, atol=1e-6))
+
+
+class TestNeighborhoodSampling(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+
+        A = np.triu((rng.rand(60, 60) < 0.05).astype('float64'), 1)
+        self.A = sp.csr_matrix(A + A.T)
+        self.seeds = np.asarray([7, 3, 42])
+        self.num_hops = 2
+
+    def test_fanout(self):
+        np.random.seed(0)
+        nodes = util.sample_neighborhood(self.A, self.seeds, [2, 2])
+
+        self.assertTrue((nodes[:3] == self.seeds).all())
+        self.assertEqual(len(np.unique(nodes)), len(nodes))
+        self.assertTrue(len(nodes) <= 3 * (1 + 2 + 2 * 2))
+
+    def test_full_neighborhood_kernel(self):
+        nodes = util.sample_neighborhood(self.A, self.seeds, [None] * self.num_hops)
+        K = util.subgraph_diffusion_kernel(self.A, nodes, self.num_hops)
+
+        expected = util.A_to_diffusion_kernel(self.A, self.num_hops)[self.seeds]
+        self.assertTrue(np.allclose(K[:3][:, :, np.argsort(nodes)], expected[:, :, np.sort(nodes)]))
+        self.assertAlmostEqual(K[:3].sum(), expected.sum(), places=4)
+
+
+class TestCandidatePairs(unittest.TestCase):
+    def setUp(self):
+        # A path 0 - 1 - 2 - 3 plus the chord 0 - 2.
+        self.A = np.zeros((4, 4))
+        for i, j in [(0, 1), (1, 2), (2, 3), (0, 2)]:
+            self.A[i, j] = self.A[j, i] = 1.0
+
+    def test_edges(self):
+        pairs = util.candidate_pairs(self.A)
+        self.assertEqual(sorted(map(tuple, pairs)), sorted(zip(*np.nonzero(self.A))))
+
+    def test_top_k(self):
+        pairs = util.candidate_pairs(self.A, top_k=1)
+
+        common = np.dot(self.A, self.A) - np.diag(np.diag(np.dot(self.A, self.A)))
+        self.assertEqual(sorted(pairs[:, 0]), [0, 1, 2, 3])
+        self.assertTrue(all(common[i, j] == common[i].max() for i, j in pairs))
+
+
+class TestDenseKernelBudget(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+
+        A = np.triu((rng.rand(50, 50) < 0.1).astype('float64'), 1)
+        self.A = A + A.T
+        self.num_hops = 3
+        self.kernel_bytes = 50 * (self.num_hops + 1) * 50 * 4
+
+    def test_chunked_build(self):
+        K = util.A_to_post_sparse_diffusion_kernel(self.A, self.num_hops, 0.05)
+
+        stats = {}
+        chunked = util.A_to_post_sparse_diffusion_kernel(
+            self.A, self.num_hops, 0.05, memory_budget=self.kernel_bytes + 10000, stats=stats
+        )
+
+        self.assertTrue(stats['num_chunks'] > 1)
+        self.assertTrue(stats['peak_bytes'] <= self.kernel_bytes + 10000)
+        self.assertTrue((chunked == K).all())
+
+    def test_default_chunk_size(self):
+        K = util.A_to_diffusion_kernel(self.A, self.num_hops)
+
+        chunk_size = util.DENSE_KERNEL_CHUNK_SIZE
+        util.DENSE_KERNEL_CHUNK_SIZE = 16
+        try:
+            stats = {}
+            chunked = util.A_to_diffusion_kernel(self.A, self.num_hops, stats=stats)
+        finally:
+            util.DENSE_KERNEL_CHUNK_SIZE = chunk_size
+
+        self.assertEqual((stats['chunk_size'], stats['num_chunks']), (16, 4))
+        self.assertTrue((chunked == K).all())
+
+    def test_refuse_over_budget(self):
+        self.assertRaises(MemoryError, util.A_to_diffusion_kernel, self.A, self.num_hops, memory_budget=self.kernel_bytes)
+
+    def test_float16(self):
+        K = util.A_to_diffusion_kernel(self.A, self.num_hops, dtype='float16')
+
+        self.assertEqual(K.dtype, np.float16)
+        self.assertTrue(np.allclose(K, util.A_to_diffusion_kernel(self.A, self.num_hops), atol=1e-3))